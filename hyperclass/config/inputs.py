@@ -25,6 +25,8 @@ def getXarray(  id: str, xcoords: Dict, subsample: int, xdims:OrderedDict, **kwa
 
 def prepare_inputs( input_vars, ssample = None ):
     subsample = int(dataManager.config.value("input.reduction/subsample", 1 ) ) if ssample is None else ssample
+    input_file_ids = [ input_vars['embedding'] ] + list(input_vars['directory']) + [ input_vars['plot'][axis] for axis in ['x','y'] ]
+    for input_file_id in input_file_ids: dataManager.convertInputFileData( input_file_id )
 #    values = { k: dataManager.config.value(k) for k in dataManager.config.allKeys() }
     np_embedding = dataManager.getInputFileData( input_vars['embedding'], subsample )
     dims = np_embedding.shape
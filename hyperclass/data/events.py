@@ -29,6 +29,10 @@ class DataEventHandler:
         rv.load()
         return rv
 
+    @property
+    def subsampling(self) -> Optional[int]:
+        return self._subsample
+
     def config(self, **kwargs ):
         self._subsample = kwargs.pop('subsample', None)
 
@@ -0,0 +1,27 @@
+import numpy as np
+from contextlib import contextmanager
+from typing import Iterator, Dict
+import os, json, threading
+
+# Atomic file writes shared by the data, graph, reduction and batch caches: data is written to a hidden temporary file
+# in the target directory, which is renamed over the target only once it is complete, so concurrent readers (threads
+# or processes) never see a partially written file, and an interrupted write leaves the previous file (or none) in place.
+
+@contextmanager
+def atomic_write( path: str ) -> Iterator[str]:
+    # Yields the temporary path to write to; it keeps the target's file name as a suffix, so extension-sensitive writers (e.g. Keras) still work.
+    directory, filename = os.path.split( path )
+    tmp_file = os.path.join( directory, f".{os.getpid()}.{threading.get_ident()}.{filename}" )
+    try:
+        yield tmp_file
+        os.replace( tmp_file, path )
+    finally:
+        if os.path.exists( tmp_file ): os.remove( tmp_file )
+
+def save_array( path: str, array: np.ndarray ):
+    with atomic_write( path ) as tmp_file:
+        with open( tmp_file, 'wb' ) as f: np.save( f, np.ascontiguousarray( array ) )
+
+def save_json( path: str, content: Dict ):
+    with atomic_write( path ) as tmp_file:
+        with open( tmp_file, 'w' ) as f: json.dump( content, f )
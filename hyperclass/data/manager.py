@@ -1,7 +1,8 @@
 import numpy as np
 from typing import List, Union, Tuple, Optional, Dict
-import os, math, pickle
+import os, math, pickle, json
 from hyperclass.gui.config import SettingsManager
+from hyperclass.data.files import save_array, save_json
 
 class DataManager(SettingsManager):
 
@@ -10,10 +11,42 @@ class DataManager(SettingsManager):
         SettingsManager.__init__(  self, **kwargs )
         self.spatial = SpatialDataManager( self, **kwargs )
 
+    @classmethod
+    def binaryFilePath(cls, input_file_path: str ) -> str:
+        return input_file_path if input_file_path.endswith(".npy") else os.path.splitext(input_file_path)[0] + ".npy"
+
+    @classmethod
+    def headerFilePath(cls, binary_file_path: str ) -> str:
+        return os.path.splitext(binary_file_path)[0] + ".json"
+
+    @classmethod
+    def sourceStats(cls, input_file_path: str ) -> Dict:
+        stat = os.stat( input_file_path )
+        return dict( source_mtime=stat.st_mtime, source_size=stat.st_size )
+
+    def isCurrent(self, input_file_path: str, binary_file_path: str ) -> bool:
+        # A converted file is current unless its source pickle has changed since the conversion (as recorded in its header).
+        if not os.path.isfile( binary_file_path ): return False
+        if ( binary_file_path == input_file_path ) or not os.path.isfile( input_file_path ): return True
+        header_file_path = self.headerFilePath( binary_file_path )
+        if not os.path.isfile( header_file_path ): return os.path.getmtime( binary_file_path ) >= os.path.getmtime( input_file_path )
+        with open( header_file_path ) as f: header = json.load( f )
+        source_stats = self.sourceStats( input_file_path )
+        if not all( [ header.get( key ) == value for key, value in source_stats.items() ] ): return False
+        # The header is written after the array and records its size and mtime, so a header paired with another array is not current.
+        stat = os.stat( binary_file_path )
+        return ( header.get( 'binary_size', stat.st_size ) == stat.st_size ) and ( header.get( 'binary_mtime', stat.st_mtime ) == stat.st_mtime )
+
     def getInputFileData(self, input_file_id: str, subsample: int = 1, dims: Tuple[int] = None ):
         input_file_path = self.config.value(f"data/init/{input_file_id}")
         try:
-            if os.path.isfile(input_file_path):
+            binary_file_path = self.binaryFilePath( input_file_path )
+            if os.path.isfile( binary_file_path ) and not self.isCurrent( input_file_path, binary_file_path ):
+                print( f"Input file {input_file_path} has changed since it was converted, reconverting")
+                if self.convertInputFileData( input_file_id, refresh=True ) is None: os.remove( binary_file_path )
+            if os.path.isfile( binary_file_path ):
+                return self.getBinaryFileData( input_file_id, binary_file_path, subsample, dims )
+            elif os.path.isfile(input_file_path):
                 print(f"Reading unstructured {input_file_id} data from file {input_file_path}")
                 with open(input_file_path, 'rb') as f:
                     result = pickle.load(f)
@@ -30,4 +63,40 @@ class DataManager(SettingsManager):
         except Exception as err:
             print(f" Can't read data[{input_file_id}] file {input_file_path}: {err}")
 
+    def getBinaryFileData(self, input_file_id: str, binary_file_path: str, subsample: int = 1, dims: Tuple[int] = None ) -> np.ndarray:
+        print(f"Mapping unstructured {input_file_id} data from file {binary_file_path}")
+        header_file_path = self.headerFilePath( binary_file_path )
+        header = {}
+        if os.path.isfile( header_file_path ):
+            with open( header_file_path ) as f: header = json.load( f )
+        result: np.ndarray = np.load( binary_file_path, mmap_mode='r' )
+        if dims is not None and (result.shape[0] == dims[1]):
+            if (result.ndim == 1) or (header.get('source_type') == 'list'): return result
+        return result[::subsample]
+
+    def convertInputFileData(self, input_file_id: str, refresh: bool = False ) -> Optional[str]:
+        input_file_path = self.config.value(f"data/init/{input_file_id}")
+        binary_file_path = self.binaryFilePath( input_file_path )
+        if self.isCurrent( input_file_path, binary_file_path ) and not refresh: return binary_file_path
+        try:
+            source_stats = self.sourceStats( input_file_path )
+            with open(input_file_path, 'rb') as f:
+                result = pickle.load(f)
+            source_type = "list" if isinstance( result, list ) else "ndarray"
+            if   isinstance( result, np.ndarray ): data = result
+            elif isinstance( result[0], np.ndarray ): data = np.vstack( result )
+            else: data = np.array( result )
+            if data.dtype == object:
+                print( f"Skipping conversion of {input_file_id} data: object arrays can't be memory-mapped")
+                return None
+            save_array( binary_file_path, data )
+            binary_stat = os.stat( binary_file_path )
+            header = dict( source=input_file_path, source_type=source_type, shape=list(data.shape), dtype=str(data.dtype), binary_size=binary_stat.st_size, binary_mtime=binary_stat.st_mtime, **source_stats )
+            save_json( self.headerFilePath( binary_file_path ), header )
+            print(f"Converted {input_file_id} data from file {input_file_path} to {binary_file_path}, shape = {data.shape}")
+            return binary_file_path
+        except Exception as err:
+            print(f" Can't convert data[{input_file_id}] file {input_file_path}: {err}")
+            return None
+
 dataManager = DataManager()
\ No newline at end of file
@@ -0,0 +1,195 @@
+import numpy as np
+import xarray as xa
+import rioxarray as rio
+from collections import OrderedDict
+from typing import List, Union, Tuple, Optional, Dict, Callable
+from hyperclass.data.files import save_array, save_json
+import os, json, math, shutil, threading
+
+def _jsonable( value ):
+    if isinstance( value, np.ndarray ): return value.tolist()
+    if isinstance( value, np.generic ): return value.item()
+    if isinstance( value, (list, tuple) ): return [ _jsonable(v) for v in value ]
+    if isinstance( value, dict ): return { str(k): _jsonable(v) for k, v in value.items() }
+    if isinstance( value, (str, int, float, bool) ) or value is None: return value
+    raise TypeError( f"Can't serialize value of type {type(value)}" )
+
+class TileCache:
+    # Directory of .npy chunks aligned with the block grid; files are renamed into place and the header is written last,
+    # so concurrent readers (threads or processes) only ever see complete chunks of a complete cache.
+
+    HEADER = "header.json"
+
+    def __init__( self, cache_dir: str, name: str ):
+        self.path = os.path.join( cache_dir, name + ".chunks" )
+        self._header: Optional[Dict] = None
+
+    @property
+    def exists(self) -> bool:
+        return os.path.isfile( os.path.join( self.path, self.HEADER ) )
+
+    @property
+    def header(self) -> Optional[Dict]:
+        if self._header is None and self.exists:
+            with open( os.path.join( self.path, self.HEADER ) ) as f:
+                self._header = json.load( f )
+        return self._header
+
+    @property
+    def attrs(self) -> Optional[Dict]:
+        return None if self.header is None else self.header['attrs']
+
+    @property
+    def shape(self) -> List[int]:
+        return self.header['shape']
+
+    @property
+    def chunk_shape(self) -> List[int]:
+        return self.header['chunk_shape']
+
+    def _chunk_file(self, iy: int, ix: int ) -> str:
+        return os.path.join( self.path, f"c-{iy}-{ix}.npy" )
+
+    def write( self, raster: xa.DataArray, chunk_shape: List[int], band_spec: str = None ) -> str:
+        os.makedirs( self.path, exist_ok=True )
+        data = raster.data          # numpy or dask: a dask tile is computed one chunk at a time
+        nchunks = [ math.ceil( data.shape[i+1] / chunk_shape[i] ) for i in range(2) ]
+        for iy in range( nchunks[0] ):
+            for ix in range( nchunks[1] ):
+                y0, x0 = iy*chunk_shape[0], ix*chunk_shape[1]
+                chunk = data[ :, y0:y0+chunk_shape[0], x0:x0+chunk_shape[1] ]
+                if hasattr( chunk, 'compute' ): chunk = chunk.compute()
+                self.writeChunk( iy, ix, chunk )
+        crs = raster.rio.crs
+        self.writeHeader( data.shape, data.dtype, raster.dims, { dim: raster.coords[dim].values for dim in raster.dims }, chunk_shape, raster.name,
+                          None if crs is None else crs.to_wkt(), raster.attrs, band_spec )
+        print( f"Writing tile cache {self.path}: shape = {data.shape}, {nchunks[0]*nchunks[1]} chunks of shape {chunk_shape}" )
+        return self.path
+
+    def writeChunk( self, iy: int, ix: int, chunk: np.ndarray ):
+        # Chunks can also be written one at a time (e.g. by a streaming producer), followed by writeHeader once all are in place.
+        os.makedirs( self.path, exist_ok=True )
+        save_array( self._chunk_file(iy, ix), chunk )
+
+    def writeHeader( self, shape: List[int], dtype, dims: List[str], coords: Dict[str,np.ndarray], chunk_shape: List[int], name: str = None, crs_wkt: str = None, attrs: Dict = None, band_spec: str = None ):
+        os.makedirs( self.path, exist_ok=True )
+        for dim in dims: save_array( os.path.join( self.path, f"{dim}.npy" ), np.asarray( coords[dim] ) )
+        header = dict( shape=list(shape), dtype=str(np.dtype(dtype)), dims=list(dims), chunk_shape=list(chunk_shape), name=name, crs_wkt=crs_wkt, band_spec=band_spec, attrs={} )
+        for key, value in ( {} if attrs is None else attrs ).items():
+            try: header['attrs'][key] = _jsonable( value )
+            except TypeError: pass
+        save_json( os.path.join( self.path, self.HEADER ), header )
+        self._header = header
+
+    def invalidate( self ):
+        if os.path.isdir( self.path ): shutil.rmtree( self.path, ignore_errors=True )
+        self._header = None
+
+    def readWindow( self, ybounds: Tuple[int,int], xbounds: Tuple[int,int] ) -> xa.DataArray:
+        cy, cx = self.chunk_shape
+        y0, y1 = ybounds[0], min( ybounds[1], self.shape[1] )
+        x0, x1 = xbounds[0], min( xbounds[1], self.shape[2] )
+        rows = []
+        for iy in range( y0//cy, (y1-1)//cy + 1 ):
+            row = []
+            for ix in range( x0//cx, (x1-1)//cx + 1 ):
+                chunk: np.ndarray = np.load( self._chunk_file(iy, ix), mmap_mode='r' )
+                cy0, cx0 = iy*cy, ix*cx
+                row.append( chunk[ :, max(y0-cy0,0):y1-cy0, max(x0-cx0,0):x1-cx0 ] )
+            rows.append( row[0] if len(row) == 1 else np.concatenate( row, axis=2 ) )
+        data = rows[0] if len(rows) == 1 else np.concatenate( rows, axis=1 )
+        dims = self.header['dims']
+        coords = { dims[0]: np.load( os.path.join( self.path, f"{dims[0]}.npy" ) ),
+                   dims[1]: np.load( os.path.join( self.path, f"{dims[1]}.npy" ) )[y0:y1],
+                   dims[2]: np.load( os.path.join( self.path, f"{dims[2]}.npy" ) )[x0:x1] }
+        raster = xa.DataArray( data, dims=dims, coords=coords, attrs=dict( self.attrs ), name=self.header['name'] )
+        if self.header['crs_wkt'] is not None: raster.rio.write_crs( self.header['crs_wkt'], inplace=True )
+        return raster
+
+    def read( self, lazy: bool = False ) -> xa.DataArray:
+        if lazy: return self.readLazy()
+        return self.readWindow( (0, self.shape[1]), (0, self.shape[2]) )
+
+    def readLazy( self ) -> xa.DataArray:
+        import dask.array as da
+        nchunks = [ math.ceil( self.shape[i+1] / self.chunk_shape[i] ) for i in range(2) ]
+        chunks = [ [ da.from_array( np.load( self._chunk_file(iy, ix), mmap_mode='r' ), chunks=-1 ) for ix in range( nchunks[1] ) ] for iy in range( nchunks[0] ) ]
+        data = da.block( chunks )
+        dims = self.header['dims']
+        coords = { dim: np.load( os.path.join( self.path, f"{dim}.npy" ) ) for dim in dims }
+        raster = xa.DataArray( data, dims=dims, coords=coords, attrs=dict( self.attrs ), name=self.header['name'] )
+        if self.header['crs_wkt'] is not None: raster.rio.write_crs( self.header['crs_wkt'], inplace=True )
+        return raster
+
+class BlockCache:
+    # LRU cache of Block instances (raw raster, reduced point data and index arrays) keyed by Tile.blockKey, bounded by block/cache_size (MB).
+    # The key starts with the block's dsid and includes the settings its point data depends on, so a settings change is a miss.
+
+    def __init__( self, max_bytes: int = None ):
+        self._blocks: OrderedDict = OrderedDict()
+        self._max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._build_locks: Dict[str,threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self) -> int:
+        from hyperclass.data.manager import dataManager
+        if self._max_bytes is not None: return self._max_bytes
+        return dataManager.config.value( 'block/cache_size', 2048, type=int ) * 2**20
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum( [ block.nbytes for block in self._blocks.values() ] )
+
+    def __contains__(self, key: str ) -> bool:
+        with self._lock:
+            return key in self._blocks
+
+    def getBlock(self, key: str, factory: Callable[[],"Block"] ) -> "Block":
+        with self._lock:
+            build_lock = self._build_locks.setdefault( key, threading.Lock() )
+        with build_lock:
+            with self._lock:
+                block = self._blocks.get( key )
+                if block is not None:
+                    self._blocks.move_to_end( key )
+                    self.hits += 1
+            if block is None:
+                block = factory()
+                with self._lock:
+                    self.misses += 1
+                    self._blocks[ key ] = block
+        self.evict()
+        return block
+
+    def evict(self):
+        with self._lock:
+            sizes = OrderedDict( [ ( key, block.nbytes ) for key, block in self._blocks.items() ] )
+            total, max_bytes = sum( sizes.values() ), self.max_bytes
+            while ( total > max_bytes ) and ( len(sizes) > 1 ):
+                key, size = sizes.popitem( last=False )
+                del self._blocks[ key ]
+                self._build_locks.pop( key, None )
+                total -= size
+                self.evictions += 1
+                print( f"BlockCache: evicted block {key} ({size/2**20:.1f} MB)" )
+
+    def clear(self, prefix: str = "" ):
+        with self._lock:
+            for key in [ key for key in self._blocks.keys() if key.startswith( prefix ) ]:
+                del self._blocks[ key ]
+                self._build_locks.pop( key, None )
+
+    def stats(self) -> Dict[str,int]:
+        with self._lock:
+            return dict( hits=self.hits, misses=self.misses, evictions=self.evictions, blocks=len(self._blocks), nbytes=self.nbytes, max_bytes=self.max_bytes )
+
+    def __str__(self):
+        stats = self.stats()
+        return f"hits={stats['hits']}, misses={stats['misses']}, evictions={stats['evictions']}, blocks={stats['blocks']}, size={stats['nbytes']/2**20:.1f}/{stats['max_bytes']/2**20:.0f} MB"
+
+blockCache = BlockCache()
@@ -1,14 +1,19 @@
 import numpy as np
+import pandas as pd
 import xarray as xa
 import pathlib
 import matplotlib as mpl
-from typing import List, Union, Tuple, Optional, Dict
+from typing import List, Union, Tuple, Optional, Dict, Iterator
 from matplotlib.colors import LinearSegmentedColormap, ListedColormap
 from PyQt5.QtCore import QSettings, QCoreApplication
 import matplotlib.pyplot as plt
-import os, math, pickle
+import os, math, pickle, time, warnings
+from concurrent.futures import ThreadPoolExecutor
+import rasterio
+from rasterio.windows import Window
 import rioxarray as rio
 from hyperclass.data.manager import DataManager
+from hyperclass.data.spatial.cache import TileCache
 from hyperclass.gui.config import SettingsManager
 from hyperclass.util.accessor import _register_accessor
 def register_datamanager_accessor(name): return _register_accessor(name, DataManager)
@@ -70,10 +75,14 @@ class MarkerManager:
 
 class SpatialDataManager():
 
+    STATS_CHUNK_BYTES = 2**24       # Largest slice of a window reduced at once by computeImageStats
+
     def __init__( self, settings: SettingsManager, **kwargs ):   # Tile shape (y,x) matches image shape (row,col)
         self._settings = settings
         self.cacheTileData = kwargs.get( 'cache_tile', True )
+        self.windowedRead = kwargs.get( 'windowed_read', True )
         self._image_name = None
+        self._image_stats: Dict[str,Dict[str,np.ndarray]] = {}
 
     @property
     def config(self):
@@ -89,6 +98,32 @@ class SpatialDataManager():
             self._image_name = self.config.value("data/init/file")
         return self._image_name
 
+    @property
+    def scheduler(self) -> str:
+        return self.config.value( 'data/dask/scheduler', 'none' )
+
+    @property
+    def lazy(self) -> bool:
+        return self.scheduler != 'none'
+
+    def configureScheduler(self):
+        # Applied wherever lazy tile data is created or computed: dask arrays also compute implicitly (e.g. through .values).
+        import dask
+        nworkers = self.config.value( 'data/dask/nworkers', os.cpu_count(), type=int )
+        dask.config.set( scheduler=self.scheduler, num_workers=nworkers )
+
+    def compute(self, raster: xa.DataArray ) -> xa.DataArray:
+        if raster.chunks is None: return raster
+        self.configureScheduler()
+        t0 = time.time()
+        result = raster.compute( scheduler=self.scheduler )
+        print( f"Computed raster {raster.name} {raster.shape} with the {self.scheduler} scheduler in {time.time()-t0} sec")
+        return result
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype( self.config.value( 'data/dtype', 'float32' ) )
+
     @property
     def tile_shape(self) -> List[int]:
         return self.config.value( 'tile/shape', [ 1000, 1000 ], type=int )
@@ -122,7 +157,8 @@ class SpatialDataManager():
 
     def getXArray(self, fill_value: float, shape: Tuple[int], dims: Tuple[str], **kwargs ) -> xa.DataArray:
         coords = kwargs.get( "coords", { dim: np.arange(shape[id]) for id, dim in enumerate(dims) } )
-        result: xa.DataArray = xa.DataArray( np.full( shape, fill_value ), dims=dims, coords=coords )
+        dtype = kwargs.get( "dtype", self.dtype if isinstance( fill_value, float ) else None )
+        result: xa.DataArray = xa.DataArray( np.full( shape, fill_value, dtype=dtype ), dims=dims, coords=coords )
         result.attrs.update( kwargs.get("attrs",{}) )
         result.name = kwargs.get( "name", "")
         return result
@@ -141,18 +177,50 @@ class SpatialDataManager():
         self.config.setValue( 'block/array_shape', block_array_shape)
 
     def getTileData(self, **kwargs ) -> Optional[xa.DataArray]:
-        tile_data: Optional[xa.DataArray] = self._readTileFile() if self.cacheTileData else None
-        if tile_data is None: tile_data = self._getTileDataFromImage()
-        if tile_data is None: return None
-        tile_data = self.mask_nodata( tile_data )
+        tile_cache = self.tileCache()
+        if self.validTileCache( tile_cache ):
+            if self.lazy: self.configureScheduler()
+            tile_data: xa.DataArray = tile_cache.read( self.lazy )
+            self.setTilesPerImage( self.config.value(self.image_name, None) )
+        else:
+            tile_data: Optional[xa.DataArray] = self._getTileDataFromImage()
+            if tile_data is None: return None
+            tile_data = self.selectValidBands( self.mask_nodata( tile_data, self.dtype ) )
+            if self.cacheTileData:
+                tile_cache.invalidate()
+                tile_cache.write( tile_data, self.block_shape, self.band_spec )
+        result =  self.rescale(tile_data, **kwargs)
+        return result
+
+    def getBlockData(self, block_coords: Tuple[int,int], **kwargs ) -> Optional[xa.DataArray]:
+        tile_cache = self.tileCache()
+        if not self.validTileCache( tile_cache ): return None
+        self.setTilesPerImage( self.config.value(self.image_name, None) )
+        y0, x0 = block_coords[0]*self.block_shape[0], block_coords[1]*self.block_shape[1]
+        block_data: xa.DataArray = tile_cache.readWindow( ( y0, y0+self.block_shape[0] ), ( x0, x0+self.block_shape[1] ) )
+        return self.rescale( block_data, **kwargs )
+
+    def getTileAttrs(self) -> Optional[Dict]:
+        tile_cache = self.tileCache()
+        return tile_cache.attrs if self.validTileCache( tile_cache ) else None
+
+    def tileCache(self) -> TileCache:
+        return TileCache( self.config.value('data/cache'), self.tileFileName() )
+
+    def validTileCache(self, tile_cache: TileCache ) -> bool:
+        # A tile cached with another dtype or band selection (data/valid_bands) is rewritten.
+        if not ( self.cacheTileData and tile_cache.exists ): return False
+        return ( tile_cache.header['dtype'] == self.dtype.name ) and ( tile_cache.header.get('band_spec') == self.band_spec )
+
+    def selectValidBands(self, tile_data: xa.DataArray ) -> xa.DataArray:
         init_shape = [ *tile_data.shape ]
         valid_bands =   self.config.value('data/valid_bands', None ) # [[0, 195], [214, 286], [319, 421]] #
-        if valid_bands is not None:
+        if (valid_bands is not None) and ('valid_bands' not in tile_data.attrs):
             dataslices = [tile_data.isel(band=slice(valid_band[0], valid_band[1])) for valid_band in valid_bands]
             tile_data = xa.concat(dataslices, dim="band")
+            tile_data.attrs['valid_bands'] = valid_bands
             print( f"-------------\n         ***** Selecting valid bands ({valid_bands}), init_shape = {init_shape}, resulting Tile shape = {tile_data.shape}")
-        result =  self.rescale(tile_data, **kwargs)
-        return result
+        return tile_data
 
     def set_tile_transform( self, data: xa.DataArray ):
         tr0 = data.transform
@@ -162,23 +230,153 @@ class SpatialDataManager():
         data.attrs['transform'] = [ tr0[0], tr0[1], x0, tr0[3], tr0[4], y0  ]
 
     def _computeSpatialNorm(self, tile_raster: xa.DataArray, refresh=False) -> xa.DataArray:
-        norm_file = os.path.join( self.config.value('data/cache'), self.normFileName )
-        if not refresh and os.path.isfile( norm_file ):
-            print( f"Loading norm from global norm file {norm_file}")
-            return xa.DataArray.from_dict( pickle.load( open( norm_file, 'rb' ) ) )
-        else:
-            print(f"Computing norm and saving to global norm file {norm_file}")
-            norm: xa.DataArray = tile_raster.mean(dim=['x','y'], skipna=True )
-            pickle.dump( norm.to_dict(), open( norm_file, 'wb' ) )
-            return norm
+        stats = self.getImageStats( refresh )
+        if stats is None:
+            print( f"Image statistics unavailable, computing norm from raster {tile_raster.name}")
+            return tile_raster.mean(dim=['x','y'], skipna=True )
+        norm = xa.DataArray( stats['mean'], dims=['band'], coords=dict( band=stats['band'] ) )
+        return norm.sel( band=tile_raster.coords['band'] )
+
+    def getImageStats(self, refresh=False, **kwargs ) -> Optional[Dict[str,np.ndarray]]:
+        stats_file = os.path.join( self.config.value('data/cache'), self.statsFileName )
+        stats = self._image_stats.get( stats_file )
+        if stats is None:
+            if not refresh and os.path.isfile( stats_file ):
+                print( f"Loading image statistics from file {stats_file}")
+                stats = pickle.load( open( stats_file, 'rb' ) )
+            else:
+                stats = self.computeImageStats( **kwargs )
+                if stats is None: return None
+                print(f"Saving image statistics to file {stats_file}")
+                pickle.dump( stats, open( stats_file, 'wb' ) )
+            self._image_stats[ stats_file ] = stats
+        return stats
+
+    def getBandStats(self, bands: np.ndarray, norm_type: str = "none" ) -> Optional[Tuple[np.ndarray,np.ndarray]]:
+        # Image-wide band statistics of the data as rescaled with norm_type (spectral: of each pixel divided by its band mean).
+        stats = self.getImageStats()
+        if ( stats is not None ) and ( norm_type == "spectral" ):
+            if 'spectral' not in stats: stats = self.getImageStats( refresh=True )       # Stats file written before spectral stats were kept
+            stats = None if stats is None else stats.get( 'spectral' )
+        if stats is None: return None
+        band_index = { int(band): index for index, band in enumerate( stats['band'] ) }
+        try:                indices = np.array( [ band_index[ int(band) ] for band in bands ] )
+        except KeyError:    return None
+        mean, std = stats['mean'][indices], stats['std'][indices]
+        if norm_type == "spatial": return np.ones_like( mean ), std / mean
+        return mean, std
+
+    def computeImageStats(self, **kwargs ) -> Optional[Dict[str,np.ndarray]]:
+        image_specs = self.readImageSpecs( self.image_name )
+        if image_specs is None: return None
+        # Block-sized windows, each reduced chunk by chunk (see _windowStats), with as many threads as data/stats/memory (MB) allows.
+        nproc = kwargs.get( 'nproc', self.config.value( 'data/stats/nproc', 1, type=int ) )
+        window_shape = self.block_shape
+        valid_bands = self.config.value('data/valid_bands', None )
+        nrows, ncols = image_specs['shape']
+        nbands = len( self.getBandIndices( valid_bands, image_specs['attrs']['nbands'] ) )
+        windows = [ ( (y0, min(y0+window_shape[0],nrows)), (x0, min(x0+window_shape[1],ncols)) ) for y0 in range( 0, nrows, window_shape[0] ) for x0 in range( 0, ncols, window_shape[1] ) ]
+        window_bytes = 2 * nbands * window_shape[0] * window_shape[1] * np.dtype( self.dtype ).itemsize + 4 * self.STATS_CHUNK_BYTES      # Read buffer, masked copy and chunk temporaries
+        memory_budget = self.config.value( 'data/stats/memory', 1024, type=int ) * 2**20
+        nthreads = int( max( 1, min( nproc, memory_budget // window_bytes ) ) )
+        print( f"Computing statistics for image {self.image_name} over {len(windows)} windows with {nthreads} threads")
+        t0 = time.time()
+        compute_stats = lambda window: self._windowStats( window, valid_bands )
+        stats = None
+        with ThreadPoolExecutor( nthreads ) as executor:
+            window_stats = executor.map( compute_stats, windows ) if nthreads > 1 else map( compute_stats, windows )
+            for wstats in window_stats:
+                if wstats is not None: stats = wstats if stats is None else self._mergeStats( stats, wstats )
+        if stats is None: return None
+        for band_stats in [ stats, stats['spectral'] ]: band_stats['std'] = np.sqrt( band_stats.pop('M2') / np.maximum( band_stats['count'], 1 ) )
+        stats.update( image=self.image_name, valid_bands=valid_bands )
+        print( f"Computed image statistics in {time.time()-t0} sec")
+        return stats
+
+    def iterImagePoints(self, **kwargs ) -> Iterator[np.ndarray]:
+        # Streams the valid pixels of the whole image as ( npoints, nbands ) arrays, one tile-size window at a time.
+        image_specs = self.readImageSpecs( self.image_name )
+        if image_specs is None: return
+        window_size = self.config.value( 'tile/size', 1000, type=int )
+        valid_bands = self.config.value('data/valid_bands', None )
+        nrows, ncols = image_specs['shape']
+        for y0 in range( 0, nrows, window_size ):
+            for x0 in range( 0, ncols, window_size ):
+                raster: Optional[xa.DataArray] = self.readGeotiffWindow( self.image_name, (y0, min(y0+window_size,nrows)), (x0, min(x0+window_size,ncols)), valid_bands )
+                if raster is None: continue
+                raster = self.rescale( self.mask_nodata( raster, self.dtype ), **kwargs )
+                points: np.ndarray = self.raster2points( raster, multi_index=False ).values
+                if points.shape[0] > 0: yield points
+
+    def readImageSample(self, nsamples: int ) -> Optional[xa.DataArray]:
+        # Decimated read of the whole image on a regular pixel grid: a spatially representative sample of roughly nsamples pixels.
+        filename = self.image_name if self.image_name.endswith(".tif") else self.image_name + ".tif"
+        try:
+            input_file = os.path.join(self.config.value('data/dir'), filename)
+            with rasterio.open( input_file ) as src:
+                stride = max( 1, int( math.ceil( math.sqrt( src.height * src.width / nsamples ) ) ) )
+                out_shape = [ int( math.ceil( src.height / stride ) ), int( math.ceil( src.width / stride ) ) ]
+                band_indices = self.getBandIndices( self.config.value('data/valid_bands', None ), src.count )
+                data: np.ndarray = src.read( indexes=band_indices, out_shape=[ len(band_indices) ] + out_shape, out_dtype=self.dtype )
+                attrs = dict( src.tags() )
+                if 'data_ignore_value' in attrs: attrs['data_ignore_value'] = float( attrs['data_ignore_value'] )
+            sample = xa.DataArray( data, dims=['band','y','x'], coords=dict( band=band_indices, y=np.arange(out_shape[0]), x=np.arange(out_shape[1]) ), attrs=attrs, name="sample" )
+            print(f"Reading image sample with stride {stride} from file {input_file}, shape = {sample.shape}")
+            return self.mask_nodata( sample, self.dtype )
+        except Exception as err:
+            print( f"WARNING: can't read sample from input file {filename}: {err}")
+            return None
+
+    def _windowStats(self, window: Tuple[ Tuple[int,int], Tuple[int,int] ], valid_bands: Optional[List[List[int]]] ) -> Optional[Dict[str,np.ndarray]]:
+        # The window's pixels are reduced in chunks of at most STATS_CHUNK_BYTES, so temporaries (including the spectral data) stay small.
+        raster: Optional[xa.DataArray] = self.readGeotiffWindow( self.image_name, window[0], window[1], valid_bands )
+        if raster is None: return None
+        data: np.ndarray = self.mask_nodata( raster, self.dtype ).values.reshape( raster.shape[0], -1 )
+        bands = raster.coords['band'].values
+        chunk_size = max( 1, self.STATS_CHUNK_BYTES // ( data.itemsize * max( data.shape[0], 1 ) ) )
+        stats = None
+        for c0 in range( 0, data.shape[1], chunk_size ):
+            chunk = data[ :, c0:c0+chunk_size ]
+            with np.errstate( invalid='ignore', divide='ignore' ), warnings.catch_warnings():
+                warnings.simplefilter( "ignore", category=RuntimeWarning )     # All-nodata pixels
+                spectral_data = chunk / np.nanmean( chunk, axis=0 )
+            spectral_data[ ~np.isfinite( spectral_data ) ] = np.nan
+            chunk_stats = self._arrayStats( bands, chunk )
+            chunk_stats['spectral'] = self._arrayStats( bands, spectral_data )
+            stats = chunk_stats if stats is None else self._mergeStats( stats, chunk_stats )
+        return stats
+
+    @classmethod
+    def _arrayStats(cls, bands: np.ndarray, data: np.ndarray ) -> Dict[str,np.ndarray]:
+        # Welford state of each band (row) of data, accumulated in float64 without upcasting data itself.
+        count = np.isfinite( data ).sum( axis=1 )
+        with np.errstate( invalid='ignore', divide='ignore' ):
+            mean = np.where( count > 0, np.nansum( data, axis=1, dtype=np.float64 ) / np.maximum( count, 1 ), 0.0 )
+            M2 = np.nansum( np.square( data - mean[:,None].astype( data.dtype ) ), axis=1, dtype=np.float64 )
+        vmin = np.fmin.reduce( data, axis=1 ).astype( np.float64 )
+        vmax = np.fmax.reduce( data, axis=1 ).astype( np.float64 )
+        return dict( band=bands, count=count, mean=mean, M2=M2, min=vmin, max=vmax )
+
+    @classmethod
+    def _mergeStats(cls, s0: Dict[str,np.ndarray], s1: Dict[str,np.ndarray] ) -> Dict[str,np.ndarray]:
+        count = s0['count'] + s1['count']
+        delta = s1['mean'] - s0['mean']
+        safe_count = np.maximum( count, 1 )
+        mean = s0['mean'] + delta * s1['count'] / safe_count
+        M2 = s0['M2'] + s1['M2'] + delta**2 * s0['count'] * s1['count'] / safe_count
+        merged = dict( band=s0['band'], count=count, mean=mean, M2=M2, min=np.fmin( s0['min'], s1['min'] ), max=np.fmax( s0['max'], s1['max'] ) )
+        if 'spectral' in s0: merged['spectral'] = cls._mergeStats( s0['spectral'], s1['spectral'] )
+        return merged
 
     def _getTileDataFromImage(self) -> Optional[xa.DataArray]:
+        if self.windowedRead and not self.lazy: return self._getTileDataFromWindow()
         full_input_bands: xa.DataArray = self.readGeotiff( self.image_name )
         if full_input_bands is None: return None
         image_attrs = dict(shape=full_input_bands.shape[-2:], attrs=full_input_bands.attrs)
         self.setTilesPerImage( image_attrs )
         ybounds, xbounds = self.getTileBounds()
         tile_raster = full_input_bands[:, ybounds[0]:ybounds[1], xbounds[0]:xbounds[1] ]
+        if self.lazy: tile_raster = tile_raster.chunk( dict( band=-1, y=self.block_shape[0], x=self.block_shape[1] ) )
         tile_filename = self.tileFileName()
         tile_raster.attrs['tile_coords'] = self.tile_index
         tile_raster.attrs['filename'] = tile_filename
@@ -186,18 +384,23 @@ class SpatialDataManager():
         tile_raster.attrs['image_shape'] = full_input_bands.shape
         self.config.setValue( self.image_name, image_attrs )
         self.set_tile_transform( tile_raster )
-        if self.cacheTileData: self.writeGeotiff( tile_raster, tile_filename )
         return tile_raster
 
-    def _readTileFile( self, iband = -1 ) -> Optional[xa.DataArray]:
-        tile_filename =self.tileFileName()
-        print(f"Reading tile file {tile_filename}")
-        tile_raster: Optional[xa.DataArray] = self.readGeotiff(tile_filename, iband)
-        if tile_raster is not None:
-            tile_raster.name = f"{self.image_name}: Band {iband+1}" if( iband >= 0 ) else self.image_name
-            tile_raster.attrs['filename'] = tile_filename
-            image_specs = self.config.value(self.image_name, None)
-            self.setTilesPerImage( image_specs )
+    def _getTileDataFromWindow(self) -> Optional[xa.DataArray]:
+        image_attrs = self.readImageSpecs( self.image_name )
+        if image_attrs is None: return None
+        self.setTilesPerImage( image_attrs )
+        ybounds, xbounds = self.getTileBounds()
+        valid_bands = self.config.value('data/valid_bands', None )
+        tile_raster = self.readGeotiffWindow( self.image_name, ybounds, xbounds, valid_bands )
+        if tile_raster is None: return None
+        tile_filename = self.tileFileName()
+        tile_raster.attrs['tile_coords'] = self.tile_index
+        tile_raster.attrs['filename'] = tile_filename
+        tile_raster.attrs['image']  = self.image_name
+        tile_raster.attrs['image_shape'] = image_attrs['shape']
+        if valid_bands is not None: tile_raster.attrs['valid_bands'] = valid_bands
+        self.config.setValue( self.image_name, image_attrs )
         return tile_raster
 
     @classmethod
@@ -225,7 +428,11 @@ class SpatialDataManager():
         if not filename.endswith(".tif"): filename = filename + ".tif"
         try:
             input_file = os.path.join(self.config.value('data/dir'), filename)
-            input_bands: xa.DataArray =  rio.open_rasterio(input_file)
+            if self.lazy:
+                self.configureScheduler()
+                input_bands: xa.DataArray = rio.open_rasterio( input_file, chunks=dict( band=-1, y=self.block_shape[0], x=self.block_shape[1] ) )
+            else:
+                input_bands: xa.DataArray =  rio.open_rasterio(input_file)
             if 'transform' not in input_bands.attrs.keys():
                 gts = input_bands.spatial_ref.GeoTransform.split()
                 input_bands.attrs['transform'] = [ float(gts[i]) for i in [ 1,2,0,4,5,3 ] ]
@@ -236,10 +443,60 @@ class SpatialDataManager():
             print( f"WARNING: can't read input file {filename}: {err}")
             return None
 
+    def readImageSpecs( self, filename: str ) -> Optional[Dict]:
+        if not filename.endswith(".tif"): filename = filename + ".tif"
+        try:
+            input_file = os.path.join(self.config.value('data/dir'), filename)
+            with rasterio.open( input_file ) as src:
+                return dict( shape=[ src.height, src.width ], attrs=dict( nbands=src.count, transform=list(src.transform)[:6] ) )
+        except Exception as err:
+            print( f"WARNING: can't read input file {filename}: {err}")
+            return None
+
+    @classmethod
+    def getBandIndices( cls, valid_bands: Optional[List[List[int]]], nbands: int ) -> List[int]:
+        if valid_bands is None: return list( range( 1, nbands+1 ) )
+        band_indices = []
+        for valid_band in valid_bands:
+            band_indices.extend( range( int(valid_band[0])+1, min( int(valid_band[1]), nbands )+1 ) )
+        return band_indices
+
+    def readGeotiffWindow( self, filename: str, ybounds: Tuple[int,int], xbounds: Tuple[int,int], valid_bands: List[List[int]] = None ) -> Optional[xa.DataArray]:
+        if not filename.endswith(".tif"): filename = filename + ".tif"
+        try:
+            input_file = os.path.join(self.config.value('data/dir'), filename)
+            with rasterio.open( input_file ) as src:
+                y0, y1 = ybounds[0], min( ybounds[1], src.height )
+                x0, x1 = xbounds[0], min( xbounds[1], src.width )
+                window = Window( x0, y0, x1-x0, y1-y0 )
+                band_indices = self.getBandIndices( valid_bands, src.count )
+                data: np.ndarray = src.read( indexes=band_indices, window=window, out_dtype=self.dtype )
+                tr = src.window_transform( window )
+                xc = tr.c + ( np.arange( x1-x0 ) + 0.5 ) * tr.a
+                yc = tr.f + ( np.arange( y1-y0 ) + 0.5 ) * tr.e
+                attrs = dict( src.tags() )
+                if 'data_ignore_value' in attrs: attrs['data_ignore_value'] = float( attrs['data_ignore_value'] )
+                if src.nodata is not None: attrs['_FillValue'] = src.nodata
+                attrs['transform'] = list(tr)[:6]
+                crs_wkt = None if src.crs is None else src.crs.to_wkt()
+            window_raster = xa.DataArray( data, dims=['band','y','x'], coords=dict( band=band_indices, y=yc, x=xc ), attrs=attrs )
+            if crs_wkt is not None: window_raster.rio.write_crs( crs_wkt, inplace=True )
+            print(f"Reading raster window [{y0}:{y1},{x0}:{x1}] ({len(band_indices)} bands) from file {input_file}, shape = {window_raster.shape}")
+            return window_raster
+        except Exception as err:
+            print( f"WARNING: can't read window from input file {filename}: {err}")
+            return None
+
     @classmethod
-    def mask_nodata(self, raster: xa.DataArray ) -> xa.DataArray:
+    def mask_nodata(cls, raster: xa.DataArray, dtype = np.float32 ) -> xa.DataArray:
         nodata_value = raster.attrs.get( 'data_ignore_value', -9999 )
-        return raster.where(raster != nodata_value, float('nan'))
+        if raster.chunks is not None:
+            result = raster.astype( dtype ).where( raster != nodata_value )
+            result.attrs = raster.attrs
+            return result
+        data: np.ndarray = raster.values
+        masked = np.where( data != nodata_value, data.astype( dtype, copy=False ), np.array( np.nan, dtype=dtype ) )
+        return raster.copy( data=masked )
 
     def tileFileName(self) -> str:
         return f"{self.image_name}.{self._fmt(self.tile_shape)}_{self._fmt(self.tile_index)}"
@@ -256,9 +513,20 @@ class SpatialDataManager():
         except Exception:
             return ""
 
+    def labelsFileName(self) -> str:
+        return f"{self.markerFileName()}.labels.pkl"
+
+    def getMarkerManager(self) -> MarkerManager:
+        return MarkerManager( self.labelsFileName(), self.config )
+
     @property
-    def normFileName( self ) -> str:
-        return f"global_norm.pkl"
+    def band_spec( self ) -> str:
+        valid_bands = self.config.value('data/valid_bands', None )
+        return "all" if valid_bands is None else "-".join( [ f"{int(vb[0])}_{int(vb[1])}" for vb in valid_bands ] )
+
+    @property
+    def statsFileName( self ) -> str:
+        return f"{self.markerFileName()}.{self.band_spec}.stats.pkl"
 
     @classmethod
     def scale_to_bounds(cls, raster: xa.DataArray, bounds: Tuple[float, float] ) -> xa.DataArray:
@@ -303,20 +571,45 @@ class SpatialDataManager():
                 norm: xa.DataArray = self._computeSpatialNorm( raster, refresh )
             elif norm_type == "spectral":
                 norm: xa.DataArray = raster.mean( dim=['band'], skipna=True )
-            result =  raster / norm
+            result =  raster / norm.astype( raster.dtype, copy=False )
             result.attrs = raster.attrs
         return result
 
     @classmethod
-    def raster2points(cls, raster: xa.DataArray ) -> xa.DataArray:
-        stacked_raster = raster.stack(samples=raster.dims[-2:]).transpose()
+    def valid_pixel_indices(cls, raster: xa.DataArray ) -> np.ndarray:
+        data: np.ndarray = raster.values.reshape( -1, raster.shape[-2]*raster.shape[-1] )
         if np.issubdtype( raster.dtype, np.integer ):
-            nodata = stacked_raster.attrs.get('_FillValue',-2)
-            point_data = stacked_raster.where( stacked_raster != nodata, drop=True ).astype(np.int32)
+            nodata = raster.attrs.get('_FillValue',-2)
+            valid = ( data != nodata ).all( axis=0 )
         else:
-            point_data = stacked_raster.dropna(dim='samples', how='any')
-        print(f" raster2points -> [{raster.name}]: Using {point_data.shape[0]} valid samples out of {stacked_raster.shape[0]} pixels")
-        return point_data
+            valid = np.isfinite( data ).all( axis=0 )
+        return np.flatnonzero( valid ).astype( np.int32 )
+
+    @classmethod
+    def samples_index(cls, raster: xa.DataArray, pindices: np.ndarray ) -> pd.MultiIndex:
+        ydim, xdim = raster.dims[-2:]
+        iy, ix = np.divmod( pindices, raster.shape[-1] )
+        return pd.MultiIndex( levels=[ raster.coords[ydim].values, raster.coords[xdim].values ], codes=[ iy, ix ], names=[ ydim, xdim ], verify_integrity=False )
+
+    @classmethod
+    def raster2points(cls, raster: xa.DataArray, pindices: np.ndarray = None, multi_index: bool = True ) -> xa.DataArray:
+        # With multi_index=False the samples coordinate is just the flat pixel indices: callers that only need the point values skip
+        # building the (y, x) MultiIndex, which samples_index( raster, pindices ) attaches on demand (see Block.samples_axis).
+        if pindices is None: pindices = cls.valid_pixel_indices( raster )
+        npixels = raster.shape[-2]*raster.shape[-1]
+        point_dtype = np.int32 if np.issubdtype( raster.dtype, np.integer ) else raster.dtype
+        coords = dict( samples=cls.samples_index( raster, pindices ) if multi_index else pindices )
+        if raster.ndim == 2:
+            point_data = raster.values.reshape( npixels )[ pindices ].astype( point_dtype, copy=False )
+            dims = [ 'samples' ]
+        else:
+            point_data = raster.values.reshape( raster.shape[0], npixels ).transpose()[ pindices ].astype( point_dtype, copy=False )
+            band_dim = raster.dims[0]
+            dims = [ 'samples', band_dim ]
+            coords[ band_dim ] = raster.coords[ band_dim ].values
+        result = xa.DataArray( point_data, dims=dims, coords=coords, attrs=dict( raster.attrs ), name=raster.name )
+        print(f" raster2points -> [{raster.name}]: Using {point_data.shape[0]} valid samples out of {npixels} pixels")
+        return result
 
     @classmethod
     def get_color_bounds( cls, raster: xa.DataArray ):
@@ -0,0 +1,59 @@
+from typing import List, Union, Tuple, Optional, Dict
+from hyperclass.data.manager import dataManager
+from hyperclass.gui.tasks import taskRunner, Task
+from hyperclass.data.spatial.tile import Tile, Block
+import threading, time
+
+class BlockPrefetcher:
+    # Warms the block cache and the NN graphs of the blocks adjacent to the current one on low priority background tasks.
+
+    PRIORITY = -10
+
+    def __init__( self ):
+        self._generation = 0
+        self._tasks: List[Task] = []
+        self._lock = threading.Lock()
+
+    @property
+    def connectivity(self) -> int:
+        return dataManager.config.value( 'block/prefetch', 4, type=int )
+
+    def neighbors(self, block_coords: Tuple[int,int] ) -> List[Tuple[int,int]]:
+        nBlocks = dataManager.config.value( "block/array_shape", [ 1, 1 ], type=int )
+        offsets = [ (-1,0), (1,0), (0,-1), (0,1) ]
+        if self.connectivity == 8: offsets = offsets + [ (-1,-1), (-1,1), (1,-1), (1,1) ]
+        elif self.connectivity != 4: return []
+        candidates = [ ( block_coords[0]+dy, block_coords[1]+dx ) for (dy,dx) in offsets ]
+        return [ (iy,ix) for (iy,ix) in candidates if ( 0 <= iy < nBlocks[0] ) and ( 0 <= ix < nBlocks[1] ) ]
+
+    def schedule(self, tile: Tile, block_coords: Tuple[int,int], **kwargs ):
+        self.cancel()
+        with self._lock:
+            generation = self._generation
+            for (iy,ix) in self.neighbors( block_coords ):
+                task = Task( f"Prefetch block [{iy},{ix}]", self.prefetch, tile, iy, ix, generation, **kwargs )
+                self._tasks.append( task )
+                taskRunner.start( task, priority=self.PRIORITY )
+
+    def cancel(self):
+        with self._lock:
+            self._generation += 1
+            for task in self._tasks: taskRunner.cancel( task )
+            self._tasks = []
+
+    def cancelled(self, generation: int ) -> bool:
+        return generation != self._generation
+
+    def prefetch(self, tile: Tile, iy: int, ix: int, generation: int, **kwargs ):
+        from hyperclass.graph.flow import activationFlowManager
+        if self.cancelled( generation ): return None
+        t0 = time.time()
+        block: Optional[Block] = tile.getBlock( iy, ix )
+        if (block is None) or self.cancelled( generation ): return None
+        point_data = block.getPointData( **kwargs )
+        if (point_data.size == 0) or self.cancelled( generation ): return None
+        activationFlowManager.getActivationFlow( point_data )
+        print( f"Prefetched block [{iy},{ix}] in {time.time()-t0} sec" )
+        return None
+
+blockPrefetcher = BlockPrefetcher()
@@ -1,13 +1,63 @@
 from skimage.transform import ProjectiveTransform
 import numpy as np
 import xarray as xa
-from typing import List, Union, Tuple, Optional, Dict
+from typing import List, Union, Tuple, Optional, Dict, Callable
 from pyproj import Proj, transform
 from ..manager import dataManager
 import os, math, pickle
 from hyperclass.graph.flow import ActivationFlow
+from .cache import blockCache
 from ...reduction.manager import reductionManager
 
+def reduction_training_data( data: xa.DataArray, norm: str, block_coords: Tuple[int,int] = None ) -> np.ndarray:
+    nsamples = dataManager.config.value( "input.reduction/nsamples", 50000, type=int )
+    sample: Optional[xa.DataArray] = dataManager.spatial.readImageSample( nsamples )
+    if (sample is None) or ( sample.shape[0] != data.shape[1] ):
+        print( f"Image sample unavailable, training the reduction on block {block_coords}")
+        return data.values
+    sample = dataManager.spatial.rescale( sample, norm=norm )
+    return dataManager.spatial.raster2points( sample, multi_index=False ).values
+
+def reduction_model( data: xa.DataArray, norm: str, block_coords: Tuple[int,int] = None ) -> Tuple[str,Callable[[np.ndarray],np.ndarray]]:
+    # Key and input normalization of the configured reduction model for this image, fitting (and saving) the model on first use.
+    # The check and fit are done under the model's lock, so blocks reduced concurrently share a single fit.
+    reduction_method = dataManager.config.value("input.reduction/method", None)
+    ndim = int(dataManager.config.value("input.reduction/ndim", 16 ) )
+    epochs = int( dataManager.config.value("input.reduction/epochs", 200 ) )
+    band_stats = dataManager.spatial.getBandStats( data.coords['band'].values, norm )      # Image-wide, so every block is normalized alike
+    if band_stats is None:
+        print( f"Image statistics unavailable, normalizing the reduction inputs of block {block_coords} with its own statistics" )
+        dave, dmag =  data.values.mean(0), 2.0*data.values.std(0)
+    else:                   dave, dmag =  band_stats[0], 2.0*band_stats[1]
+    normalize = lambda values: ( values - dave.astype( data.dtype ) ) / dmag.astype( data.dtype )
+    model_key = "-".join( [ dataManager.spatial.markerFileName(), dataManager.spatial.band_spec, norm, reduction_method.lower(), reductionManager.architecture( reduction_method, data.shape[1], ndim ) ] )
+    with reductionManager.modelLock( model_key ):
+        if reductionManager.getEncoder( model_key, reduction_method ) is None:
+            if reduction_method.lower() == "incrementalpca":
+                training_data = map( normalize, dataManager.spatial.iterImagePoints( norm=norm ) )
+            else:
+                training_data = normalize( reduction_training_data( data, norm, block_coords ) )
+            reductionManager.fit( training_data, reduction_method, ndim, epochs, model_key )
+    return model_key, normalize
+
+def prepare_reduction( norm: str = "none" ) -> bool:
+    # Fits the reduction model up front (from the image sample), e.g. before dispatching blocks to worker processes.
+    if dataManager.config.value("input.reduction/method", None) == "None": return True
+    sample: Optional[xa.DataArray] = dataManager.spatial.readImageSample( dataManager.config.value( "input.reduction/nsamples", 50000, type=int ) )
+    if sample is None: return False
+    reduction_model( dataManager.spatial.raster2points( dataManager.spatial.rescale( sample, norm=norm ), multi_index=False ), norm )
+    return True
+
+def reduce_points( data: xa.DataArray, norm: str, block_coords: Tuple[int,int] = None ) -> xa.DataArray:
+    # Applies the configured input reduction to point data, fitting (and caching) the reduction model on first use.
+    reduction_method = dataManager.config.value("input.reduction/method", None)
+    ndim = int(dataManager.config.value("input.reduction/ndim", 16 ) )
+    if reduction_method != "None":
+        model_key, normalize = reduction_model( data, norm, block_coords )
+        reduced_spectra = reductionManager.transform( normalize( data.values ), model_key, reduction_method )
+        coords = dict( samples=data.coords['samples'], band=np.arange(ndim) )
+        return xa.DataArray( reduced_spectra.astype( data.dtype, copy=False ), dims=['samples', 'band'], coords=coords )
+    return data
 
 class Tile:
 
@@ -15,6 +65,7 @@ class Tile:
         self.config = kwargs
         self._data: xa.DataArray = None
         self._transform: ProjectiveTransform = None
+        self._attrs: Optional[Tuple[str,Dict]] = None
         self.subsampling: int =  kwargs.get('subsample',1)
 
     @property
@@ -23,11 +74,24 @@ class Tile:
             self._data: xa.DataArray = dataManager.spatial.getTileData(  **self.config )
         return self._data
 
+    @property
+    def attrs(self) -> Optional[Dict]:
+        # Read once per tile (from the tile cache header, else the tile data), until reset() or a change of tile.
+        name = self.name
+        if ( self._attrs is None ) or ( self._attrs[0] != name ):
+            attrs = dataManager.spatial.getTileAttrs()
+            if ( attrs is None ) and ( self.data is not None ): attrs = self.data.attrs
+            if attrs is None: return None
+            self._attrs = ( name, attrs )
+        return self._attrs[1]
+
     def iparm(self, key: str ):
         return int( dataManager.config.value(key) )
 
     def reset(self):
         self._data = None
+        self._attrs = None
+        blockCache.clear( self.name )
 
     @property
     def name(self) -> str:
@@ -35,13 +99,13 @@ class Tile:
 
     @property
     def transform(self) -> Optional[ProjectiveTransform]:
-        if self.data is None: return None
+        if self.attrs is None: return None
         if self._transform is None:
-            self._transform = ProjectiveTransform( np.array(list(self.data.attrs['transform']) + [0, 0, 1]).reshape(3, 3) )
+            self._transform = ProjectiveTransform( np.array(list(self.attrs['transform']) + [0, 0, 1]).reshape(3, 3) )
         return self._transform
 
     def get_block_transform( self, iy, ix ) -> ProjectiveTransform:
-        tr0 = self.data.attrs['transform']
+        tr0 = self.attrs['transform']
         iy0, ix0 = iy * dataManager.spatial.block_shape[0], ix * dataManager.spatial.block_shape[1]
         y0, x0 = tr0[5] + iy0 * tr0[4], tr0[2] + ix0 * tr0[0]
         tr1 = [ tr0[0], tr0[1], x0, tr0[3], tr0[4], y0, 0, 0, 1  ]
@@ -50,16 +114,24 @@ class Tile:
 
     @property
     def filename(self) -> str:
-        return self.data.attrs['filename']
+        return self.attrs['filename']
 
     @property
     def nBlocks(self) -> List[ List[int] ]:
         return [ self.data.shape[i+1]//dataManager.spatial.block_shape[i] for i in range(2) ]
 
     def getBlock(self, iy: int, ix: int, **kwargs ) -> Optional["Block"]:
-        if self.data is None: return None
-        block = Block( self, iy, ix, **kwargs )
-        return block
+        if self.attrs is None: return None
+        return blockCache.getBlock( self.blockKey( iy, ix, **kwargs ), lambda: Block( self, iy, ix, **kwargs ) )
+
+    def blockKey(self, iy: int, ix: int, **kwargs ) -> str:
+        # Block cache key: the block id plus every setting its data and (reduced) point data depend on.
+        reduction = [ dataManager.config.value("input.reduction/method", "None"), str( dataManager.config.value("input.reduction/ndim", 16 ) ) ]
+        settings = [ dataManager.spatial.band_spec, self.config.get( 'norm', 'none' ), *reduction ] + [ f"{key}={value}" for key, value in sorted( kwargs.items() ) ]
+        return "|".join( [ self.blockId( iy, ix ), *settings ] )
+
+    def blockId(self, iy: int, ix: int ) -> str:
+        return "-".join( [ self.name, str(iy), str(ix) ] )
 
     # def getPointData( self, **kwargs ) -> xa.DataArray:
     #     subsample = kwargs.get( 'subsample', None )
@@ -83,34 +155,41 @@ class Block:
         self.block_coords = (iy,ix)
         self.data = self._getData()
         self.transform = tile.get_block_transform( iy, ix )
-        self.index_array: xa.DataArray = self.get_index_array()
+        self.pindices: np.ndarray = dataManager.spatial.valid_pixel_indices( self.data )
+        self.index_array: np.ndarray = self.get_index_array()
         self._flow = None
         self._samples_axis: Optional[xa.DataArray] = None
+        self._point_indices: Optional[np.ndarray] = None
         tr = self.transform.params.flatten()
         self.data.attrs['transform'] = self.transform
         self._xlim = [ tr[2], tr[2] + tr[0] * (self.data.shape[2]) ]
         self._ylim = [ tr[5] + tr[4] * (self.data.shape[1]), tr[5] ]
         self._point_data = None
+        self._subsample: Optional[int] = None
 
     @property
     def dsid( self ):
-        return "-".join( [ self.tile.name ] + [ str(i) for i in self.block_coords ] )
+        return self.tile.blockId( *self.block_coords )
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [ self.data, self._point_data, self.pindices, self.index_array, self._point_indices ]
+        return sum( [ array.nbytes for array in arrays if array is not None ] )
 
     def _getData( self ) -> Optional[xa.DataArray]:
-        if self.tile.data is None: return None
-        ybounds, xbounds = self.getBounds()
-        block_raster = self.tile.data[:, ybounds[0]:ybounds[1], xbounds[0]:xbounds[1] ]
+        block_raster: Optional[xa.DataArray] = dataManager.spatial.getBlockData( self.block_coords, **self.tile.config )
+        if block_raster is None:
+            if self.tile.data is None: return None
+            ybounds, xbounds = self.getBounds()
+            block_raster = dataManager.spatial.compute( self.tile.data[:, ybounds[0]:ybounds[1], xbounds[0]:xbounds[1] ] )
         block_raster.attrs['block_coords'] = self.block_coords
         block_raster.name = f"{self.tile.name}_b-{self.block_coords[0]}-{self.block_coords[1]}"
         return block_raster
 
-    def get_index_array(self) -> xa.DataArray:
-        stacked_data: xa.DataArray = self.data.stack( samples=self.data.dims[-2:] )
-        filtered_samples = stacked_data[1].dropna( dim="samples" )
-        indices = np.arange(filtered_samples.shape[0])
-        point_indices = xa.DataArray( indices, dims=['samples'], coords=dict(samples=filtered_samples.samples) )
-        result = point_indices.reindex( samples=stacked_data.samples, fill_value= -1 )
-        return result.unstack()
+    def get_index_array(self) -> np.ndarray:
+        index_array = np.full( self.data.shape[-2:], -1, dtype=np.int32 )
+        index_array.reshape(-1)[ self.pindices ] = np.arange( self.pindices.size, dtype=np.int32 )
+        return index_array
 
     def iparm(self, key: str ):
         return int( dataManager.config.value(key) )
@@ -154,42 +233,35 @@ class Block:
         from hyperclass.data.events import DataType
         dstype = kwargs.get('dstype', DataType.Embedding)
         if dstype == DataType.Embedding:
-            if self._point_data is None:
-                subsample = kwargs.get( 'subsample', None )
-                result: xa.DataArray =  dataManager.spatial.raster2points( self.data )
-                if result.size > 0:
-                    ptData: xa.DataArray = result if subsample is None else result[::subsample]
-                    self._point_data =  self.reduce( ptData )
-                else:
-                    self._point_data = result
-                self._samples_axis = self._point_data.coords['samples']
-                self._point_data.attrs['dsid'] = "-".join( [ str(i) for i in self.block_coords ] )
+            subsample = kwargs.get( 'subsample', None )
+            if ( self._point_data is None ) or ( subsample != self._subsample ):
+                self._subsample = subsample
+                self._point_indices = self.pindices if subsample is None else self.pindices[::subsample]
+                self._samples_axis = None
+                result: xa.DataArray =  dataManager.spatial.raster2points( self.data, self._point_indices )
+                self._point_data =  self.reduce( result ) if result.size > 0 else result
+                self._point_data.attrs['dsid'] = self.dsid
                 self._point_data.attrs['type'] = 'block'
             return self._point_data
         elif dstype == DataType.Plot:
             subsample = kwargs.get('subsample', None)
-            result: xa.DataArray = dataManager.spatial.raster2points(self.data)
-            if result.size > 0:     point_data = result if subsample is None else result[::subsample]
-            else:                   point_data = result
-            point_data.attrs['dsid'] = "-".join([str(i) for i in self.block_coords])
+            point_data: xa.DataArray = dataManager.spatial.raster2points( self.data, self.pindices if subsample is None else self.pindices[::subsample] )
+            point_data.attrs['dsid'] = self.dsid
             point_data.attrs['type'] = 'block'
             return point_data
 
     def reduce(self, data: xa.DataArray):
-        reduction_method = dataManager.config.value("input.reduction/method", None)
-        ndim = int(dataManager.config.value("input.reduction/ndim", 16 ) )
-        epochs = int( dataManager.config.value("input.reduction/epochs", 200 ) )
-        if reduction_method != "None":
-            dave, dmag =  data.values.mean(0), 2.0*data.values.std(0)
-            normed_data = ( data.values - dave ) / dmag
-            reduced_spectra, reproduction = reductionManager.reduce( normed_data, reduction_method, ndim, epochs )
-            coords = dict( samples=data.coords['samples'], band=np.arange(ndim) )
-            return xa.DataArray( reduced_spectra, dims=['samples', 'band'], coords=coords )
-        return data
+        return reduce_points( data, self.tile.config.get( 'norm', 'none' ), self.block_coords )
+
+    @property
+    def point_indices(self) -> np.ndarray:
+        return self.pindices if self._point_indices is None else self._point_indices
 
     @property
     def samples_axis(self) -> xa.DataArray:
-        if self._samples_axis is None: self.getPointData()
+        if self._samples_axis is None:
+            samples = dataManager.spatial.samples_index( self.data, self.point_indices )
+            self._samples_axis = xa.DataArray( samples, dims=['samples'], coords=dict( samples=samples ) )
         return  self._samples_axis
 
     def getSelectedPointData( self, cy: List[float], cx: List[float] ) -> np.ndarray:
@@ -232,28 +304,29 @@ class Block:
 
     def pindex2coords(self, point_index: int) -> Dict:
         try:
-            selected_sample: List = self.samples_axis.values[point_index]
-            return dict( y = selected_sample[0], x = selected_sample[1] )
+            index = self.pindex2indices( point_index )
+            ydim, xdim = self.data.dims[-2:]
+            return dict( y = self.data.coords[ydim].values[ index['iy'] ], x = self.data.coords[xdim].values[ index['ix'] ] )
         except Exception as err:
             print( f" --> pindex2coords Error: {err}" )
 
     def pindex2indices(self, point_index: int) -> Dict:
         try:
-            selected_sample: List = self.samples_axis.values[point_index]
-            return self.coords2indices( selected_sample[0], selected_sample[1] )
+            iy, ix = divmod( int( self.point_indices[point_index] ), self.data.shape[-1] )
+            return dict( iy = iy, ix = ix )
         except Exception as err:
-            print( f" --> pindex2coords Error: {err}" )
+            print( f" --> pindex2indices Error: {err}" )
 
     def indices2pindex( self, iy, ix ) -> int:
-        return self.index_array.values[ iy, ix ]
+        return self.index_array[ iy, ix ]
 
     def coords2pindex( self, cy, cx ) -> int:
         try:
             index = self.coords2indices( cy, cx )
-            return self.index_array.values[ index['iy'], index['ix'] ]
+            return self.index_array[ index['iy'], index['ix'] ]
         except IndexError as err:
             return -1
 
     def multi_coords2pindex(self, ycoords: List[float], xcoords: List[float] ) -> np.ndarray:
         ( yi, xi ) = self.multi_coords2indices( ycoords, xcoords )
-        return self.index_array.values[ yi, xi ]
\ No newline at end of file
+        return self.index_array[ yi, xi ]
\ No newline at end of file
@@ -0,0 +1,29 @@
+from hyperclass.data.manager import dataManager
+from hyperclass.learn.batch import BatchClassifier
+import hyperclass.learn
+import numpy as np
+import os, sys, time, tempfile
+
+# Times a whole-image batch classification with the serial path and with process pools of increasing size.
+# Usage: python -m hyperclass.exe.dev.batch_scaling <project> <image> [mode] [max_nproc]
+
+if __name__ == '__main__':
+    project, image = sys.argv[1], sys.argv[2]
+    mode = sys.argv[3] if len(sys.argv) > 3 else "model"
+    max_nproc = int(sys.argv[4]) if len(sys.argv) > 4 else os.cpu_count()
+    dataManager.initProject( project, {} )
+    dataManager.spatial.setImageName( image )
+
+    results = {}
+    nproc = 1
+    while nproc <= max_nproc:
+        with tempfile.TemporaryDirectory() as output_dir:
+            classifier = BatchClassifier( output_dir, mode=mode, nproc=nproc, refresh=True )
+            t0 = time.time()
+            classifier.run()
+            results[nproc] = time.time() - t0
+        nproc = nproc * 2
+
+    print( f"\nBatch classification scaling ({mode}):" )
+    for nproc, dt in results.items():
+        print( f"   nproc = {nproc:3d}: {dt:8.2f} sec, speedup = {results[1]/dt:.2f}" )
@@ -0,0 +1,106 @@
+from hyperclass.data.manager import dataManager
+from hyperclass.data.spatial.tile import Tile
+from hyperclass.graph.index import KNNIndex
+from hyperclass.graph.cache import NNGraphCache
+from hyperclass.graph.knn import build_knn
+from hyperclass.graph.csr import CSRGraph
+from hyperclass.graph.flow import propagate_labels
+import numpy as np
+import xarray as xa
+import sys, time, tempfile, shutil, mmap
+
+# Memory footprint and accuracy of the compact graph storage modes (graph/storage): the (I, D) neighbour arrays with float16
+# distances, and the CSR graph with uint16 indices and float16 or uint8 (quantised) weights. Accuracy is measured against the
+# float32 graph: max relative error of the distances / edge weights, class agreement of the spread labels and max relative error
+# of the spread graph distances. The resident footprint of a complete KNNIndex (neighbour arrays, search index and CSR graph, as held
+# after the graph is built) is compared with the float32 baseline, in bytes per neighbour.
+# Usage: python -m hyperclass.exe.dev.graph_memory <project> <image> [block_size] [nseeds] [distance_scale]
+
+def relative_error( values: np.ndarray, reference: np.ndarray ) -> float:
+    if reference.size == 0: return 0.0
+    return float( ( np.abs( values - reference ) / np.maximum( np.abs( reference ), np.finfo( np.float32 ).tiny ) ).max() )
+
+def resident_bytes( value, seen: set = None, depth: int = 0 ) -> int:
+    # Bytes of the in-memory numpy arrays reachable from value (through attributes, slots and containers), each buffer counted once.
+    # Memory mapped arrays are backed by the page cache rather than the process heap, and are not counted.
+    seen = set() if seen is None else seen
+    if ( depth > 6 ) or ( id( value ) in seen ) or isinstance( value, ( xa.DataArray, str, bytes ) ): return 0
+    if isinstance( value, np.ndarray ):
+        root = value
+        while isinstance( root.base, np.ndarray ): root = root.base
+        if isinstance( root, np.memmap ) or isinstance( root.base, mmap.mmap ) or ( id( root ) in seen ): return 0
+        seen.update( [ id( value ), id( root ) ] )
+        return root.nbytes
+    seen.add( id( value ) )
+    if isinstance( value, dict ): items = list( value.values() )
+    elif isinstance( value, ( list, tuple ) ): items = list( value )
+    else: items = list( getattr( value, '__dict__', {} ).values() ) + [ getattr( value, slot, None ) for slot in getattr( type( value ), '__slots__', () ) ]
+    return sum( [ resident_bytes( item, seen, depth+1 ) for item in items ] )
+
+def data_buffer( point_data: xa.DataArray ) -> int:
+    # The point data belongs to the block, so search backends that reference it rather than copying it are not charged for it.
+    root = point_data.values
+    while isinstance( root.base, np.ndarray ): root = root.base
+    return id( root )
+
+def index_footprint( point_data: xa.DataArray, storage: str ) -> KNNIndex:
+    dataManager.config.setValue( 'graph/storage', storage )
+    index = KNNIndex( point_data, KNNIndex.graphParams( point_data ) )
+    index.build()
+    index.graph
+    return index
+
+def spread( graph: CSRGraph, C: np.ndarray, sources: np.ndarray ):
+    C1, P1 = C.copy(), np.where( C > 0, 0.0, np.inf ).astype( np.float32 )
+    S1 = np.where( C > 0, np.arange( C.size ), -1 ).astype( np.int32 )
+    t0 = time.time()
+    propagate_labels( *graph.kernel_args, C1, P1, S1, sources, -1 )
+    return C1, P1, time.time() - t0
+
+if __name__ == '__main__':
+    project, image = sys.argv[1], sys.argv[2]
+    block_size = int(sys.argv[3]) if len(sys.argv) > 3 else 250
+    nseeds = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+    distance_scale = float(sys.argv[5]) if len(sys.argv) > 5 else 1.0      # e.g. 1e3 to check distances beyond the float16 range
+    dataManager.initProject( project, {} )
+    dataManager.useSnapshot( dataManager.snapshot() )     # Benchmark settings are not written back to the project
+    dataManager.spatial.setImageName( image )
+    dataManager.config.setValue( 'block/indices', [0, 0] )
+    dataManager.config.setValue( 'block/size', block_size )
+    point_data = Tile().getBlock( 0, 0 ).getPointData()
+    X = np.ascontiguousarray( point_data.values, dtype=np.float32 )
+    params = KNNIndex.nnParams( *X.shape )
+    I, D = build_knn( X, params['method'], params['n_neighbors'], n_trees=params['n_trees'], n_iters=params['n_iters'] ).neighbor_graph
+    I, D = np.asarray( I, dtype=np.int32 ), np.asarray( D, dtype=np.float32 ) * distance_scale
+    D16 = KNNIndex.compactDistances( D )
+    print( f"\nBlock {block_size}x{block_size}: {X.shape[0]} points, {I.shape[1]} neighbors ({params['method']})" )
+    print( f"   I, D (float32): {(I.nbytes+D.nbytes)/2**20:.2f} MB -> D ({D16.dtype}): {(I.nbytes+D16.nbytes)/2**20:.2f} MB, max relative distance error = {relative_error( D16.astype( np.float32 ), D ):.2e}" )
+
+    rng = np.random.default_rng( 0 )
+    C = np.zeros( X.shape[0], dtype=np.int32 )
+    seeds = rng.choice( X.shape[0], min( nseeds, X.shape[0] ), replace=False )
+    C[seeds] = rng.integers( 1, 5, seeds.size )
+    sources = np.nonzero( C > 0 )[0].astype( np.int32 )
+    graph = CSRGraph.fromKNN( I, D, symmetric=True )
+    for compile_graph in [ graph ] + [ graph.compact( storage ) for storage in [ "float32", "float16", "uint8" ] ]:
+        spread( compile_graph, C, sources )
+    C0, P0, dt0 = spread( graph, C, sources )
+    reached = np.isfinite( P0 )
+    for storage in [ "float32", "float16", "uint8" ]:
+        compact_graph = graph.compact( storage )
+        C1, P1, dt = spread( compact_graph, C, sources )
+        print( f"   CSR {storage:>7}: {compact_graph.nbytes/2**20:.2f} MB ({compact_graph.nbytes/graph.nbytes:.0%}), {compact_graph.indices.dtype} indices, max relative weight error = {relative_error( compact_graph.float_weights, graph.weights ):.2e}, "
+               f"spread {dt:.3f} sec (float32 {dt0:.3f} sec), class agreement = {np.mean( C1 == C0 ):.4f}, max relative distance error = {relative_error( P1[reached], P0[reached] ):.2e}" )
+
+    cache_dir = tempfile.mkdtemp()
+    dataManager.config.setValue( 'data/cache', cache_dir )
+    dataManager.config.setValue( 'graph/cache', "graph" )
+    baseline = None
+    for storage in [ "float32", "float16", "uint8" ]:
+        index = index_footprint( point_data, storage )
+        nbytes = resident_bytes( index, { data_buffer( point_data ) } )
+        baseline = nbytes if baseline is None else baseline
+        print( f"   KNNIndex {storage:>7}: {nbytes/2**20:.2f} MB resident ({nbytes/baseline:.0%} of float32), {nbytes/index.I.size:.1f} bytes per neighbour, "
+               f"CSR graph {index.graph.nbytes/2**20:.2f} MB, I {index.I.dtype} / D {index.D.dtype}{' memory mapped' if isinstance( index.I, np.memmap ) else ''}" )
+        NNGraphCache( cache_dir, point_data.attrs['dsid'] ).invalidate()
+    shutil.rmtree( cache_dir, ignore_errors=True )
@@ -0,0 +1,68 @@
+import argparse, ast, importlib.util, os, subprocess, sys
+from collections import OrderedDict
+from typing import List, Tuple, Dict
+
+# Measures the import time of each hyperclass entry point with 'python -X importtime' in a fresh interpreter,
+# and lists the heaviest third-party packages pulled in, so that startup regressions are caught.
+# Usage: python -m hyperclass.exe.dev.import_time [-n NREPEATS] [-t TOP] [--max SECONDS] [modules ...]
+# Exits with status 1 if any entry point takes longer than --max seconds.
+# Launcher scripts start their application at module level, so only their import statements are timed.
+
+ENTRY_POINTS = [ "hyperclass.gui.spatial.application", "hyperclass.gui.unstructured.application", "hyperclass.learn.batch", "hyperclass.exe.hyperclass.batch",
+                 "hyperclass.exe.hyperclass.IndianaPines", "hyperclass.exe.tessclass.configure" ]
+SCRIPT_ENTRY_POINTS = [ "hyperclass.exe.hyperclass.IndianaPines", "hyperclass.exe.tessclass.configure" ]
+HEAVY_PACKAGES = [ "keras", "tensorflow", "jax", "torch", "vtk", "umap", "pynndescent", "numba", "sklearn" ]
+
+def script_imports( module: str ) -> str:
+    path = importlib.util.find_spec( module ).origin
+    with open( path ) as source:
+        text = source.read()
+    statements = [ ast.get_source_segment( text, node ) for node in ast.parse( text, path ).body if isinstance( node, ( ast.Import, ast.ImportFrom ) ) ]
+    return "\n".join( statements )
+
+def import_times( module: str ) -> Tuple[float,Dict[str,float]]:
+    env = dict( os.environ, QT_QPA_PLATFORM=os.environ.get( "QT_QPA_PLATFORM", "offscreen" ) )
+    imports = script_imports( module ) if module in SCRIPT_ENTRY_POINTS else f"import {module}"
+    code = f"import time\nt0 = time.perf_counter()\n{imports}\nprint( time.perf_counter() - t0 )"
+    proc = subprocess.run( [ sys.executable, "-X", "importtime", "-c", code ], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True )
+    if proc.returncode != 0:
+        raise RuntimeError( f"Import of {module} failed:\n{proc.stderr[-2000:]}" )
+    cumulative: Dict[str,float] = OrderedDict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith( "import time:" ) or "[us]" in line: continue
+        fields = line[len("import time:"):].split( "|" )
+        cumulative[ fields[2].strip() ] = int( fields[1] ) * 1e-6
+    total = float( proc.stdout.split()[-1] ) if module in SCRIPT_ENTRY_POINTS else cumulative[ module ]
+    return total, cumulative
+
+def heavy_packages( cumulative: Dict[str,float] ) -> List[str]:
+    return [ package for package in HEAVY_PACKAGES if package in cumulative ]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description="Report the import time of hyperclass entry points" )
+    parser.add_argument( "modules", nargs="*", default=ENTRY_POINTS, help="modules to import (default: all entry points)" )
+    parser.add_argument( "-n", "--nrepeats", type=int, default=3, help="number of runs per module; the fastest is reported" )
+    parser.add_argument( "-t", "--top", type=int, default=10, help="number of slowest top-level packages to list" )
+    parser.add_argument( "--max", type=float, default=None, help="fail if any entry point takes longer than this many seconds" )
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.modules:
+        try:
+            runs = [ import_times( module ) for i in range( args.nrepeats ) ]
+        except RuntimeError as err:
+            print( f"\n{err}" )
+            failed.append( module )
+            continue
+        total, cumulative = min( runs, key=lambda run: run[0] )
+        print( f"\n{module}: {total:.3f} sec" )
+        toplevel = [ ( name, dt ) for name, dt in cumulative.items() if ( "." not in name ) and ( name != module ) ]
+        for name, dt in sorted( toplevel, key=lambda item: -item[1] )[:args.top]:
+            print( f"   {name:>24}: {dt:.3f} sec" )
+        heavy = heavy_packages( cumulative )
+        if len( heavy ): print( f"   Heavy backends loaded at import: {', '.join( heavy )}" )
+        if ( args.max is not None ) and ( total > args.max ): failed.append( module )
+
+    if len( failed ):
+        print( f"\nImport failed or too slow for: {', '.join( failed )}" )
+        sys.exit( 1 )
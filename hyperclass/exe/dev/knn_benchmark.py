@@ -0,0 +1,33 @@
+from hyperclass.data.manager import dataManager
+from hyperclass.data.spatial.tile import Tile
+from hyperclass.graph.index import KNNIndex
+from hyperclass.graph.knn import build_knn, knn_recall, select_method, exact_search_time
+import numpy as np
+import sys, time
+
+# Builds the kNN graph of one block with each backend (exact matmul, sklearn tree, NNDescent) and reports
+# build time and recall against exact neighbours, along with the backend the 'auto' setting would select.
+# Usage: python -m hyperclass.exe.dev.knn_benchmark <project> <image> [block_size] [nsamples]
+
+if __name__ == '__main__':
+    project, image = sys.argv[1], sys.argv[2]
+    block_size = int(sys.argv[3]) if len(sys.argv) > 3 else 250
+    nsamples = int(sys.argv[4]) if len(sys.argv) > 4 else 256
+    dataManager.initProject( project, {} )
+    dataManager.useSnapshot( dataManager.snapshot() )     # Benchmark settings are not written back to the project
+    dataManager.spatial.setImageName( image )
+    dataManager.config.setValue( 'block/indices', [0, 0] )
+    dataManager.config.setValue( 'block/size', block_size )
+    point_data = Tile().getBlock( 0, 0 ).getPointData()
+    X = np.ascontiguousarray( point_data.values, dtype=np.float32 )
+    budget = dataManager.config.value( "graph/knn_budget", 2.0, type=float )
+    params = KNNIndex.nnParams( *X.shape, method="nndescent" )
+
+    print( f"\nBlock {block_size}x{block_size}: {X.shape[0]} points x {X.shape[1]} features, {params['n_neighbors']} neighbors" )
+    print( f"   predicted exact search time = {exact_search_time( *X.shape ):.2f} sec, auto (budget {budget} sec) selects '{select_method( *X.shape, budget )}'" )
+    for method in [ "exact", "tree", "nndescent" ]:
+        t0 = time.time()
+        knn = build_knn( X, method, params['n_neighbors'], n_trees=params['n_trees'], n_iters=params['n_iters'] )
+        I, D = knn.neighbor_graph
+        t1 = time.time()
+        print( f"   {method:>10}: {t1-t0:.3f} sec, recall = {knn_recall( X, np.asarray( I ), nsamples ):.4f}" )
@@ -0,0 +1,74 @@
+from hyperclass.data.manager import dataManager
+from hyperclass.data.spatial.tile import Tile
+from hyperclass.graph.flow import ActivationFlow, iterate_spread_labels, propagate_labels, propagate_labels_parallel
+import numpy as np
+import numba, sys, time
+
+# Compares the sweep-based label spreading (iterate_spread_labels, run to convergence) with the single-pass
+# multi-source Dijkstra propagation (propagate_labels) and the multi-threaded relaxation (propagate_labels_parallel,
+# with all numba threads) on a 250x250 block and on a full tile of an image.
+# Usage: python -m hyperclass.exe.dev.spread_benchmark <project> <image> [nseeds] [max_sweeps]
+
+def sweep_spread( flow: ActivationFlow, C: np.ndarray, P: np.ndarray, max_sweeps: int ) -> int:
+    label_count = np.count_nonzero( C )
+    for iteration in range( max_sweeps ):
+        iterate_spread_labels( flow.I.astype( np.int64 ), np.array( flow.D, dtype=np.float32 ), C, P )
+        new_label_count = np.count_nonzero( C )
+        if new_label_count == label_count: return iteration + 1
+        label_count = new_label_count
+    return max_sweeps
+
+def benchmark( label: str, block_size: int, nseeds: int, max_sweeps: int ):
+    dataManager.config.setValue( 'block/size', block_size )
+    block = Tile().getBlock( 0, 0 )
+    point_data = block.getPointData()
+    npoints = point_data.shape[0]
+    t0 = time.time()
+    flow = ActivationFlow( point_data )
+    t1 = time.time()
+    graph = flow.graph
+    t2 = time.time()
+    rng = np.random.default_rng( 0 )
+    C = np.zeros( npoints, dtype=np.int32 )
+    seeds = rng.choice( npoints, min( nseeds, npoints ), replace=False )
+    C[seeds] = rng.integers( 1, 5, seeds.size )
+    P = np.where( C > 0, 0.0, np.inf ).astype( np.float32 )
+    S = np.where( C > 0, np.arange( npoints ), -1 ).astype( np.int32 )
+    sources = np.nonzero( C > 0 )[0].astype( np.int32 )
+
+    C0, P0 = C.copy(), P.copy()
+    propagate_labels( *graph.kernel_args, C0, P0, S.copy(), sources, -1 )       # compile
+    C0, P0 = C.copy(), P.copy()
+    sweep_spread( flow, C0, P0, 1 )                   # compile
+    C0, P0 = C.copy(), P.copy()
+    propagate_labels_parallel( *graph.kernel_args, C0, P0, S.copy(), sources, 1 )   # compile
+
+    C1, P1 = C.copy(), P.copy()
+    t3 = time.time()
+    nsweeps = sweep_spread( flow, C1, P1, max_sweeps )
+    t4 = time.time()
+    C2, P2 = C.copy(), P.copy()
+    propagate_labels( *graph.kernel_args, C2, P2, S.copy(), sources, -1 )
+    t5 = time.time()
+    C3, P3 = C.copy(), P.copy()
+    propagate_labels_parallel( *graph.kernel_args, C3, P3, S.copy(), sources, -1 )
+    t6 = time.time()
+    reached = np.isfinite( P2 )
+    print( f"\n{label}: {npoints} points, {graph.nedges} directed edges ({graph.nbytes/2**20:.1f} MB), NN graph {t1-t0:.2f} sec, CSR graph {t2-t1:.3f} sec" )
+    print( f"   sweeps:   {t4-t3:.3f} sec ({nsweeps} iterations), labelled {np.count_nonzero(C1)}" )
+    print( f"   dijkstra: {t5-t4:.3f} sec, labelled {np.count_nonzero(C2)}, speedup = {(t4-t3)/max(t5-t4,1e-9):.1f}" )
+    print( f"   parallel: {t6-t5:.3f} sec ({numba.get_num_threads()} threads), max distance difference = {np.max( np.abs( P3[reached] - P2[reached] ) ):.2e}" )
+    print( f"   class agreement = {np.mean( C1[reached] == C2[reached] ):.4f}, distance ratio (sweep/dijkstra) = {np.mean( P1[reached] ) / max( np.mean( P2[reached] ), 1e-12 ):.4f}" )
+
+if __name__ == '__main__':
+    project, image = sys.argv[1], sys.argv[2]
+    nseeds = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    max_sweeps = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+    dataManager.initProject( project, {} )
+    dataManager.useSnapshot( dataManager.snapshot() )     # Benchmark settings are not written back to the project
+    dataManager.spatial.setImageName( image )
+    dataManager.config.setValue( 'block/indices', [0, 0] )
+    tile_size = dataManager.config.value( 'tile/size', 1000, type=int )
+
+    benchmark( "Block 250x250", 250, nseeds, max_sweeps )
+    benchmark( f"Tile {tile_size}x{tile_size}", tile_size, nseeds, max_sweeps )
@@ -0,0 +1,22 @@
+from hyperclass.data.manager import dataManager
+from hyperclass.learn.batch import BatchClassifier
+import hyperclass.learn
+import argparse, sys
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description="Classify every block of an image without the GUI, using saved labels or a saved model" )
+    parser.add_argument( "image", help="image file name (relative to data/dir)" )
+    parser.add_argument( "output_dir", help="directory for per-block checkpoints and per-tile label GeoTIFFs" )
+    parser.add_argument( "-m", "--mode", choices=[ "model", "spread", "tilespread" ], default="model", help="apply the saved learning model, or spread the saved labels over the NN graph of each block (spread) or of each whole tile (tilespread)" )
+    parser.add_argument( "-M", "--model", default="svc", help="learning model id (mode=model)" )
+    parser.add_argument( "-n", "--niters", type=int, default=100, help="label spreading iterations (mode=spread, tilespread)" )
+    parser.add_argument( "-j", "--nproc", type=int, default=1, help="number of worker processes for the blocks of each tile" )
+    parser.add_argument( "-r", "--refresh", action="store_true", help="discard existing checkpoints" )
+    parser.add_argument( "-p", "--project", default="hyperclass", help="settings project name" )
+    args = parser.parse_args()
+
+    dataManager.initProject( args.project, {} )
+    dataManager.spatial.setImageName( args.image )
+    dataManager.config.setValue( "dev/model", args.model )
+    classifier = BatchClassifier( args.output_dir, mode=args.mode, niters=args.niters, nproc=args.nproc, refresh=args.refresh )
+    sys.exit( 0 if classifier.run() else 1 )
@@ -0,0 +1,39 @@
+from hyperclass.data.manager import dataManager
+import argparse, sys
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description="Label every pixel of an image from its nearest neighbours in one labelled block, streaming the image window by window" )
+    parser.add_argument( "image", help="image file name (relative to data/dir)" )
+    parser.add_argument( "output_dir", help="directory for the chunked output stores" )
+    parser.add_argument( "-t", "--tile", type=int, nargs=2, default=[0, 0], help="tile indices of the labelled block" )
+    parser.add_argument( "-b", "--block", type=int, nargs=2, default=[0, 0], help="block indices of the labelled block" )
+    parser.add_argument( "-n", "--niters", type=int, default=100, help="label spreading iterations within the labelled block" )
+    parser.add_argument( "-k", "--nneighbors", type=int, default=None, help="neighbours per query (default: umap/nneighbors)" )
+    parser.add_argument( "-w", "--window", type=int, default=None, help="window size in pixels (default: query/window_size, or the block size)" )
+    parser.add_argument( "-j", "--nthreads", type=int, default=1, help="query threads" )
+    parser.add_argument( "--neighbors", action="store_true", help="also write the neighbour indices and distances" )
+    parser.add_argument( "-p", "--project", default="hyperclass", help="settings project name" )
+    args = parser.parse_args()
+
+    dataManager.initProject( args.project, {} )
+    dataManager.spatial.setImageName( args.image )
+    dataManager.config.setValue( 'tile/indices', list( args.tile ) )
+    from hyperclass.data.spatial.tile import Tile
+    from hyperclass.graph.index import knnIndexRegistry
+    from hyperclass.graph.query import ImageQuery
+    from hyperclass.learn.batch import BatchClassifier
+
+    spreader = BatchClassifier( args.output_dir, mode="spread", niters=args.niters )
+    if not spreader.prepare(): sys.exit( 1 )
+    block = Tile().getBlock( *args.block )
+    point_data = block.getPointData()
+    labels = spreader.classify( block, point_data )
+    if labels is None:
+        print( f"No labels found in block {args.block} of tile {args.tile}" )
+        sys.exit( 1 )
+    index = knnIndexRegistry.getIndex( point_data )
+    options = dict( nthreads=args.nthreads, outputs=[ 'labels', 'neighbors' ] if args.neighbors else [ 'labels' ] )
+    if args.nneighbors is not None: options['k'] = args.nneighbors
+    if args.window is not None: options['window_size'] = args.window
+    outputs = ImageQuery( index, labels, **options ).run( args.output_dir )
+    sys.exit( 0 if outputs is not None else 1 )
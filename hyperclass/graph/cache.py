@@ -0,0 +1,91 @@
+import numpy as np
+import xarray as xa
+from typing import List, Union, Tuple, Optional, Dict
+from hyperclass.graph.csr import CSRGraph
+from hyperclass.data.files import atomic_write, save_array, save_json
+import os, json, hashlib, pickle, shutil
+
+def fingerprint( point_data: xa.DataArray, nrows: int = 1024 ) -> str:
+    # Cheap content hash: shape, dtype and an evenly strided sample of rows and sample coordinates.
+    values = point_data.values
+    rows = np.linspace( 0, values.shape[0]-1, min( nrows, values.shape[0] ) ).astype( np.int64 ) if values.shape[0] else np.zeros( [0], dtype=np.int64 )
+    digest = hashlib.blake2b( digest_size=16 )
+    digest.update( f"{values.shape}:{values.dtype}".encode() )
+    digest.update( np.ascontiguousarray( values[rows] ).tobytes() )
+    samples = point_data.coords[ point_data.dims[0] ].values[rows]
+    digest.update( str( samples.tolist() ).encode() if samples.dtype.kind == 'O' else np.ascontiguousarray( samples ).tobytes() )
+    return digest.hexdigest()
+
+class NNGraphCache:
+    # Directory of .npy files holding the kNN graph (I, D) of one dataset and its symmetric CSR graphs (one per spatial edge setting), plus the pickled NNDescent index when requested.
+    # The header, written last, records the parameters the graph was built with (and the backend chosen for method 'auto'); an entry whose parameters differ is deleted on load.
+
+    HEADER = "header.json"
+
+    def __init__( self, cache_dir: str, dsid: str ):
+        self.path = os.path.join( cache_dir, "graphs", dsid + ".nngraph" )
+
+    @classmethod
+    def key( cls, params: Dict ) -> str:
+        return hashlib.blake2b( json.dumps( params, sort_keys=True ).encode(), digest_size=16 ).hexdigest()
+
+    @property
+    def header(self) -> Optional[Dict]:
+        header_file = os.path.join( self.path, self.HEADER )
+        if not os.path.isfile( header_file ): return None
+        with open( header_file ) as f:
+            return json.load( f )
+
+    def write( self, params: Dict, I: np.ndarray, D: np.ndarray, index = None, method: str = None ) -> str:
+        os.makedirs( self.path, exist_ok=True )
+        for filename in [ self.HEADER, "index.pkl" ]:
+            if os.path.isfile( os.path.join( self.path, filename ) ): os.remove( os.path.join( self.path, filename ) )
+        for name in os.listdir( self.path ):
+            if name.startswith( "csr" ): CSRGraph.remove( self.csr_path( name ) )
+        save_array( os.path.join( self.path, "I.npy" ), I )
+        save_array( os.path.join( self.path, "D.npy" ), D )
+        if index is not None:
+            with atomic_write( os.path.join( self.path, "index.pkl" ) ) as tmp_file:
+                with open( tmp_file, 'wb' ) as f: pickle.dump( index, f )
+        header = dict( key=self.key( params ), params=params, shape=list( I.shape ), index=index is not None, method=method )
+        save_json( os.path.join( self.path, self.HEADER ), header )
+        print( f"Writing NN graph cache {self.path}: shape = {I.shape}, index = {index is not None}" )
+        return self.path
+
+    @property
+    def method(self) -> Optional[str]:
+        # The kNN backend the graph was built with (the choice made for method 'auto').
+        header = self.header
+        return None if header is None else header.get( 'method' )
+
+    def read( self, params: Dict ) -> Optional[Tuple[np.ndarray,np.ndarray]]:
+        header = self.header
+        if header is None: return None
+        if header['key'] != self.key( params ):
+            print( f"NN graph cache {self.path} is stale, parameters changed: {header['params']} -> {params}" )
+            self.invalidate()
+            return None
+        I = np.load( os.path.join( self.path, "I.npy" ), mmap_mode='r' )
+        D = np.load( os.path.join( self.path, "D.npy" ), mmap_mode='r' )
+        return I, D
+
+    def csr_path(self, name: str = "csr" ) -> str:
+        return os.path.join( self.path, name )
+
+    def writeGraph( self, graph: CSRGraph, name: str = "csr" ) -> Optional[str]:
+        # Only stored alongside a complete (I, D) entry, which it is derived from.
+        if self.header is None: return None
+        return graph.save( self.csr_path( name ) )
+
+    def readGraph( self, name: str = "csr" ) -> Optional[CSRGraph]:
+        if self.header is None: return None
+        return CSRGraph.load( self.csr_path( name ), mmap=True )
+
+    def readIndex( self ):
+        index_file = os.path.join( self.path, "index.pkl" )
+        if not os.path.isfile( index_file ): return None
+        with open( index_file, 'rb' ) as f:
+            return pickle.load( f )
+
+    def invalidate( self ):
+        if os.path.isdir( self.path ): shutil.rmtree( self.path, ignore_errors=True )
@@ -0,0 +1,207 @@
+import numpy as np
+import numba
+from numba import types
+from numba.extending import overload
+from typing import List, Union, Tuple, Optional, Dict
+from hyperclass.data.files import save_array, save_json
+import os, json, shutil
+
+@numba.njit(inline="always")
+def half_to_float( h ) -> np.float32:
+    # Decodes a float16 bit pattern (numba has no CPU float16 type).
+    bits = np.int32( h )
+    exponent = ( bits >> 10 ) & 0x1f
+    mantissa = bits & 0x3ff
+    if exponent == 0:       value = mantissa * 5.960464477539063e-08
+    elif exponent == 31:    value = np.inf if mantissa == 0 else np.nan
+    else:                   value = ( 1024 + mantissa ) * 2.0 ** ( exponent - 25 )
+    return np.float32( -value if ( bits & 0x8000 ) else value )
+
+def edge_weight( weights: np.ndarray, j: int, scale: float ) -> np.float32:
+    # Weight of edge j as seen by the graph kernels: float32 weights are used as stored, uint16 weights hold float16 bit patterns
+    # and uint8 weights are quantised, both in units of scale.
+    if weights.dtype == np.uint16: return np.float32( weights[j:j+1].view( np.float16 )[0] * scale )
+    if weights.dtype == np.uint8:  return np.float32( weights[j] * scale )
+    return np.float32( weights[j] )
+
+@overload( edge_weight, inline="always" )
+def _edge_weight( weights, j, scale ):
+    if weights.dtype == types.uint16: return lambda weights, j, scale: np.float32( half_to_float( weights[j] ) * scale )
+    if weights.dtype == types.uint8:  return lambda weights, j, scale: np.float32( weights[j] * scale )
+    return lambda weights, j, scale: np.float32( weights[j] )
+
+@numba.njit
+def merge_rows( n: int, indptr: np.ndarray, indices: np.ndarray, values: np.ndarray, keep_max: bool ) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    # Sorts the column indices within each row and merges duplicate (i,j) entries into one, keeping the smallest weight
+    # (or the largest, with keep_max), so that consumers which sum duplicates (e.g. scipy.sparse) see each edge once.
+    out_indptr = np.zeros( n + 1, dtype=np.int64 )
+    nnz = 0
+    for i in range( n ):
+        start, end = indptr[i], indptr[i+1]
+        order = np.argsort( indices[start:end], kind='mergesort' )
+        row_indices, row_values = indices[start:end][order], values[start:end][order]
+        for iE in range( row_indices.size ):
+            if ( nnz > out_indptr[i] ) and ( indices[nnz-1] == row_indices[iE] ):
+                values[nnz-1] = max( values[nnz-1], row_values[iE] ) if keep_max else min( values[nnz-1], row_values[iE] )
+            else:
+                indices[nnz], values[nnz] = row_indices[iE], row_values[iE]
+                nnz += 1
+        out_indptr[i+1] = nnz
+    return out_indptr, indices[:nnz].copy(), values[:nnz].copy()
+
+@numba.njit
+def knn_to_csr( I: np.ndarray, D: np.ndarray, symmetric: bool, keep_max: bool = False ) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    # CSR arrays ( indptr, indices, weights ) of the kNN edges i -> I[i,k], skipping self loops and missing (-1) neighbours.
+    # A symmetric graph also stores every edge in the reverse direction; an edge found from both ends (or listed twice) is stored once (see merge_rows).
+    n, k = I.shape
+    degree = np.zeros( n + 1, dtype=np.int64 )
+    for i in range( n ):
+        for iN in range( k ):
+            j = I[i,iN]
+            if ( j >= 0 ) and ( j != i ):
+                degree[i+1] += 1
+                if symmetric: degree[j+1] += 1
+    indptr = np.cumsum( degree )
+    fill = indptr[:-1].copy()
+    indices = np.empty( indptr[-1], dtype=np.int32 )
+    weights = np.empty( indptr[-1], dtype=np.float32 )
+    for i in range( n ):
+        for iN in range( k ):
+            j = I[i,iN]
+            if ( j >= 0 ) and ( j != i ):
+                indices[fill[i]] = j;  weights[fill[i]] = D[i,iN];  fill[i] += 1
+                if symmetric:
+                    indices[fill[j]] = i;  weights[fill[j]] = D[i,iN];  fill[j] += 1
+    return merge_rows( n, indptr, indices, weights, keep_max )
+
+@numba.njit
+def edges_to_csr( n: int, rows: np.ndarray, cols: np.ndarray, weights: np.ndarray, symmetric: bool ) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    # CSR arrays of an edge list (optionally stored in both directions), with duplicate edges merged into the one of smallest weight
+    # (see merge_rows). Self loops and missing (-1) endpoints are dropped.
+    degree = np.zeros( n + 1, dtype=np.int64 )
+    for e in range( rows.size ):
+        i, j = rows[e], cols[e]
+        if ( i >= 0 ) and ( j >= 0 ) and ( i != j ):
+            degree[i+1] += 1
+            if symmetric: degree[j+1] += 1
+    indptr = np.cumsum( degree )
+    fill = indptr[:-1].copy()
+    indices = np.empty( indptr[-1], dtype=np.int32 )
+    values = np.empty( indptr[-1], dtype=np.float32 )
+    for e in range( rows.size ):
+        i, j = rows[e], cols[e]
+        if ( i >= 0 ) and ( j >= 0 ) and ( i != j ):
+            indices[fill[i]] = j;  values[fill[i]] = weights[e];  fill[i] += 1
+            if symmetric:
+                indices[fill[j]] = i;  values[fill[j]] = weights[e];  fill[j] += 1
+    return merge_rows( n, indptr, indices, values, False )
+
+class CSRGraph:
+    # Weighted adjacency in CSR form: int32 indptr (int64 only beyond 2**31 edges) and indices, float32 weights.
+    # Shared by label spreading, UMAP's fuzzy simplicial set and the graph caches; save/load use one .npy file per array so a loaded graph can be memory mapped.
+    # A compact graph (see compact) has uint16 indices when it has at most 2**16 nodes, and float16 or uint8 (quantised) weights, in units of scale.
+
+    __slots__ = ( 'indptr', 'indices', 'weights', 'scale' )
+    ARRAYS = ( 'indptr', 'indices', 'weights' )
+    HEADER = "header.json"
+
+    def __init__( self, indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray, scale: float = 1.0 ):
+        index_type = np.int32 if indptr[-1] < np.iinfo( np.int32 ).max else np.int64
+        self.indptr: np.ndarray = np.asarray( indptr, dtype=index_type )
+        self.indices: np.ndarray = np.asarray( indices, dtype=np.uint16 if indices.dtype == np.uint16 else np.int32 )
+        self.weights: np.ndarray = np.asarray( weights, dtype=weights.dtype if weights.dtype in [ np.float16, np.uint8 ] else np.float32 )
+        self.scale: float = float( scale )
+
+    @classmethod
+    def fromKNN( cls, I: np.ndarray, D: np.ndarray, symmetric: bool = True, keep_max: bool = False ) -> "CSRGraph":
+        # Duplicate edges keep the smallest weight (the shortest distance); pass keep_max for similarity weights (e.g. UMAP memberships).
+        return CSRGraph( *knn_to_csr( np.ascontiguousarray( I ), np.ascontiguousarray( D, dtype=np.float32 ), symmetric, keep_max ) )
+
+    @classmethod
+    def fromEdges( cls, n: int, rows: np.ndarray, cols: np.ndarray, weights: np.ndarray, symmetric: bool = True ) -> "CSRGraph":
+        return CSRGraph( *edges_to_csr( n, np.ascontiguousarray( rows, dtype=np.int64 ), np.ascontiguousarray( cols, dtype=np.int64 ), np.ascontiguousarray( weights, dtype=np.float32 ), symmetric ) )
+
+    @classmethod
+    def fromScipy( cls, matrix ) -> "CSRGraph":
+        matrix = matrix.tocsr()
+        return CSRGraph( matrix.indptr, matrix.indices, matrix.data )
+
+    def compact( self, weights: str = "float16" ) -> "CSRGraph":
+        # Weights are stored in units of a per-graph (per-block) scale: a power of two bringing the largest weight into [1,2) for float16,
+        # so that distances of any magnitude stay within float16 range, and max weight / 255 for uint8, quantised over [0, max weight].
+        indices = self.indices.astype( np.uint16 ) if self.nnodes <= 2**16 else self.indices
+        values = self.float_weights
+        max_weight = float( values.max() ) if values.size > 0 else 0.0
+        if weights == "float16":
+            scale = 2.0 ** np.floor( np.log2( max_weight ) ) if max_weight > 0 else 1.0
+            return CSRGraph( self.indptr, indices, ( values / np.float32( scale ) ).astype( np.float16 ), scale )
+        if weights == "uint8":
+            scale = max_weight / 255.0 if max_weight > 0 else 1.0
+            return CSRGraph( self.indptr, indices, np.clip( np.rint( values / scale ), 0, 255 ).astype( np.uint8 ), scale )
+        return CSRGraph( self.indptr, indices, values )
+
+    @property
+    def float_weights(self) -> np.ndarray:
+        if self.weights.dtype in [ np.uint8, np.float16 ]: return self.weights.astype( np.float32 ) * np.float32( self.scale )
+        return self.weights.astype( np.float32, copy=False )
+
+    def toScipy( self ):
+        # Shares the arrays with the returned matrix (a compact graph's weights are decoded first). The graph builders merge duplicate
+        # edges, so the matrix has canonical format and scipy operations that sum duplicates see each edge's weight once.
+        import scipy.sparse
+        return scipy.sparse.csr_matrix( ( self.float_weights, self.indices, self.indptr ), shape=( self.nnodes, self.nnodes ), copy=False )
+
+    @property
+    def arrays(self) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+        return self.indptr, self.indices, self.weights
+
+    @property
+    def kernel_args(self) -> Tuple[np.ndarray,np.ndarray,np.ndarray,np.float32]:
+        # ( indptr, indices, weights, scale ) as taken by the spreading kernels, which decode each weight with edge_weight.
+        weights = self.weights.view( np.uint16 ) if self.weights.dtype == np.float16 else self.weights
+        return self.indptr, self.indices, weights, np.float32( self.scale )
+
+    @property
+    def nnodes(self) -> int:
+        return self.indptr.size - 1
+
+    @property
+    def nedges(self) -> int:
+        return self.indices.size
+
+    @property
+    def nbytes(self) -> int:
+        return sum( [ array.nbytes for array in self.arrays ] )
+
+    def degree(self) -> np.ndarray:
+        return np.diff( self.indptr )
+
+    def neighbors( self, node: int ) -> Tuple[np.ndarray,np.ndarray]:
+        start, end = self.indptr[node], self.indptr[node+1]
+        return self.indices[start:end], self.weights[start:end]
+
+    def save( self, path: str ) -> str:
+        # The arrays are renamed into place and the header is written last, so a reader never sees a partial graph.
+        os.makedirs( path, exist_ok=True )
+        header_file = os.path.join( path, self.HEADER )
+        if os.path.isfile( header_file ): os.remove( header_file )
+        for name, array in zip( self.ARRAYS, self.arrays ):
+            save_array( os.path.join( path, f"{name}.npy" ), array )
+        save_json( header_file, dict( nnodes=self.nnodes, nedges=self.nedges, scale=self.scale, merged=True ) )
+        return path
+
+    @classmethod
+    def load( cls, path: str, mmap: bool = True ) -> Optional["CSRGraph"]:
+        header_file = os.path.join( path, cls.HEADER )
+        if not os.path.isfile( header_file ): return None
+        with open( header_file ) as f: header = json.load( f )
+        if not header.get( 'merged', False ): return None        # Saved before duplicate edges were merged: rebuilt by the caller
+        arrays = [ np.load( os.path.join( path, f"{name}.npy" ), mmap_mode='r' if mmap else None ) for name in cls.ARRAYS ]
+        return CSRGraph( *arrays, scale=header.get( 'scale', 1.0 ) )
+
+    @classmethod
+    def remove( cls, path: str ):
+        if os.path.isdir( path ): shutil.rmtree( path, ignore_errors=True )
+
+    def __str__(self):
+        return f"CSRGraph: {self.nnodes} nodes, {self.nedges} edges ({self.indices.dtype} indices, {self.weights.dtype} weights), {self.nbytes/2**20:.1f} MB"
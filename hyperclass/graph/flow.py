@@ -1,28 +1,24 @@
-from pynndescent import NNDescent
 import numpy as np
-import numpy.ma as ma
 import xarray as xa
 import numba
 from typing import List, Union, Tuple, Optional, Dict
 from hyperclass.gui.events import EventClient
 from hyperclass.data.manager import dataManager
 from hyperclass.gui.tasks import taskRunner, Task
+from hyperclass.graph.index import KNNIndex, knnIndexRegistry
+from hyperclass.graph.csr import CSRGraph, edge_weight
 from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
 from PyQt5.QtWidgets import QMessageBox
 import os, time, threading, traceback
 
-@numba.njit(fastmath=True,
-    locals={
-        "selection": numba.boolean[:],
-        "indices": numba.int32[:],
-        "labels": numba .int32[:],
-        "index_stack": numba.int32[:,:],
-    },)
+@numba.njit(fastmath=True)
 def getFilteredLabels( labels: np.ndarray ) -> np.ndarray:
-    indices = np.arange(labels.shape[0], dtype = np.int32 )
-    selection = (labels > 0)
-    index_stack = np.vstack( (indices, labels) ).transpose()
-    return index_stack[ selection ]
+    selection = np.nonzero( labels > 0 )[0]
+    index_stack = np.empty( ( selection.size, 2 ), dtype=np.int32 )
+    for i in range( selection.size ):
+        index_stack[i,0] = selection[i]
+        index_stack[i,1] = labels[ selection[i] ]
+    return index_stack
 
 @numba.jit(fastmath=True,
     locals={
@@ -55,15 +51,130 @@ def iterate_spread_labels( I: np.ndarray, D: np.ndarray, C: np.ndarray, P: np.nd
                 C[pid1] = label_spec[1]
                 P[pid1] = PN
 
+@numba.njit(inline="always")
+def heap_push( heap_d: np.ndarray, heap_n: np.ndarray, size: int, d: float, node: int ) -> int:
+    i = size
+    while i > 0:
+        parent = ( i - 1 ) >> 1
+        if heap_d[parent] <= d: break
+        heap_d[i] = heap_d[parent];  heap_n[i] = heap_n[parent]
+        i = parent
+    heap_d[i] = d;  heap_n[i] = node
+    return size + 1
+
+@numba.njit(inline="always")
+def heap_pop( heap_d: np.ndarray, heap_n: np.ndarray, size: int ) -> Tuple[float,int,int]:
+    d, node = heap_d[0], heap_n[0]
+    size -= 1
+    last_d, last_n = heap_d[size], heap_n[size]
+    i = 0
+    while True:
+        child = 2*i + 1
+        if child >= size: break
+        if ( child + 1 < size ) and ( heap_d[child+1] < heap_d[child] ): child += 1
+        if heap_d[child] >= last_d: break
+        heap_d[i] = heap_d[child];  heap_n[i] = heap_n[child]
+        i = child
+    heap_d[i] = last_d;  heap_n[i] = last_n
+    return d, node, size
+
+@numba.njit
+def propagate_labels( indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray, scale: float, C: np.ndarray, P: np.ndarray, S: np.ndarray, sources: np.ndarray, max_hops: int ) -> bool:
+    # Multi-source Dijkstra from the given source nodes: every node they reach more cheaply takes their class (C), the accumulated
+    # graph distance (P) and the seed it traces back to (S). Nodes that no source improves are left untouched, so the sources
+    # can be just the new seeds of an existing labelling. Paths are cut after max_hops edges (max_hops < 0: no limit).
+    # The weights may be compact (see CSRGraph.kernel_args). Returns False if the hop limit stopped the propagation early.
+    n = C.shape[0]
+    hops = np.zeros( n, dtype=np.int32 )
+    settled = np.zeros( n, dtype=np.bool_ )
+    heap_d = np.empty( sources.size + indices.size, dtype=np.float32 )
+    heap_n = np.empty( sources.size + indices.size, dtype=np.int32 )
+    size = 0
+    for i in sources:
+        size = heap_push( heap_d, heap_n, size, P[i], i )
+    converged = True
+    while size > 0:
+        d, u, size = heap_pop( heap_d, heap_n, size )
+        if settled[u] or ( d > P[u] ): continue
+        settled[u] = True
+        for j in range( indptr[u], indptr[u+1] ):
+            v = indices[j]
+            pv = d + edge_weight( weights, j, scale )
+            if ( C[v] == 0 ) or ( pv < P[v] ):
+                if ( max_hops >= 0 ) and ( hops[u] >= max_hops ):
+                    converged = False
+                    break
+                C[v] = C[u]
+                P[v] = pv
+                S[v] = S[u]
+                hops[v] = hops[u] + 1
+                size = heap_push( heap_d, heap_n, size, pv, v )
+    return converged
+
+@numba.njit
+def boundary_nodes( indptr: np.ndarray, indices: np.ndarray, affected: np.ndarray, C: np.ndarray, P: np.ndarray ) -> np.ndarray:
+    # Labelled nodes outside the affected region that border it: the sources that refill the region after its seeds are removed.
+    boundary = np.zeros( C.shape[0], dtype=np.bool_ )
+    for v in np.nonzero( affected )[0]:
+        for j in range( indptr[v], indptr[v+1] ):
+            u = indices[j]
+            if ( not affected[u] ) and ( C[u] > 0 ) and ( P[u] < np.inf ):
+                boundary[u] = True
+    return np.nonzero( boundary )[0].astype( np.int32 )
+
+@numba.njit(parallel=True)
+def relax_labels( indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray, scale: float, C: np.ndarray, P: np.ndarray, S: np.ndarray, updated: np.ndarray,
+                  C1: np.ndarray, P1: np.ndarray, S1: np.ndarray, updated1: np.ndarray ) -> int:
+    # One synchronous relaxation step: each node pulls from the neighbours updated in the previous step, reading (C, P, S) and
+    # writing only its own entry of (C1, P1, S1), so the threads never race and the result doesn't depend on the thread count.
+    nchanged = 0
+    for v in numba.prange( C.shape[0] ):
+        cv, pv, sv = C[v], P[v], S[v]
+        for j in range( indptr[v], indptr[v+1] ):
+            u = indices[j]
+            if updated[u]:
+                pu = P[u] + edge_weight( weights, j, scale )
+                if ( cv == 0 ) or ( pu < pv ):
+                    cv, pv, sv = C[u], pu, S[u]
+        C1[v], P1[v], S1[v] = cv, pv, sv
+        changed = ( cv != C[v] ) or ( pv != P[v] )
+        updated1[v] = changed
+        if changed: nchanged += 1
+    return nchanged
+
+def propagate_labels_parallel( indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray, scale: float, C: np.ndarray, P: np.ndarray, S: np.ndarray, sources: np.ndarray, max_hops: int ) -> bool:
+    # Double-buffered Bellman-Ford version of propagate_labels for multi-threaded runs: each step extends the labels by one edge.
+    # Converges to the same P; C differs only where two sources are at exactly the same distance.
+    updated = np.zeros( C.shape, dtype=np.bool_ )
+    updated[sources] = True
+    buffers = [ ( C.copy(), P.copy(), S.copy(), updated ), ( np.empty_like( C ), np.empty_like( P ), np.empty_like( S ), np.empty( C.shape, dtype=np.bool_ ) ) ]
+    converged, step = False, 0
+    while ( max_hops < 0 ) or ( step < max_hops ):
+        nchanged = relax_labels( indptr, indices, weights, scale, *buffers[0], *buffers[1] )
+        buffers.reverse()
+        step += 1
+        if nchanged == 0:
+            converged = True
+            break
+    C[:], P[:], S[:] = buffers[0][0], buffers[0][1], buffers[0][2]
+    return converged
+
 class ActivationFlowManager:
 
     def __init__( self ):
         self.instances = {}
         self.condition = threading.Condition()
+        self._build_locks: Dict[str,threading.Lock] = {}
 
     def __getitem__( self, dsid ):
         return self.instances.get( dsid )
 
+    def remove( self, dsid: str ):
+        with self.condition:
+            self.instances.pop( dsid, None )
+            self._build_locks.pop( dsid, None )
+        knnIndexRegistry.remove( dsid )
+
     def clear(self):
         for instance in self.instances.values():
             instance.clear()
@@ -72,15 +183,15 @@ class ActivationFlowManager:
         if point_data is None: return None
         dsid = point_data.attrs['dsid']
         print( f"Get Activation flow for dsid {dsid}")
-        self.condition.acquire()
-        try:
+        with self.condition:
+            build_lock = self._build_locks.setdefault( dsid, threading.Lock() )
+        with build_lock:
             result = self.instances.get( dsid, None )
             if result is None:
                 result = self.create_flow( point_data, **kwargs )
-                self.instances[dsid] = result
-            self.condition.notifyAll()
-        finally:
-            self.condition.release()
+                with self.condition:
+                    self.instances[dsid] = result
+                    self.condition.notifyAll()
         return result
 
     def create_flow(self, point_data: xa.DataArray, **kwargs):
@@ -91,11 +202,12 @@ class ActivationFlow(QObject,EventClient):
     def __init__(self, nodes_data: xa.DataArray,  **kwargs ):
         QObject.__init__(self)
         self.nodes: xa.DataArray = None
-        self.nnd: NNDescent = None
-        self.I: np.ndarray = None
-        self.D: np.ndarray = None
+        self.index: Optional[KNNIndex] = None
         self.P: np.ndarray = None
         self.C: np.ndarray = None
+        self.S: np.ndarray = None
+        self._seeds: np.ndarray = None
+        self._converged = False
         self.reset = True
 
         background = kwargs.get( 'background', False )
@@ -109,71 +221,93 @@ class ActivationFlow(QObject,EventClient):
         self.reset = True
 
     def setGraph( self, I: np.ndarray, D: np.ndarray ):
-        self.I = I
-        self.D = ma.MaskedArray( D )
+        self.index = KNNIndex.fromGraph( I, D )
 
     def setNodeData(self, nodes_data: xa.DataArray, **kwargs ):
         if self.reset or (self.nodes is None):
             if (nodes_data.size > 0):
-                t0 = time.time()
                 self.nodes = nodes_data
-                self.nnd = self.getNNGraph( nodes_data, **kwargs )
-                self.I = self.nnd.neighbor_graph[0]
-                self.D = self.nnd.neighbor_graph[1]
-                dt = (time.time()-t0)
-                print( f"Computed NN Graph with {self.nnd.n_neighbors} neighbors and {nodes_data.shape[0]} verts in {dt} sec ({dt/60} min)")
+                self.index = knnIndexRegistry.getIndex( nodes_data, **kwargs )
             else:
                 print( "No data available for this block")
 
-    @classmethod
-    def getNNGraph(cls, nodes: xa.DataArray, **kwargs ):
-        n_neighbors = dataManager.config.value("umap/nneighbors", type=int)
-        n_trees = kwargs.get('ntree', 5 + int(round((nodes.shape[0]) ** 0.5 / 20.0)))
-        n_iters = kwargs.get('niter', max(5, 2 * int(round(np.log2(nodes.shape[0])))))
-        nnd = NNDescent(nodes.values, n_trees=n_trees, n_iters=n_iters, n_neighbors=n_neighbors, max_candidates=60, verbose=True)
-        return nnd
+    @property
+    def I(self) -> Optional[np.ndarray]:
+        return None if self.index is None else self.index.I
+
+    @property
+    def D(self) -> Optional[np.ndarray]:
+        return None if self.index is None else self.index.D
+
+    @property
+    def nnd(self) -> Optional["NNDescent"]:
+        return None if self.index is None else self.index.nnd
+
+    @property
+    def graph(self) -> CSRGraph:
+        return self.index.graph
+
+    def updateSeeds( self, sample_data: np.ndarray ) -> np.ndarray:
+        # Applies the difference between the new and the previous seed labels to (C, P, S) and returns the nodes to propagate from:
+        # added seeds, plus the border of the region whose nearest seed was removed. Changing a seed's class relabels its region in place.
+        # Negative (nodata) labels are kept fixed: they are never overwritten and never propagate.
+        seed_mask = sample_data > 0
+        if (self.C is None) or self.reset or (self._seeds is None):
+            self.C = sample_data.astype( np.int32 )
+            self.P = np.where( sample_data != 0, 0.0, np.inf ).astype( np.float32 )
+            self.S = np.where( seed_mask, np.arange( sample_data.size ), -1 ).astype( np.int32 )
+            self._seeds = sample_data.copy()
+            return np.nonzero( seed_mask )[0].astype( np.int32 )
+        previous_mask = self._seeds > 0
+        added = seed_mask & ~previous_mask
+        removed = previous_mask & ~seed_mask
+        relabelled = np.nonzero( seed_mask & previous_mask & ( sample_data != self._seeds ) )[0]
+        self._seeds = sample_data.copy()
+        if relabelled.size > 0:
+            region = np.isin( self.S, relabelled )
+            self.C[region] = sample_data[ self.S[region] ]
+        sources = [ np.nonzero( added )[0].astype( np.int32 ) ]
+        if np.count_nonzero( removed ) > 0:
+            affected = np.isin( self.S, np.nonzero( removed )[0] )
+            self.C[affected], self.P[affected], self.S[affected] = 0, np.inf, -1
+            sources.append( boundary_nodes( self.graph.indptr, self.graph.indices, affected, self.C, self.P ) )
+        if not self._converged:
+            sources.append( np.nonzero( ( self.C > 0 ) & np.isfinite( self.P ) )[0].astype( np.int32 ) )     # resume a hop-limited spread
+        self.C[added], self.P[added], self.S[added] = sample_data[added], 0.0, np.nonzero( added )[0]
+        return np.unique( np.concatenate( sources ) )
 
     def spread( self, sample_labels: xa.DataArray, nIter: int = 1, **kwargs ) -> Optional[xa.Dataset]:
         if self.D is None:
             Task.showMessage( "Awaiting task completion", "", "The NN graph computation has not yet finished", QMessageBox.Critical )
             return None
         sample_data = sample_labels.values
-        sample_mask = sample_data == 0
-        if self.C is None or self.reset:
-            self.C = sample_data
-        else:
-            self.C = np.where( sample_mask, self.C, sample_data )
-        label_count = np.count_nonzero(self.C)
-        if label_count == 0:
+        if np.count_nonzero( sample_data > 0 ) == 0:
             Task.showMessage("Workflow violation", "", "Must label some points before this algorithm can be applied", QMessageBox.Critical )
             return None
-        if (self.P is None) or self.reset:   self.P = np.full( self.C.shape, float('inf'), dtype=np.float32 )
-        self.P = np.where( sample_mask, self.P, 0.0 )
-        print(f"Beginning graph flow iterations, #C = {label_count}")
         t0 = time.time()
+        sources = self.updateSeeds( sample_data )
+        print(f"Beginning graph flow, #C = {np.count_nonzero(self.C)}, #sources = {sources.size}")
         converged = False
-        for iter in range(nIter):
-            try:
-                iterate_spread_labels( self.I, self.D, self.C, self.P )
-                new_label_count = np.count_nonzero(self.C)
-                if new_label_count == label_count:
-                    print( "Converged!" )
-                    converged = True
-                    break
-                else:
-                    label_count = new_label_count
- #                   print(f"\n -->> Iter{iter + 1}: #C = {label_count}\n")
-            except Exception as err:
-                print(f"Error in graph flow iteration {iter}:")
-                traceback.print_exc(50)
-                break
+        try:
+            # Each of the original sweep iterations extended the labels by up to two graph edges
+            max_hops = 2*nIter if nIter > 0 else -1
+            nthreads = min( dataManager.config.value( "graph/nthreads", 1, type=int ), numba.config.NUMBA_NUM_THREADS )
+            if nthreads > 1:
+                numba.set_num_threads( nthreads )
+                converged = propagate_labels_parallel( *self.graph.kernel_args, self.C, self.P, self.S, sources, max_hops )
+            else:
+                converged = propagate_labels( *self.graph.kernel_args, self.C, self.P, self.S, sources, max_hops )
+        except Exception as err:
+            print(f"Error in graph flow:")
+            traceback.print_exc(50)
+        self._converged = converged
 
         t1 = time.time()
         result_attrs = dict( converged=converged, **sample_labels.attrs )
         result_attrs[ '_FillValue']=-2
-        xC: xa.DataArray =  xa.DataArray( self.C, dims=sample_labels.dims, coords=sample_labels.coords, attrs=result_attrs )
-        xP: xa.DataArray = xa.DataArray( self.P, dims=sample_labels.dims, coords=sample_labels.coords,  attrs=result_attrs )
-        print(f"Completed graph flow {nIter} iterations in {(t1 - t0)} sec, Class Range = [ {xC.min().values} -> {xC.max().values} ], #marked = {np.count_nonzero(xC.values)}")
+        xC: xa.DataArray =  xa.DataArray( self.C.copy(), dims=sample_labels.dims, coords=sample_labels.coords, attrs=result_attrs )
+        xP: xa.DataArray = xa.DataArray( self.P.copy(), dims=sample_labels.dims, coords=sample_labels.coords,  attrs=result_attrs )
+        print(f"Completed graph flow (nIter = {nIter}, converged = {converged}) in {(t1 - t0)} sec, Class Range = [ {xC.min().values} -> {xC.max().values} ], #marked = {np.count_nonzero(xC.values)}")
         self.reset = False
         return xa.Dataset( dict( C=xC, D=xP ) )
 
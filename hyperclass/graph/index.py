@@ -0,0 +1,219 @@
+import numpy as np
+import xarray as xa
+from typing import List, Union, Tuple, Optional, Dict
+from hyperclass.data.manager import dataManager
+from hyperclass.graph.cache import NNGraphCache, fingerprint
+from hyperclass.graph.csr import CSRGraph
+from hyperclass.graph.knn import build_knn, select_method, knn_recall
+from hyperclass.graph.spatial import pixel_index_array, augment_knn
+import time, threading
+
+class KNNIndex:
+    # The kNN graph of one dataset for one parameter set: neighbour arrays (I, D), their symmetric CSR graph and the search index
+    # (NNDescent, or one of the exact backends in graph/knn.py). With graph/spatial set, neighbor_graph and graph also include pixel adjacency edges.
+    # With graph/storage set to float16 or uint8, D is held (and cached) as float16 when its values fit, and graph is a compact CSRGraph (see CSRGraph.compact).
+    # Compact storage also keeps I and D as memory maps of their cached copies, and releases the search index and merged neighbour rows
+    # once the compact graph is built (see release), so that the resident footprint of a block is essentially its compact graph.
+
+    def __init__( self, nodes: Optional[xa.DataArray], params: Dict, **kwargs ):
+        self.nodes = nodes
+        self.params = params
+        self.I: np.ndarray = None
+        self.D: np.ndarray = None
+        self._nnd: "NNDescent" = None
+        self._neighbor_graph: Optional[Tuple[np.ndarray,np.ndarray]] = None
+        self._graph: Optional[CSRGraph] = None
+        self._lock = threading.RLock()        # Reentrant: graph builds from neighbor_graph, which takes the lock too
+        self._query_lock = threading.Lock()
+        self._query_index = None
+        self.method: Optional[str] = params.get( 'method' )
+
+    @classmethod
+    def fromGraph( cls, I: np.ndarray, D: np.ndarray ) -> "KNNIndex":
+        index = KNNIndex( None, {} )
+        index.I, index.D = I, D
+        return index
+
+    def build( self, **kwargs ):
+        t0 = time.time()
+        cache_mode = dataManager.config.value( "graph/cache", "graph" )
+        graph_cache = NNGraphCache( dataManager.config.value('data/cache'), self.params['dsid'] )
+        graph = None if cache_mode == "none" else graph_cache.read( self.search_params )
+        if graph is None:
+            self.method = self.resolveMethod( self.params['method'], *self.nodes.shape )
+            self._nnd = self.getNNGraph( self.nodes, **dict( kwargs, method=self.method ) )
+            I, D = self._nnd.neighbor_graph
+            self.I, self.D = np.asarray( I, dtype=np.int32 ), np.asarray( D, dtype=np.float32 )
+            if self.storage != "float32": self.D = self.compactDistances( self.D, self.params.get('dsid') )
+            if cache_mode != "none":
+                graph_cache.write( self.search_params, self.I, self.D, self._nnd if cache_mode == "index" else None, method=self.method )
+                if self.storage != "float32": self.I, self.D = graph_cache.read( self.search_params )
+            action = "Computed"
+        else:
+            # The backend 'auto' chose when the graph was built, so a cached graph is reused even where this machine's timing would choose another.
+            self.method = graph_cache.method or self.resolveMethod( self.params['method'], *self.nodes.shape )
+            self._nnd = graph_cache.readIndex() if cache_mode == "index" else None
+            self.I, self.D = graph
+            action = "Loaded"
+        dt = (time.time()-t0)
+        print( f"{action} NN Graph ({self.method}) with {self.I.shape[1]} neighbors and {self.I.shape[0]} verts in {dt} sec ({dt/60} min)")
+        recall_samples = dataManager.config.value( "graph/recall", 0, type=int )
+        if ( recall_samples > 0 ) and ( self.method == "nndescent" ):
+            print( f"NN Graph recall (vs exact, {recall_samples} samples) = {self.recall( recall_samples ):.4f}" )
+
+    @property
+    def search_params(self) -> Dict:
+        # The parameters of the kNN search alone: the spatial edges are added afterwards, so they do not invalidate the cached search.
+        return { key: value for key, value in self.params.items() if key != 'spatial' }
+
+    @property
+    def spatial(self) -> Tuple[int,float]:
+        connectivity, weight = self.params.get( 'spatial', [ 0, 1.0 ] )
+        return int( connectivity ), float( weight )
+
+    @property
+    def storage(self) -> str:
+        return self.params.get( 'storage', "float32" )
+
+    @classmethod
+    def compactDistances( cls, D: np.ndarray, dsid: str = None ) -> np.ndarray:
+        # D is read as is (by UMAP, the spatial edges and the tile graph), so it is only stored as float16 when its values fit.
+        if np.abs( np.asarray( D ) ).max( initial=0.0 ) > np.finfo( np.float16 ).max:
+            print( f"NN graph distances of {dsid} exceed the float16 range, keeping them in float32" )
+            return D
+        return np.asarray( D, dtype=np.float16 )
+
+    @property
+    def neighbor_graph(self) -> Tuple[np.ndarray,np.ndarray]:
+        connectivity, weight = self.spatial
+        if ( connectivity == 0 ) or ( self.nodes is None ): return self.I, self.D
+        if self._neighbor_graph is None:
+            with self._lock:
+                if self._neighbor_graph is None:
+                    index_array = pixel_index_array( self.nodes )
+                    if index_array is None:
+                        print( f"No pixel coordinates for dataset {self.params.get('dsid')}, spatial edges are not added" )
+                        self._neighbor_graph = ( self.I, self.D )
+                    else:
+                        self._neighbor_graph = augment_knn( self.I, self.D, index_array, connectivity, weight )
+        return self._neighbor_graph
+
+    @property
+    def nnd(self) -> Optional["NNDescent"]:
+        # A graph loaded from the cache without its search index (or whose index was released) gets one on first use:
+        # the cached index when graph/cache is 'index', otherwise one seeded with the neighbour graph.
+        if (self._nnd is None) and (self.I is not None) and (self.nodes is not None):
+            with self._lock:
+                if self._nnd is None:
+                    if dataManager.config.value( "graph/cache", "graph" ) == "index":
+                        self._nnd = NNGraphCache( dataManager.config.value('data/cache'), self.params['dsid'] ).readIndex()
+                    if self._nnd is None:
+                        self._nnd = self.getNNGraph( self.nodes, method=self.method, init_graph=np.asarray( self.I ), init_dist=np.asarray( self.D, dtype=np.float32 ) )
+        return self._nnd
+
+    @property
+    def graph(self) -> CSRGraph:
+        if self._graph is None:
+            with self._lock:
+                if self._graph is None:
+                    graph_cache = None if ( 'dsid' not in self.params ) or ( dataManager.config.value( "graph/cache", "graph" ) == "none" ) else NNGraphCache( dataManager.config.value('data/cache'), self.params['dsid'] )
+                    name = "csr" if self.spatial[0] == 0 else "csr-{}-{}".format( *self.spatial )
+                    if self.storage != "float32": name = f"{name}-{self.storage}"
+                    graph = None if graph_cache is None else graph_cache.readGraph( name )
+                    if graph is None:
+                        graph = CSRGraph.fromKNN( *self.neighbor_graph, symmetric=True )
+                        if self.storage != "float32": graph = graph.compact( self.storage )
+                        if graph_cache is not None: graph_cache.writeGraph( graph, name )
+                    self._graph = graph
+                    if self.storage != "float32": self.release()
+        return self._graph
+
+    def release( self ):
+        # Drops what the compact graph makes redundant: the search index (reloaded or rebuilt by the next query, see nnd),
+        # which holds its own copy of the data and neighbour graph, and the merged neighbour rows (recomputed on use).
+        self._nnd = None
+        self._query_index = None
+        self._neighbor_graph = None
+
+    def query( self, X: np.ndarray, k: int = None ) -> Tuple[np.ndarray,np.ndarray]:
+        # Safe to call from several threads: the first query (which builds NNDescent's search graph and compiles its search, neither of
+        # which is thread-safe) runs alone, while concurrent callers wait for it; later queries run concurrently.
+        # A released and rebuilt search index is warmed up again.
+        X, k = np.ascontiguousarray( X, dtype=np.float32 ), self.I.shape[1] if k is None else k
+        nnd = self.nnd
+        if self._query_index is not nnd:
+            with self._query_lock:
+                if self._query_index is not nnd:
+                    result = nnd.query( X, k )
+                    self._query_index = nnd
+                    return result
+        return nnd.query( X, k )
+
+    def recall( self, nsamples: int = 256 ) -> float:
+        return knn_recall( np.asarray( self.nodes.values, dtype=np.float32 ), np.asarray( self.I ), nsamples )
+
+    @classmethod
+    def resolveMethod(cls, method: str, npoints: int, nfeatures: int ) -> str:
+        if method != "auto": return method
+        return select_method( npoints, nfeatures, dataManager.config.value( "graph/knn_budget", 2.0, type=float ) )
+
+    @classmethod
+    def nnParams(cls, npoints: int, nfeatures: int, resolve: bool = True, **kwargs ) -> Dict:
+        n_neighbors = dataManager.config.value("umap/nneighbors", type=int)
+        n_trees = kwargs.get('ntree', 5 + int(round( npoints ** 0.5 / 20.0)))
+        n_iters = kwargs.get('niter', max(5, 2 * int(round(np.log2( npoints )))))
+        method = kwargs.get( 'method', dataManager.config.value( "graph/knn", "auto" ) )
+        if resolve: method = cls.resolveMethod( method, npoints, nfeatures )
+        return dict( n_neighbors=n_neighbors, n_trees=n_trees, n_iters=n_iters, method=method )
+
+    @classmethod
+    def graphParams(cls, nodes: xa.DataArray, **kwargs ) -> Dict:
+        # Everything the kNN graph depends on: a change in any of these invalidates the cached graph. The method is the configured one
+        # ('auto' is not resolved here, since its choice depends on timing this machine), the resolved backend is recorded in the cache header.
+        params = dict( dsid=nodes.attrs['dsid'], fingerprint=fingerprint( nodes ), band_spec=dataManager.spatial.band_spec, **cls.nnParams( *nodes.shape, resolve=False, **kwargs ) )
+        params['reduction'] = [ dataManager.config.value("input.reduction/method", "None"), int( dataManager.config.value("input.reduction/ndim", 16 ) ) ]
+        params['spatial'] = [ dataManager.config.value( "graph/spatial", 0, type=int ), dataManager.config.value( "graph/spatial_weight", 1.0, type=float ) ]
+        params['storage'] = dataManager.config.value( "graph/storage", "float32" )
+        return params
+
+    @classmethod
+    def getNNGraph(cls, nodes: xa.DataArray, **kwargs ):
+        params = cls.nnParams( *nodes.shape, **kwargs )
+        init_graph = kwargs.get( 'init_graph', None )
+        if init_graph is not None: params['n_neighbors'] = init_graph.shape[1]
+        return build_knn( nodes.values, params['method'], params['n_neighbors'], n_trees=params['n_trees'], n_iters=params['n_iters'], init_graph=init_graph, init_dist=kwargs.get( 'init_dist' ) )
+
+class KNNIndexRegistry:
+    # Hands out one KNNIndex per dataset and parameter set, so flow spreading, embedding, supervised embedding and transform share it.
+
+    def __init__( self ):
+        self._indices: Dict[str,KNNIndex] = {}
+        self._lock = threading.Lock()
+        self._build_locks: Dict[str,threading.Lock] = {}
+
+    def getIndex( self, point_data: xa.DataArray, **kwargs ) -> KNNIndex:
+        params = KNNIndex.graphParams( point_data, **kwargs )
+        key = f"{params['dsid']}:{NNGraphCache.key( params )}"
+        with self._lock:
+            build_lock = self._build_locks.setdefault( key, threading.Lock() )
+        with build_lock:
+            index = self._indices.get( key )
+            if index is None:
+                index = KNNIndex( point_data, params )
+                index.build( **kwargs )
+                with self._lock:
+                    self._indices[ key ] = index
+        return index
+
+    def remove( self, dsid: str ):
+        with self._lock:
+            for key in [ key for key in self._indices.keys() if key.split(":")[0] == dsid ]:
+                del self._indices[ key ]
+                self._build_locks.pop( key, None )
+
+    def clear( self ):
+        with self._lock:
+            self._indices.clear()
+            self._build_locks.clear()
+
+knnIndexRegistry = KNNIndexRegistry()
@@ -0,0 +1,102 @@
+import numpy as np
+from typing import List, Union, Tuple, Optional, Dict
+import time
+
+# kNN search backends. Each one exposes the part of the NNDescent interface the rest of hyperclass uses:
+# neighbor_graph ( I, D ) of the indexed points, each point being its own first neighbour, and query( X, k ).
+
+METHODS = [ "auto", "exact", "tree", "nndescent" ]
+TREE_MAX_FEATURES = 12          # Space partitioning trees degrade to brute force beyond a dozen or so dimensions
+_matmul_rate: Optional[float] = None
+
+def matmul_rate() -> float:
+    # Measured float32 matmul throughput of this machine (multiply-adds per second), used to predict the cost of an exact search.
+    global _matmul_rate
+    if _matmul_rate is None:
+        A = np.random.default_rng( 0 ).random( ( 2048, 64 ), dtype=np.float32 )
+        A @ A.T
+        t0 = time.perf_counter()
+        A @ A.T
+        _matmul_rate = A.shape[0] * A.shape[0] * A.shape[1] / max( time.perf_counter() - t0, 1e-6 )
+    return _matmul_rate
+
+def exact_search_time( n_samples: int, n_features: int, n_queries: int = None ) -> float:
+    return ( n_samples if n_queries is None else n_queries ) * n_samples * n_features / matmul_rate()
+
+def select_method( n_samples: int, n_features: int, time_budget: float ) -> str:
+    if exact_search_time( n_samples, n_features ) <= time_budget: return "exact"
+    if n_features <= TREE_MAX_FEATURES: return "tree"
+    return "nndescent"
+
+def exact_knn( X: np.ndarray, Y: np.ndarray, k: int, chunk_bytes: int = 2**26 ) -> Tuple[np.ndarray,np.ndarray]:
+    # Brute force kNN of the rows of Y among the rows of X, one chunk of Y at a time with ||y||^2 - 2 y.x + ||x||^2 computed by float32 matmul.
+    X = np.ascontiguousarray( X, dtype=np.float32 )
+    Y = np.ascontiguousarray( Y, dtype=np.float32 )
+    k = min( k, X.shape[0] )
+    xx = np.einsum( 'ij,ij->i', X, X )
+    I = np.empty( ( Y.shape[0], k ), dtype=np.int32 )
+    D = np.empty( ( Y.shape[0], k ), dtype=np.float32 )
+    chunk_size = max( 1, chunk_bytes // ( 4 * max( X.shape[0], 1 ) ) )
+    for c0 in range( 0, Y.shape[0], chunk_size ):
+        Yc = Y[c0:c0+chunk_size]
+        d2 = Yc @ X.T
+        d2 *= -2.0
+        d2 += np.einsum( 'ij,ij->i', Yc, Yc )[:,None]
+        d2 += xx[None,:]
+        np.maximum( d2, 0.0, out=d2 )
+        nearest = np.argpartition( d2, k-1, axis=1 )[:,:k] if k < X.shape[0] else np.broadcast_to( np.arange( k ), d2.shape ).copy()
+        nearest_d2 = np.take_along_axis( d2, nearest, axis=1 )
+        order = np.argsort( nearest_d2, axis=1, kind='stable' )
+        I[c0:c0+chunk_size] = np.take_along_axis( nearest, order, axis=1 )
+        D[c0:c0+chunk_size] = np.sqrt( np.take_along_axis( nearest_d2, order, axis=1 ) )
+    return I, D
+
+def knn_recall( X: np.ndarray, I: np.ndarray, nsamples: int = 256, seed: int = 0 ) -> float:
+    # Fraction of the true k nearest neighbours found in I, estimated from a random sample of rows checked against an exact search.
+    rows = np.random.default_rng( seed ).choice( X.shape[0], min( nsamples, X.shape[0] ), replace=False )
+    k = I.shape[1]
+    exact, _ = exact_knn( X, X[rows], k )
+    found = [ np.intersect1d( I[row], exact[iR] ).size for iR, row in enumerate( rows ) ]
+    return float( np.sum( found ) ) / ( rows.size * k )
+
+class ExactKNN:
+    # Exact search by blocked matmul: nothing to build, the neighbour graph is computed on first use.
+
+    def __init__( self, X: np.ndarray, n_neighbors: int, init_graph: np.ndarray = None, init_dist: np.ndarray = None, **kwargs ):
+        self.X = np.ascontiguousarray( X, dtype=np.float32 )
+        self.n_neighbors = n_neighbors
+        self._neighbor_graph = None if init_graph is None else ( init_graph, init_dist )
+
+    @property
+    def neighbor_graph(self) -> Tuple[np.ndarray,np.ndarray]:
+        if self._neighbor_graph is None:
+            self._neighbor_graph = self.query( self.X, self.n_neighbors )
+        return self._neighbor_graph
+
+    def query( self, X: np.ndarray, k: int ) -> Tuple[np.ndarray,np.ndarray]:
+        return exact_knn( self.X, X, k )
+
+class TreeKNN( ExactKNN ):
+    # Exact search with a sklearn kd-tree (or ball tree), effective in low dimensions.
+
+    def __init__( self, X: np.ndarray, n_neighbors: int, init_graph: np.ndarray = None, init_dist: np.ndarray = None, **kwargs ):
+        from sklearn.neighbors import NearestNeighbors
+        ExactKNN.__init__( self, X, n_neighbors, init_graph, init_dist )
+        self.tree = NearestNeighbors( n_neighbors=n_neighbors, algorithm=kwargs.get( 'algorithm', 'auto' ) ).fit( self.X )
+
+    def query( self, X: np.ndarray, k: int ) -> Tuple[np.ndarray,np.ndarray]:
+        D, I = self.tree.kneighbors( np.ascontiguousarray( X, dtype=np.float32 ), min( k, self.X.shape[0] ) )
+        return I.astype( np.int32 ), D.astype( np.float32 )
+
+def build_knn( X: np.ndarray, method: str, n_neighbors: int, **kwargs ):
+    # kwargs: n_trees, n_iters (NNDescent), init_graph, init_dist (an already computed neighbour graph to start from).
+    if method == "exact": return ExactKNN( X, n_neighbors, **kwargs )
+    if method == "tree": return TreeKNN( X, n_neighbors, **kwargs )
+    if method == "nndescent":
+        from pynndescent import NNDescent
+        X = np.ascontiguousarray( X, dtype=np.float32 )
+        init_graph = kwargs.get( 'init_graph', None )
+        if init_graph is not None:
+            return NNDescent( X, n_neighbors=init_graph.shape[1], init_graph=init_graph, init_dist=kwargs.get( 'init_dist' ), tree_init=False, n_iters=1, max_candidates=60, verbose=True )
+        return NNDescent( X, n_trees=kwargs['n_trees'], n_iters=kwargs['n_iters'], n_neighbors=n_neighbors, max_candidates=60, verbose=True )
+    raise ValueError( f"Unknown kNN method: {method}, expected one of {METHODS[1:]}" )
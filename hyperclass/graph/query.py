@@ -0,0 +1,101 @@
+import numpy as np
+import xarray as xa
+from typing import List, Union, Tuple, Optional, Dict, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from hyperclass.data.manager import dataManager
+from hyperclass.data.spatial.cache import TileCache
+from hyperclass.graph.index import KNNIndex
+import math, time
+
+class ImageQuery:
+    # Queries every pixel of the current image against the kNN index of one (labelled) block, out of core: the image is read one
+    # window at a time (the next window is read while the current one is queried), reduced with the cached reduction model,
+    # and queried in batches on a thread pool. Results are written window by window to chunked stores (TileCache layout) under output_dir:
+    # the neighbour indices and distances, and/or the label of the nearest labelled neighbour when per-point labels are given.
+    # At most two windows are held in memory at once.
+
+    NODATA = -2
+
+    def __init__( self, index: KNNIndex, labels: np.ndarray = None, **kwargs ):
+        self.index = index
+        self.labels = labels
+        self.k = kwargs.get( 'k', index.I.shape[1] )
+        self.norm = kwargs.get( 'norm', 'none' )
+        self.window_size = kwargs.get( 'window_size', dataManager.config.value( 'query/window_size', dataManager.spatial.block_shape[0], type=int ) )
+        self.batch_size = kwargs.get( 'batch_size', dataManager.config.value( 'query/batch_size', 10000, type=int ) )
+        self.nthreads = kwargs.get( 'nthreads', dataManager.config.value( 'graph/nthreads', 1, type=int ) )
+        self.outputs = kwargs.get( 'outputs', [ 'labels' ] if labels is not None else [ 'neighbors' ] )
+
+    def windows( self, shape: List[int] ) -> Iterator[Tuple[Tuple[int,int],Tuple[int,int],Tuple[int,int]]]:
+        for iy in range( math.ceil( shape[0] / self.window_size ) ):
+            for ix in range( math.ceil( shape[1] / self.window_size ) ):
+                y0, x0 = iy*self.window_size, ix*self.window_size
+                yield (iy, ix), ( y0, min( y0+self.window_size, shape[0] ) ), ( x0, min( x0+self.window_size, shape[1] ) )
+
+    def readWindow( self, ybounds: Tuple[int,int], xbounds: Tuple[int,int] ) -> Optional[Tuple[xa.DataArray,np.ndarray,np.ndarray]]:
+        from hyperclass.data.spatial.tile import reduce_points
+        raster: Optional[xa.DataArray] = dataManager.spatial.readGeotiffWindow( dataManager.spatial.image_name, ybounds, xbounds, dataManager.config.value( 'data/valid_bands', None ) )
+        if raster is None: return None
+        raster = dataManager.spatial.rescale( dataManager.spatial.mask_nodata( raster, dataManager.spatial.dtype ), norm=self.norm )
+        pindices = dataManager.spatial.valid_pixel_indices( raster )
+        if pindices.size == 0: return raster, pindices, np.zeros( [ 0, self.index.nodes.shape[1] ], dtype=np.float32 )
+        points = reduce_points( dataManager.spatial.raster2points( raster, pindices, multi_index=False ), self.norm )
+        return raster, pindices, np.ascontiguousarray( points.values, dtype=np.float32 )
+
+    def query( self, executor: ThreadPoolExecutor, points: np.ndarray ) -> Tuple[np.ndarray,np.ndarray]:
+        batches = [ points[b0:b0+self.batch_size] for b0 in range( 0, points.shape[0], self.batch_size ) ]
+        results = list( executor.map( lambda batch: self.index.query( batch, self.k ), batches ) )     # KNNIndex.query runs the first (warm-up) query alone
+        return np.concatenate( [ np.asarray( I, dtype=np.int32 ) for I, D in results ] ), np.concatenate( [ np.asarray( D, dtype=np.float32 ) for I, D in results ] )
+
+    def nearestLabels( self, I: np.ndarray, D: np.ndarray ) -> Tuple[np.ndarray,np.ndarray]:
+        # Class of, and distance to, the nearest of the k neighbours that carries a label (0 / inf if none does).
+        neighbor_labels = np.where( I >= 0, self.labels[ np.maximum( I, 0 ) ], 0 )
+        labelled = neighbor_labels > 0
+        first = np.argmax( labelled, axis=1 )
+        found = labelled[ np.arange( I.shape[0] ), first ]
+        rows = np.arange( I.shape[0] )
+        return np.where( found, neighbor_labels[rows,first], 0 ).astype( np.int32 ), np.where( found, D[rows,first], np.inf ).astype( np.float32 )
+
+    def stores( self, output_dir: str ) -> Dict[str,TileCache]:
+        name = f"{self.index.params.get('dsid', dataManager.spatial.image_name)}.query"
+        names = dict( neighbors=[ 'I', 'D' ], labels=[ 'C', 'P' ] )
+        return { array: TileCache( output_dir, f"{name}.{array}" ) for output in self.outputs for array in names[output] }
+
+    def run( self, output_dir: str ) -> Optional[Dict[str,str]]:
+        image_specs = dataManager.spatial.readImageSpecs( dataManager.spatial.image_name )
+        if image_specs is None: return None
+        shape, tr = image_specs['shape'], image_specs['attrs']['transform']
+        stores = self.stores( output_dir )
+        for store in stores.values(): store.invalidate()
+        windows = list( self.windows( shape ) )
+        t0, npoints, crs_wkt = time.time(), 0, None
+        with ThreadPoolExecutor( 1 ) as reader, ThreadPoolExecutor( max( self.nthreads, 1 ) ) as executor:
+            next_window = reader.submit( self.readWindow, *windows[0][1:] )
+            for iW, ( (iy, ix), ybounds, xbounds ) in enumerate( windows ):
+                window_data = next_window.result()
+                if iW + 1 < len( windows ): next_window = reader.submit( self.readWindow, *windows[iW+1][1:] )
+                wshape = ( ybounds[1]-ybounds[0], xbounds[1]-xbounds[0] )
+                chunks = dict( I=np.full( ( self.k, *wshape ), -1, dtype=np.int32 ), D=np.full( ( self.k, *wshape ), np.nan, dtype=np.float32 ),
+                               C=np.full( ( 1, *wshape ), self.NODATA, dtype=np.int32 ), P=np.full( ( 1, *wshape ), np.nan, dtype=np.float32 ) )
+                if window_data is not None:
+                    raster, pindices, points = window_data
+                    if ( crs_wkt is None ) and ( raster.rio.crs is not None ): crs_wkt = raster.rio.crs.to_wkt()
+                    if pindices.size > 0:
+                        I, D = self.query( executor, points )
+                        chunks['I'].reshape( self.k, -1 )[ :, pindices ] = I.transpose()
+                        chunks['D'].reshape( self.k, -1 )[ :, pindices ] = D.transpose()
+                        if 'C' in stores: chunks['C'].reshape(-1)[ pindices ], chunks['P'].reshape(-1)[ pindices ] = self.nearestLabels( I, D )
+                        npoints += pindices.size
+                for array, store in stores.items(): store.writeChunk( iy, ix, chunks[array] )
+                print( f"Queried window {iW+1}/{len(windows)} [{ybounds[0]}:{ybounds[1]},{xbounds[0]}:{xbounds[1]}]: {npoints} points in {time.time()-t0:.2f} sec" )
+
+        coords = dict( y = tr[5] + ( np.arange( shape[0] ) + 0.5 ) * tr[4], x = tr[2] + ( np.arange( shape[1] ) + 0.5 ) * tr[0], neighbor=np.arange( self.k ), band=np.arange( 1 ) )
+        for array, store in stores.items():
+            dims = [ 'neighbor' if array in [ 'I', 'D' ] else 'band', 'y', 'x' ]
+            nbands = self.k if array in [ 'I', 'D' ] else 1
+            dtype = np.int32 if array in [ 'I', 'C' ] else np.float32
+            attrs = dict( _FillValue=self.NODATA ) if array == 'C' else ( dict( _FillValue=-1 ) if array == 'I' else {} )
+            store.writeHeader( [ nbands, *shape ], dtype, dims, coords, [ self.window_size, self.window_size ], array, crs_wkt, dict( attrs, index=self.index.params.get('dsid') ) )
+        dt = time.time() - t0
+        print( f"Queried {npoints} image points against index {self.index.params.get('dsid')} in {dt:.2f} sec ({npoints/max(dt,1e-9):.0f} points/sec), outputs: {list(stores.keys())}" )
+        return { array: store.path for array, store in stores.items() }
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import xarray as xa
+import numba
+from typing import List, Union, Tuple, Optional, Dict
+
+# Pixel adjacency edges for spatial (block) point data, merged into the spectral kNN graph so that label spreading
+# and the UMAP fuzzy simplicial set both see the spatial prior.
+
+CONNECTIVITY = { 4: [ (-1,0), (0,-1), (0,1), (1,0) ], 8: [ (-1,-1), (-1,0), (-1,1), (0,-1), (0,1), (1,-1), (1,0), (1,1) ] }
+
+def pixel_index_array( point_data: xa.DataArray ) -> Optional[np.ndarray]:
+    # Same layout as Block.index_array (point index of each pixel, -1 where there is none), rebuilt from the (y, x) samples index
+    # so that it also holds for subsampled point data. Returns None for point data without pixel coordinates.
+    samples = point_data.indexes.get( point_data.dims[0] )
+    if not isinstance( samples, pd.MultiIndex ) or ( samples.nlevels != 2 ): return None
+    index_array = np.full( [ len( level ) for level in samples.levels ], -1, dtype=np.int32 )
+    index_array[ samples.codes[0], samples.codes[1] ] = np.arange( samples.size, dtype=np.int32 )
+    return index_array
+
+@numba.njit
+def spatial_neighbors( index_array: np.ndarray, offsets: np.ndarray, npoints: int ) -> np.ndarray:
+    # ( npoints, len(offsets) ) array of the point index of each pixel neighbour, -1 outside the block or on nodata pixels.
+    ny, nx = index_array.shape
+    neighbors = np.full( ( npoints, offsets.shape[0] ), -1, dtype=np.int32 )
+    for iy in range( ny ):
+        for ix in range( nx ):
+            i = index_array[iy,ix]
+            if i < 0: continue
+            for iO in range( offsets.shape[0] ):
+                y, x = iy + offsets[iO,0], ix + offsets[iO,1]
+                if ( y >= 0 ) and ( y < ny ) and ( x >= 0 ) and ( x < nx ):
+                    neighbors[i,iO] = index_array[y,x]
+    return neighbors
+
+@numba.njit
+def merge_neighbors( I: np.ndarray, D: np.ndarray, S: np.ndarray, spatial_distance: float ) -> Tuple[np.ndarray,np.ndarray]:
+    # Appends the spatial neighbours S to each kNN row (keeping the shorter distance for pixels that are in both), sorted by distance.
+    # Unused slots get index -1 and distance -1: the CSR builders skip them and UMAP's smooth_knn_dist leaves them out when fitting sigma and rho,
+    # so border and nodata-adjacent pixels, which have fewer neighbours, are calibrated on their real neighbours only.
+    n, k = I.shape
+    m = k + S.shape[1]
+    I1 = np.full( ( n, m ), -1, dtype=np.int32 )
+    D1 = np.zeros( ( n, m ), dtype=np.float32 )
+    for i in range( n ):
+        ncols = 0
+        for iN in range( k ):
+            if I[i,iN] >= 0:
+                I1[i,ncols], D1[i,ncols] = I[i,iN], D[i,iN]
+                ncols += 1
+        for iS in range( S.shape[1] ):
+            j = S[i,iS]
+            if j < 0: continue
+            found = False
+            for iC in range( ncols ):
+                if I1[i,iC] == j:
+                    D1[i,iC] = min( D1[i,iC], spatial_distance )
+                    found = True
+            if not found:
+                I1[i,ncols], D1[i,ncols] = j, spatial_distance
+                ncols += 1
+        order = np.argsort( D1[i,:ncols], kind='mergesort' )
+        I1[i,:ncols], D1[i,:ncols] = I1[i,:ncols][order], D1[i,:ncols][order]
+        D1[i,ncols:] = -1.0
+    return I1, D1
+
+def augment_knn( I: np.ndarray, D: np.ndarray, index_array: np.ndarray, connectivity: int, weight: float ) -> Tuple[np.ndarray,np.ndarray]:
+    # Spatial edges get 'weight' times the median spectral neighbour distance, so the weight does not depend on the data scale.
+    D = np.asarray( D, dtype=np.float32 )
+    spectral = D[:,1:][ np.asarray( I )[:,1:] >= 0 ]
+    spatial_distance = weight * float( np.median( spectral ) ) if spectral.size > 0 else weight
+    S = spatial_neighbors( index_array, np.array( CONNECTIVITY[connectivity], dtype=np.int32 ), I.shape[0] )
+    return merge_neighbors( np.ascontiguousarray( I ), np.ascontiguousarray( D ), S, np.float32( spatial_distance ) )
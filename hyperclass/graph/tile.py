@@ -0,0 +1,100 @@
+import numpy as np
+import xarray as xa
+from typing import List, Union, Tuple, Optional, Dict
+from concurrent.futures import ThreadPoolExecutor
+from hyperclass.data.manager import dataManager
+from hyperclass.data.spatial.tile import Tile
+from hyperclass.graph.csr import CSRGraph
+from hyperclass.graph.index import KNNIndex, knnIndexRegistry
+from hyperclass.graph.flow import propagate_labels, propagate_labels_parallel
+import numba, time
+
+class TileGraph:
+    # One graph over all the points of a tile, stitched from the per-block kNN graphs (shared with the block flows through knnIndexRegistry).
+    # Cross-block edges come from querying each block's points against the indices of its adjacent blocks: a found neighbour is kept
+    # if it is closer than the point's k-th neighbour within its own block, i.e. if it belongs in the point's tile-wide kNN.
+    # The cross-block queries run on graph/nthreads threads; KNNIndex.query runs the first query on each index alone.
+    # Nodes are numbered block by block, in row-major block order.
+
+    def __init__( self, tile: Tile, connectivity: int = 8, **kwargs ):
+        self.tile = tile
+        self.connectivity = connectivity
+        self.indices: Dict[Tuple[int,int],KNNIndex] = {}
+        self.offsets: Dict[Tuple[int,int],int] = {}
+        self.npoints = 0
+        self.graph: Optional[CSRGraph] = None
+        self._kwargs = kwargs
+
+    @property
+    def block_coords(self) -> List[Tuple[int,int]]:
+        nBlocks = dataManager.config.value( "block/array_shape", [ 1, 1 ], type=int )       # Includes the partial blocks at the tile edges
+        return [ (iy, ix) for iy in range( nBlocks[0] ) for ix in range( nBlocks[1] ) ]
+
+    def neighbors( self, block_coords: Tuple[int,int] ) -> List[Tuple[int,int]]:
+        offsets = [ (-1,0), (1,0), (0,-1), (0,1) ]
+        if self.connectivity == 8: offsets = offsets + [ (-1,-1), (-1,1), (1,-1), (1,1) ]
+        candidates = [ ( block_coords[0]+dy, block_coords[1]+dx ) for (dy,dx) in offsets ]
+        return [ coords for coords in candidates if coords in self.indices ]
+
+    def blockNodes( self, iy: int, ix: int ) -> slice:
+        offset = self.offsets[ (iy,ix) ]
+        return slice( offset, offset + self.indices[ (iy,ix) ].I.shape[0] )
+
+    def getBlockIndex( self, block_coords: Tuple[int,int] ) -> Optional[KNNIndex]:
+        point_data: xa.DataArray = self.tile.getBlock( *block_coords ).getPointData( **self._kwargs )
+        if point_data.size == 0: return None
+        return knnIndexRegistry.getIndex( point_data, **self._kwargs )
+
+    def crossEdges( self, block_coords: Tuple[int,int], neighbor_coords: Tuple[int,int] ) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+        index, neighbor_index = self.indices[ block_coords ], self.indices[ neighbor_coords ]
+        k = index.I.shape[1]
+        I, D = neighbor_index.query( index.nodes.values, k )
+        kth_distance = np.asarray( index.D )[:,-1]
+        rows, cols = np.nonzero( ( np.asarray( I ) >= 0 ) & ( D < kth_distance[:,None] ) )
+        return rows + self.offsets[ block_coords ], np.asarray( I )[rows,cols] + self.offsets[ neighbor_coords ], D[rows,cols]
+
+    def build( self, nthreads: int = None ) -> CSRGraph:
+        t0 = time.time()
+        nthreads = dataManager.config.value( "graph/nthreads", 1, type=int ) if nthreads is None else nthreads
+        with ThreadPoolExecutor( max( nthreads, 1 ) ) as executor:
+            block_indices = dict( zip( self.block_coords, executor.map( self.getBlockIndex, self.block_coords ) ) )
+            self.indices = { coords: index for coords, index in block_indices.items() if index is not None }
+            self.npoints, self.offsets = 0, {}
+            for coords, index in self.indices.items():
+                self.offsets[ coords ] = self.npoints
+                self.npoints += index.I.shape[0]
+            t1 = time.time()
+            pairs = [ ( coords, neighbor ) for coords in self.indices.keys() for neighbor in self.neighbors( coords ) ]
+            cross_edges = list( executor.map( lambda pair: self.crossEdges( *pair ), pairs ) )
+
+        edges = []
+        for coords, index in self.indices.items():
+            I, D = index.neighbor_graph
+            rows = np.repeat( np.arange( I.shape[0] ), I.shape[1] ) + self.offsets[ coords ]
+            cols = np.where( np.asarray( I ) >= 0, np.asarray( I ) + self.offsets[ coords ], -1 ).ravel()
+            edges.append( ( rows, cols, np.asarray( D ).ravel() ) )
+        ncross = sum( [ rows.size for rows, cols, weights in cross_edges ] )
+        edges.extend( cross_edges )
+        self.graph = CSRGraph.fromEdges( self.npoints, *[ np.concatenate( [ edge[i] for edge in edges ] ) for i in range(3) ], symmetric=True )
+        print( f"Built tile graph over {len(self.indices)} blocks: {self.graph}, {ncross} cross-block edges, block graphs {t1-t0:.2f} sec, stitching {time.time()-t1:.2f} sec" )
+        return self.graph
+
+    def spread( self, block_labels: Dict[Tuple[int,int],np.ndarray], nIter: int = -1 ) -> Dict[Tuple[int,int],Tuple[np.ndarray,np.ndarray]]:
+        # Spreads the labels of any subset of blocks (one label per block point, 0 = unlabelled, < 0 = fixed) over the whole tile,
+        # returning the class and graph distance of every point, block by block.
+        if self.graph is None: self.build()
+        labels = np.zeros( self.npoints, dtype=np.int32 )
+        for coords, block_data in block_labels.items():
+            if coords in self.indices: labels[ self.blockNodes( *coords ) ] = block_data
+        C = labels.copy()
+        P = np.where( labels != 0, 0.0, np.inf ).astype( np.float32 )
+        S = np.where( labels > 0, np.arange( self.npoints ), -1 ).astype( np.int32 )
+        sources = np.nonzero( labels > 0 )[0].astype( np.int32 )
+        max_hops = 2*nIter if nIter > 0 else -1
+        nthreads = min( dataManager.config.value( "graph/nthreads", 1, type=int ), numba.config.NUMBA_NUM_THREADS )
+        if nthreads > 1:
+            numba.set_num_threads( nthreads )
+            propagate_labels_parallel( *self.graph.kernel_args, C, P, S, sources, max_hops )
+        else:
+            propagate_labels( *self.graph.kernel_args, C, P, S, sources, max_hops )
+        return { coords: ( C[ self.blockNodes( *coords ) ], P[ self.blockNodes( *coords ) ] ) for coords in self.indices.keys() }
@@ -85,7 +85,10 @@ class PreferencesDialog(DialogBase):
     def createTileGroupBox(self):
         self.blockSizeSelector = self.createComboSelector("Block Side Length: ", range(100, 600, 50), "block/size")
         self.blocksPerTileSelector = self.createComboSelector("Tile Side Length: ", range(600, 2000, 200), "tile/size")
-        return self.createGroupBox("tiles", [self.blockSizeSelector, self.blocksPerTileSelector])
+        self.blockCacheSelector = self.createComboSelector("Block Cache (MB): ", [ 2**i for i in range(8, 17) ], "block/cache_size", 2048 )
+        self.prefetchSelector = self.createComboSelector("Prefetch Neighbors: ", [ 0, 4, 8 ], "block/prefetch", 4 )
+        self.schedulerSelector = self.createComboSelector("Lazy Scheduler: ", [ "none", "threads", "processes", "synchronous" ], "data/dask/scheduler", "none" )
+        return self.createGroupBox("tiles", [self.blockSizeSelector, self.blocksPerTileSelector, self.blockCacheSelector, self.prefetchSelector, self.schedulerSelector])
 
     def createInitGroupBox(self):
         self.tileSizeSelector = self.createComboSelector("Tile Indices: ", range(100, 600, 50), "tile/indices")
@@ -100,6 +103,35 @@ class PreferencesDialog(DialogBase):
         self.apiKeySelector = self.createSettingInputField( "API KEY", "google/api_key", "" )
         return self.createGroupBox("google", [self.apiKeySelector])
 
+class DictSettings:
+    # Read/write view of a settings snapshot with the QSettings value/setValue interface; changes are never written back to disk.
+
+    def __init__( self, values: Dict ):
+        self._values = dict( values )
+
+    def value(self, key: str, defaultValue = None, type = None ):
+        value = self._values.get( key, defaultValue )
+        if (type is None) or (value is None): return value
+        if isinstance( value, (list, tuple) ): return [ self._convert( v, type ) for v in value ]
+        return self._convert( value, type )
+
+    @classmethod
+    def _convert(cls, value, type ):
+        if (type == bool) and isinstance( value, str ): return value.lower() == "true"
+        return type( value )
+
+    def setValue(self, key: str, value ):
+        self._values[ key ] = value
+
+    def contains(self, key: str ) -> bool:
+        return key in self._values
+
+    def allKeys(self) -> List[str]:
+        return list( self._values.keys() )
+
+    def sync(self):
+        pass
+
 class SettingsManager:
 
     def __init__( self, **kwargs ):
@@ -107,15 +139,24 @@ class SettingsManager:
         QSettings.setPath(QSettings.IniFormat, QSettings.SystemScope, self.system_settings_dir )
         self.project_name = None
         self.default_settings = kwargs.get('defaults',{})
+        self._snapshot: Optional[DictSettings] = None
 
     def initProject(self, name: str, default_settings: Dict ):
         self.project_name = name
         self.default_settings = default_settings
 
     @property
-    def config(self) -> QSettings:
+    def config(self) -> Union[QSettings,DictSettings]:
+        if self._snapshot is not None: return self._snapshot
         return self.getSettings( QSettings.UserScope )
 
+    def snapshot(self) -> Dict:
+        config = self.config
+        return { key: config.value(key) for key in config.allKeys() }
+
+    def useSnapshot(self, snapshot: Optional[Dict] ):
+        self._snapshot = None if snapshot is None else DictSettings( snapshot )
+
     def iparm(self, key: str ):
         return int( self.config.value(key) )
 
@@ -163,6 +163,8 @@ class LabelsManager(QObject,EventClient):
         return None
 
     def updateLabels(self):
+        if self._labels_data is None: return
+        self._labels_data = self._labels_data.where( self._labels_data <= 0, 0 )      # Labels of deleted markers are cleared
         for marker in self._markers:
             for pid in marker.pids:
                 self._labels_data[ pid ] = marker.cid
@@ -191,7 +193,7 @@ class LabelsManager(QObject,EventClient):
             event = dict( event="message", type="warning", title='Workflow Message', caption="Awaiting task completion", msg="The data has not yet been loaded" )
             self.submitEvent( event, EventMode.Gui )
             return None
-        resume = ( optype == "neighbors" ) and ( self._optype == "neighbors" )
+        resume = ( optype == self._optype )     # The flow applies only the label changes since the last spread
         if not resume: self._flow.clear()
         self._optype = optype
         labels_data = self.labels_data(True)
@@ -15,6 +15,7 @@ from collections import Mapping
 from functools import partial
 from hyperclass.gui.application import HCMainWindow
 from hyperclass.data.events import dataEventHandler
+from hyperclass.data.spatial.prefetch import blockPrefetcher
 from hyperclass.gui.events import EventClient, EventMode
 from typing import List, Union, Tuple, Dict
 
@@ -166,6 +167,7 @@ class SpatialAppConsole(HCMainWindow):
                     self.load_tile.addAction(menuButton)
 
     def runSetBlock( self, coords, **kwargs ):
+        blockPrefetcher.cancel()
         taskRunner.start( Task("Loading block", self.setBlock, coords,  **kwargs ) )
 
     def runSetTile( self, coords, **kwargs ):
@@ -250,6 +252,7 @@ class SpatialAppConsole(HCMainWindow):
         current_tile_coords = dataManager.config.value( "tile/indices", None )
         if current_tile_coords is None or current_tile_coords != tile_coords:
             print( f"Setting tile indices = {tile_coords}" )
+            blockPrefetcher.cancel()
             dataManager.config.setValue( "tile/indices", tile_coords )
             filename = dataManager.config.value("data/init/file", None)
             if filename is not None: taskRunner.start(Task(f"Load New Tile", self.openFile, filename, **kwargs) )
@@ -260,6 +263,7 @@ class SpatialAppConsole(HCMainWindow):
         block = self.labelingConsole.setBlock( block_coords, **kwargs )
         self.satelliteCanvas.setBlock(block)
         self.update_block_load_menu.emit()
+        if block is not None: blockPrefetcher.schedule( self.labelingConsole.getTile(), block_coords, subsample=dataEventHandler.subsampling )
         return block
 
     def show(self):
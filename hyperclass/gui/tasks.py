@@ -76,8 +76,12 @@ class TaskRunner(QObject,EventClient):
         print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
 
     def start(self, task: Task, **kwargs ):
+        priority = kwargs.get( 'priority', 0 )
         print(f"Task[{task.context}] running: {task.label}")
-        self.threadpool.start(task)
+        self.threadpool.start( task, priority )
+
+    def cancel(self, task: Task ) -> bool:
+        return self.threadpool.tryTake( task )
 
     def message(self, message: Tuple ):
         Task.showMessage( *message )
@@ -0,0 +1,240 @@
+import xarray as xa
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Union, Tuple, Optional, Dict, NamedTuple
+from hyperclass.data.manager import dataManager
+from hyperclass.data.spatial.tile import Tile, Block, prepare_reduction
+from hyperclass.data.spatial.cache import blockCache
+from hyperclass.data.files import save_array
+import multiprocessing as mp
+import os, time, shutil
+
+class BlockWorkUnit(NamedTuple):
+    # Everything a worker process needs to re-open and classify one block: no array data crosses the process boundary.
+    image: str
+    tile_coords: Tuple[int,int]
+    block_coords: Tuple[int,int]
+    config: Dict
+    options: Dict
+
+_worker_classifiers: Dict[str,"BatchClassifier"] = {}
+
+def process_block_unit( unit: BlockWorkUnit ) -> Tuple[Tuple[int,int],Optional[np.ndarray],Dict[str,List[float]]]:
+    dataManager.useSnapshot( unit.config )
+    dataManager.config.setValue( 'tile/indices', list( unit.tile_coords ) )
+    key = f"{unit.image}:{sorted(unit.options.items())}"
+    classifier = _worker_classifiers.get( key )
+    if classifier is None:
+        classifier = BatchClassifier( **unit.options )
+        if not classifier.prepare(): return unit.block_coords, None, {}
+        _worker_classifiers[ key ] = classifier
+    classifier.timings = OrderedDict()
+    labels = classifier.processBlock( Tile(), unit.tile_coords, unit.block_coords )
+    blockCache.clear()
+    return unit.block_coords, labels, classifier.timings
+
+class BatchClassifier:
+    # Classifies every block of every tile of the current image without a Qt event loop.
+    # Each block's label raster is checkpointed as soon as it is computed, so an interrupted run resumes where it stopped.
+
+    NODATA = -2
+
+    def __init__(self, output_dir: str, **kwargs ):
+        self.output_dir = output_dir
+        self.mode = kwargs.get( 'mode', 'model' )           # 'model': apply the saved learning model, 'spread': spread the saved labels within each block, 'tilespread': over the whole tile
+        self.niters = kwargs.get( 'niters', 100 )
+        self.refresh = kwargs.get( 'refresh', False )
+        self.nproc = kwargs.get( 'nproc', 1 )
+        self.timings: Dict[str,List[float]] = OrderedDict()   # stage -> [ seconds, npoints, nblocks ]
+        self._markers: Optional[List[Dict]] = None
+
+    @property
+    def checkpoint_dir(self) -> str:
+        return os.path.join( self.output_dir, f"{dataManager.spatial.markerFileName()}.{self.mode}.checkpoints" )
+
+    def checkpointFile(self, tile_coords: Tuple[int,int], block_coords: Tuple[int,int] ) -> str:
+        block_size = dataManager.spatial.block_shape[0]
+        return os.path.join( self.checkpoint_dir, f"t{tile_coords[0]}-{tile_coords[1]}.b{block_size}-{block_coords[0]}-{block_coords[1]}.npy" )
+
+    def labelsFile(self, tile_coords: Tuple[int,int] ) -> str:
+        return os.path.join( self.output_dir, f"{dataManager.spatial.markerFileName()}.{self.mode}.t{tile_coords[0]}-{tile_coords[1]}.labels.tif" )
+
+    def record(self, stage: str, t0: float, npoints: int ):
+        timing = self.timings.setdefault( stage, [ 0.0, 0, 0 ] )
+        timing[0] += time.time() - t0
+        timing[1] += npoints
+        timing[2] += 1
+
+    def report(self) -> str:
+        lines = [ "Batch classification throughput:" ]
+        for stage, ( dt, npoints, nblocks ) in self.timings.items():
+            rate = npoints / dt if dt > 0 else float('inf')
+            lines.append( f"   {stage:>10}: {nblocks} blocks, {npoints} points in {dt:.2f} sec ({rate:.0f} points/sec)" )
+        return "\n".join( lines )
+
+    @property
+    def options(self) -> Dict:
+        return dict( output_dir=self.output_dir, mode=self.mode, niters=self.niters )
+
+    def prepare(self) -> bool:
+        from hyperclass.learn.manager import learningManager
+        if self.mode in [ "spread", "tilespread" ]:
+            mm = dataManager.spatial.getMarkerManager()
+            mm.readMarkers()
+            if not mm.hasData:
+                print( f"No saved labels found in {mm.file_path}" )
+                return False
+            self._markers = [ m for m in mm.markers if m['cid'] > 0 ]
+            return True
+        return learningManager.loadModel()
+
+    def run(self) -> bool:
+        image_specs = dataManager.spatial.readImageSpecs( dataManager.spatial.image_name )
+        if image_specs is None: return False
+        dataManager.spatial.setTilesPerImage( image_specs )
+        if not self.prepare(): return False
+        if self.refresh and os.path.isdir( self.checkpoint_dir ): shutil.rmtree( self.checkpoint_dir )
+        os.makedirs( self.checkpoint_dir, exist_ok=True )
+        tile_array_shape = dataManager.config.value( 'tile/array_shape', [1,1], type=int )
+        t0 = time.time()
+        if ( self.nproc > 1 ) and not prepare_reduction(): return False    # Fit once here, not separately in every worker
+        executor = ProcessPoolExecutor( self.nproc, mp_context=mp.get_context("spawn") ) if self.nproc > 1 else None
+        try:
+            for ty in range( tile_array_shape[0] ):
+                for tx in range( tile_array_shape[1] ):
+                    self.processTile( (ty,tx), executor )
+        finally:
+            if executor is not None: executor.shutdown()
+        print( f"Completed batch classification of image {dataManager.spatial.image_name} with {self.nproc} processes in {time.time()-t0} sec" )
+        print( self.report() )
+        return True
+
+    def processTile(self, tile_coords: Tuple[int,int], executor: ProcessPoolExecutor = None ) -> Optional[str]:
+        dataManager.config.setValue( 'tile/indices', list(tile_coords) )
+        tile = Tile()
+        if self.mode == "tilespread": return self.spreadTile( tile, tile_coords )
+        block_array_shape = dataManager.config.value( 'block/array_shape', [1,1], type=int )
+        block_indices = [ (by,bx) for by in range( block_array_shape[0] ) for bx in range( block_array_shape[1] ) ]
+        block_labels: Dict[Tuple[int,int],np.ndarray] = {}
+        if executor is None:
+            for block_coords in block_indices:
+                labels = self.processBlock( tile, tile_coords, block_coords )
+                if labels is not None: block_labels[ block_coords ] = labels
+        else:
+            pending = [ block_coords for block_coords in block_indices if not os.path.isfile( self.checkpointFile( tile_coords, block_coords ) ) ]
+            if len( pending ) and ( dataManager.spatial.getTileAttrs() is None ): dataManager.spatial.getTileData()    # Workers read their blocks from the tile cache
+            config = dataManager.snapshot()
+            futures = [ executor.submit( process_block_unit, BlockWorkUnit( dataManager.spatial.image_name, tile_coords, block_coords, config, self.options ) ) for block_coords in pending ]
+            for block_coords in block_indices:
+                if block_coords not in pending: block_labels[ block_coords ] = self.processBlock( tile, tile_coords, block_coords )
+            for future in as_completed( futures ):
+                block_coords, labels, timings = future.result()
+                if labels is not None: block_labels[ block_coords ] = labels
+                for stage, ( dt, npoints, nblocks ) in timings.items():
+                    timing = self.timings.setdefault( stage, [ 0.0, 0, 0 ] )
+                    timing[0] += dt; timing[1] += npoints; timing[2] += nblocks
+        blockCache.clear( tile.name )
+        return self.writeTileLabels( tile, tile_coords, block_labels )
+
+    def spreadTile(self, tile: Tile, tile_coords: Tuple[int,int] ) -> Optional[str]:
+        # Spreads the labels of every block over one graph of the whole tile (see TileGraph), so that labels in any block classify all of them.
+        from hyperclass.graph.tile import TileGraph
+        if tile.attrs is None: return None
+        t0 = time.time()
+        tile_graph = TileGraph( tile )
+        tile_graph.build()
+        self.record( 'graph', t0, tile_graph.npoints )
+        blocks: Dict[Tuple[int,int],Block] = { block_coords: tile.getBlock( *block_coords ) for block_coords in tile_graph.indices.keys() }
+        seeds = { block_coords: self.getBlockSeeds( block ) for block_coords, block in blocks.items() }
+        if sum( [ np.count_nonzero( block_seeds ) for block_seeds in seeds.values() ] ) == 0:
+            print( f"No labels found in tile {tile_coords}" )
+            return None
+        t0 = time.time()
+        results = tile_graph.spread( seeds, self.niters )
+        self.record( 'spread', t0, tile_graph.npoints )
+        block_labels: Dict[Tuple[int,int],np.ndarray] = {}
+        for block_coords, ( C, P ) in results.items():
+            label_raster = np.full( blocks[block_coords].data.shape[-2:], self.NODATA, dtype=np.int32 )
+            label_raster.reshape(-1)[ blocks[block_coords].point_indices ] = C
+            block_labels[ block_coords ] = label_raster
+        blockCache.clear( tile.name )
+        return self.writeTileLabels( tile, tile_coords, block_labels )
+
+    def processBlock(self, tile: Tile, tile_coords: Tuple[int,int], block_coords: Tuple[int,int] ) -> Optional[np.ndarray]:
+        checkpoint_file = self.checkpointFile( tile_coords, block_coords )
+        if os.path.isfile( checkpoint_file ):
+            print( f"Restoring block {block_coords} of tile {tile_coords} from checkpoint {checkpoint_file}" )
+            return np.load( checkpoint_file )
+        t0 = time.time()
+        block: Optional[Block] = tile.getBlock( *block_coords )
+        if block is None: return None
+        self.record( 'read', t0, block.pindices.size )
+        t0 = time.time()
+        point_data: xa.DataArray = block.getPointData()
+        self.record( 'reduce', t0, point_data.shape[0] )
+        label_raster = np.full( block.data.shape[-2:], self.NODATA, dtype=np.int32 )
+        if point_data.size > 0:
+            label_raster.reshape(-1)[ block.point_indices ] = 0
+            sample_labels = self.classify( block, point_data )
+            if sample_labels is not None: label_raster.reshape(-1)[ block.point_indices ] = sample_labels
+        t0 = time.time()
+        save_array( checkpoint_file, label_raster )
+        self.record( 'write', t0, point_data.shape[0] )
+        return label_raster
+
+    def classify(self, block: Block, point_data: xa.DataArray ) -> Optional[np.ndarray]:
+        from hyperclass.learn.manager import learningManager
+        from hyperclass.graph.flow import activationFlowManager
+        npoints = point_data.shape[0]
+        if self.mode == "spread":
+            seeds = self.getBlockSeeds( block )
+            if np.count_nonzero( seeds ) == 0: return None
+            t0 = time.time()
+            flow = activationFlowManager.getActivationFlow( point_data )
+            self.record( 'graph', t0, npoints )
+            t0 = time.time()
+            sample_labels = xa.DataArray( seeds, dims=['samples'], coords=dict( samples=point_data.coords['samples'] ), attrs=dict( dsid=block.dsid ) )
+            result: Optional[xa.Dataset] = flow.spread( sample_labels, self.niters )
+            activationFlowManager.remove( block.dsid )
+            self.record( 'spread', t0, npoints )
+            return None if result is None else result['C'].values
+        else:
+            t0 = time.time()
+            prediction: xa.DataArray = learningManager.model.apply_classification( point_data )
+            self.record( 'classify', t0, npoints )
+            return prediction.values
+
+    def getBlockSeeds(self, block: Block ) -> np.ndarray:
+        seeds = np.zeros( block.point_indices.size, dtype=np.int32 )
+        markers = [ m for m in self._markers if block.inBounds( m['y'], m['x'] ) ]
+        if len( markers ) == 0: return seeds
+        iy, ix = block.multi_coords2indices( [ m['y'] for m in markers ], [ m['x'] for m in markers ] )
+        ny, nx = block.data.shape[-2:]
+        in_block = ( iy >= 0 ) & ( iy < ny ) & ( ix >= 0 ) & ( ix < nx )
+        pixels = iy * nx + ix
+        pos = np.searchsorted( block.point_indices, pixels )
+        valid = in_block & ( pos < block.point_indices.size )
+        valid[valid] = block.point_indices[ pos[valid] ] == pixels[valid]
+        seeds[ pos[valid] ] = np.array( [ m['cid'] for m in markers ], dtype=np.int32 )[valid]
+        return seeds
+
+    def writeTileLabels(self, tile: Tile, tile_coords: Tuple[int,int], block_labels: Dict[Tuple[int,int],np.ndarray] ) -> Optional[str]:
+        if len( block_labels ) == 0: return None
+        block_shape = dataManager.spatial.block_shape
+        ny = max( [ by*block_shape[0] + labels.shape[0] for (by,bx), labels in block_labels.items() ] )
+        nx = max( [ bx*block_shape[1] + labels.shape[1] for (by,bx), labels in block_labels.items() ] )
+        tile_labels = np.full( [ny, nx], self.NODATA, dtype=np.int32 )
+        for (by,bx), labels in block_labels.items():
+            y0, x0 = by*block_shape[0], bx*block_shape[1]
+            tile_labels[ y0:y0+labels.shape[0], x0:x0+labels.shape[1] ] = labels
+        tr = tile.attrs['transform']
+        coords = dict( y = tr[5] + ( np.arange(ny) + 0.5 ) * tr[4], x = tr[2] + ( np.arange(nx) + 0.5 ) * tr[0] )
+        labels_raster = xa.DataArray( tile_labels, dims=['y','x'], coords=coords, attrs=dict( _FillValue=self.NODATA ), name="labels" )
+        tile_cache = dataManager.spatial.tileCache()
+        crs_wkt = None if tile_cache.header is None else tile_cache.header['crs_wkt']
+        if crs_wkt is not None: labels_raster.rio.write_crs( crs_wkt, inplace=True )
+        output_file = self.labelsFile( tile_coords )
+        labels_raster.rio.to_raster( output_file )
+        print( f"Writing labels for tile {tile_coords} to file {output_file}, shape = {tile_labels.shape}" )
+        return output_file
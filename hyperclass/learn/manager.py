@@ -1,5 +1,5 @@
 import xarray as xa
-import time, traceback, abc
+import time, traceback, abc, os, pickle
 import numpy as np
 import scipy
 
@@ -8,6 +8,7 @@ from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
 from hyperclass.gui.events import EventClient, EventMode
 from typing import List, Tuple, Optional, Dict
 from hyperclass.gui.tasks import taskRunner, Task
+from hyperclass.data.files import atomic_write
 
 class Cluster:
 
@@ -90,6 +91,18 @@ class LearningManager(QObject,EventClient):
         model: LearningModel = self._models[ mid ]
         return model
 
+    def modelFilePath(self, mid: str ) -> str:
+        from hyperclass.data.manager import dataManager
+        return os.path.join( dataManager.config.value('data/cache'), f"{dataManager.spatial.markerFileName()}.{mid}.model.pkl" )
+
+    def saveModel(self, *args, **kwargs ) -> Optional[str]:
+        model = self.model
+        return model.save( kwargs.get( 'path', self.modelFilePath( model.mid ) ) )
+
+    def loadModel(self, *args, **kwargs ) -> bool:
+        model = self.model
+        return model.load( kwargs.get( 'path', self.modelFilePath( model.mid ) ) )
+
     def learn_classification( self, block, labels: xa.DataArray, **kwargs  ):
         from hyperclass.data.manager import dataManager
         from hyperclass.umap.manager import umapManager
@@ -175,5 +188,25 @@ class LearningModel:
     def predict( self, data: np.ndarray, **kwargs ):
         raise Exception( "abstract method LearningModel.predict called")
 
+    def save(self, path: str ) -> Optional[str]:
+        try:
+            print( f"Saving model {self.mid} to file {path}")
+            with atomic_write( path ) as tmp_file:
+                with open( tmp_file, 'wb' ) as f: pickle.dump( self.__dict__, f )
+            return path
+        except Exception as err:
+            print( f" Can't save model {self.mid}: {err}")
+            return None
+
+    def load(self, path: str ) -> bool:
+        try:
+            with open( path, 'rb' ) as f:
+                print( f"Loading model {self.mid} from file {path}")
+                self.__dict__.update( pickle.load( f ) )
+            return True
+        except Exception as err:
+            print( f" Can't load model {self.mid}: {err}")
+            return False
+
 learningManager = LearningManager()
 
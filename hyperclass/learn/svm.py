@@ -1,7 +1,4 @@
-from sklearn.pipeline import make_pipeline
-from sklearn.preprocessing import StandardScaler
 from typing import List, Union, Dict, Callable, Tuple, Optional
-from sklearn.svm import LinearSVC
 import xarray as xa
 import time, traceback
 from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
@@ -16,10 +13,21 @@ class SCVLearningModel(LearningModel):
     def __init__(self, **kwargs ):
         LearningModel.__init__(self, "svc",  **kwargs )
         self._score: Optional[np.ndarray] = None
-        norm = kwargs.get( 'norm', True )
-        tol = kwargs.pop( 'tol', 1e-5 )
-        if norm: self.svc = make_pipeline( StandardScaler(), LinearSVC( tol=tol, dual=False, fit_intercept=False, **kwargs ) )
-        else:    self.svc = LinearSVC(tol=tol, dual=False, fit_intercept=False, **kwargs)
+        self._svc = None
+        self._svc_parms = dict( kwargs )
+
+    @property
+    def svc(self):
+        if self._svc is None:
+            from sklearn.pipeline import make_pipeline
+            from sklearn.preprocessing import StandardScaler
+            from sklearn.svm import LinearSVC
+            kwargs = dict( self._svc_parms )
+            norm = kwargs.get( 'norm', True )
+            tol = kwargs.pop( 'tol', 1e-5 )
+            if norm: self._svc = make_pipeline( StandardScaler(), LinearSVC( tol=tol, dual=False, fit_intercept=False, **kwargs ) )
+            else:    self._svc = LinearSVC(tol=tol, dual=False, fit_intercept=False, **kwargs)
+        return self._svc
 
     def fit( self, X: np.ndarray, y: np.ndarray, **kwargs ):
         t0 = time.time()
@@ -144,7 +144,9 @@ class LabelingConsole(QObject,EventClient):
         self.menu_actions = OrderedDict( Layers = [ [ "Increase Labels Alpha", 'Ctrl+>', None, partial( self.update_image_alpha, "labels", True ) ],
                                                     [ "Decrease Labels Alpha", 'Ctrl+<', None, partial( self.update_image_alpha, "labels", False ) ],
                                                     [ "Increase Band Alpha",   'Alt+>',  None, partial( self.update_image_alpha, "bands", True ) ],
-                                                    [ "Decrease Band Alpha",   'Alt+<',  None, partial( self.update_image_alpha, "bands", False ) ] ] )
+                                                    [ "Decrease Band Alpha",   'Alt+<',  None, partial( self.update_image_alpha, "bands", False ) ] ],
+                                         Session = [ [ "Save Labels", 'Ctrl+S', "Save labeled points for batch classification", self.save_labels ],
+                                                     [ "Save Model",  None, "Save the current learning model for batch classification", self.save_model ] ] )
  #                                                   OrderedDict( GoogleMaps=google_actions )  ]  )
 
         atexit.register(self.exit)
@@ -313,6 +315,25 @@ class LabelingConsole(QObject,EventClient):
         event = dict( event="classify", type="apply", data=self.block  )
         self.submitEvent(event, EventMode.Gui )
 
+    def save_labels(self, *args, **kwargs ):
+        if self.block is None: return
+        markers = []
+        for marker in labelsManager.getMarkers():
+            if marker.cid > 0:
+                for pid in marker.pids:
+                    coords = self.block.pindex2coords( pid )
+                    if coords is not None: markers.append( dict( cid=marker.cid, y=float(coords['y']), x=float(coords['x']) ) )
+        mm = dataManager.spatial.getMarkerManager()
+        mm.readMarkers()
+        if mm.hasData:
+            other_markers = [ m for m in mm.markers if not self.block.inBounds( m['y'], m['x'] ) ]
+            markers = other_markers + markers
+        mm.writeMarkers( labelsManager.labels, labelsManager.colors, markers )
+
+    def save_model(self, *args, **kwargs ):
+        from hyperclass.learn.manager import learningManager
+        learningManager.saveModel()
+
     def initLabels(self):
         nodata_value = -2
         template = self.block.data[0].squeeze( drop=True )
@@ -1,31 +1,145 @@
 from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
 from hyperclass.gui.events import EventClient, EventMode
 from hyperclass.gui.dialog import DialogBase
-from typing import List, Union, Tuple, Dict
+from typing import List, Union, Tuple, Dict, Optional, Iterable
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QRadioButton, QLabel, QPushButton, QFrame, QMessageBox, QGroupBox
-from keras.layers import *
-from keras.models import *
-from keras.callbacks import *
 import xarray as xa
-import numpy as np, time
+import numpy as np, time, os, threading
+from hyperclass.data.files import atomic_write
+
+class LinearReducer:
+    # Linear projection ( X - mean ) @ components.T shared by the PCA, IncrementalPCA and RandomizedSVD methods.
+
+    def __init__( self, mean: np.ndarray, components: np.ndarray ):
+        self.mean = mean.astype( np.float32 )
+        self.components = components.astype( np.float32 )
+
+    @classmethod
+    def fit( cls, inputs: Union[np.ndarray,Iterable[np.ndarray]], reduction_method: str, ndim: int ) -> "LinearReducer":
+        # IncrementalPCA streams the batches; the other methods need all the data at once, so an iterable of batches is concatenated.
+        method = reduction_method.lower()
+        if method == "incrementalpca":
+            from sklearn.decomposition import IncrementalPCA
+            ipca = IncrementalPCA( n_components=ndim )
+            ready, pending = None, []
+            for batch in ( [inputs] if isinstance( inputs, np.ndarray ) else inputs ):
+                pending.append( batch )
+                if sum( [ b.shape[0] for b in pending ] ) >= ndim:
+                    if ready is not None: ipca.partial_fit( ready )
+                    ready, pending = np.concatenate( pending ), []
+            if ready is None: raise Exception( f"Not enough data for an IncrementalPCA reduction to {ndim} dimensions: {sum( [ b.shape[0] for b in pending ] )} samples" )
+            ipca.partial_fit( np.concatenate( [ ready ] + pending ) )        # The last batch takes any remainder smaller than ndim
+            return LinearReducer( ipca.mean_, ipca.components_ )
+        if not isinstance( inputs, np.ndarray ): inputs = np.concatenate( list( inputs ) )
+        if method == "pca":
+            from sklearn.decomposition import PCA
+            pca = PCA( n_components=ndim, svd_solver="full" ).fit( inputs )
+            return LinearReducer( pca.mean_, pca.components_ )
+        elif method == "randomizedsvd":
+            from sklearn.utils.extmath import randomized_svd
+            mean = inputs.mean( axis=0 )
+            U, S, VT = randomized_svd( inputs - mean, n_components=ndim, random_state=0 )
+            return LinearReducer( mean, VT )
+        raise Exception( f"Unknown linear reduction method: {reduction_method}" )
+
+    def transform( self, inputs: np.ndarray ) -> np.ndarray:
+        return ( inputs - self.mean ) @ self.components.T
+
+    def inverse_transform( self, reduced: np.ndarray ) -> np.ndarray:
+        return reduced @ self.components + self.mean
+
+    def save( self, path: str ):
+        np.savez( path, mean=self.mean, components=self.components )
+
+    @classmethod
+    def load( cls, path: str ) -> "LinearReducer":
+        archive = np.load( path )
+        return LinearReducer( archive['mean'], archive['components'] )
 
 class ReductionManager(QObject,EventClient):
 
+    ACTIVATION = 'tanh'
+    REDUCTION_FACTOR = 2
+    LINEAR_METHODS = [ "pca", "incrementalpca", "randomizedsvd" ]
+
     def __init__( self, **kwargs ):
         QObject.__init__(self)
+        self._encoders: Dict[str,Union["Model",LinearReducer]] = {}
+        self._locks: Dict[str,threading.Lock] = {}
+        self._locks_lock = threading.Lock()
 
     def config_gui(self, base: DialogBase):
-        self.methodSelector = base.createComboSelector("Method: ", ["None", "Autoencoder"], "input.reduction/method", "Autoencoder" )
+        self.methodSelector = base.createComboSelector("Method: ", ["None", "Autoencoder", "PCA", "IncrementalPCA", "RandomizedSVD"], "input.reduction/method", "Autoencoder" )
         self.nDimSelector = base.createComboSelector("#Dimensions: ", list(range(3, 120)), "input.reduction/ndim", 32)
         self.ssSelector = base.createComboSelector("Subsample: ", list(range(1, 200, 2)), "input.reduction/subsample", 1)
-        return base.createGroupBox("reduction", [self.methodSelector, self.nDimSelector, self.ssSelector])
+        self.nSamplesSelector = base.createComboSelector("Training Samples: ", [ 10000*2**i for i in range(0, 7) ], "input.reduction/nsamples", 50000 )
+        return base.createGroupBox("reduction", [self.methodSelector, self.nDimSelector, self.ssSelector, self.nSamplesSelector])
 
     def reduce(self, inputs: np.ndarray, reduction_method: str, ndim: int, nepochs: int = 1  ) -> Tuple[np.ndarray,np.ndarray]:
         if reduction_method.lower() == "autoencoder": return self.autoencoder( inputs, ndim, nepochs )
+        if reduction_method.lower() in self.LINEAR_METHODS:
+            reducer = LinearReducer.fit( inputs, reduction_method, ndim )
+            reduced = reducer.transform( inputs )
+            return ( reduced, reducer.inverse_transform( reduced ) )
+
+    @classmethod
+    def isLinear( cls, reduction_method: str ) -> bool:
+        return reduction_method.lower() in cls.LINEAR_METHODS
+
+    @classmethod
+    def architecture( cls, reduction_method: str, input_dims: int, ndim: int ) -> str:
+        if cls.isLinear( reduction_method ): return f"linear{input_dims}-{ndim}"
+        return f"ae{input_dims}-{ndim}-{cls.ACTIVATION}-r{cls.REDUCTION_FACTOR}"
+
+    def modelFilePath( self, model_key: str, reduction_method: str ) -> str:
+        from hyperclass.data.manager import dataManager
+        extension = "linear.npz" if self.isLinear( reduction_method ) else "encoder.h5"
+        return os.path.join( dataManager.config.value('data/cache'), f"{model_key}.{extension}" )
+
+    def modelLock( self, model_key: str ) -> threading.Lock:
+        # Held around the check-and-fit of a model, so threads reducing blocks concurrently fit it only once.
+        with self._locks_lock:
+            return self._locks.setdefault( model_key, threading.Lock() )
+
+    def getEncoder( self, model_key: str, reduction_method: str = "autoencoder" ) -> Optional[Union["Model",LinearReducer]]:
+        encoder = self._encoders.get( model_key )
+        if encoder is None:
+            model_file = self.modelFilePath( model_key, reduction_method )
+            if os.path.isfile( model_file ):
+                print( f"Loading encoder from file {model_file}")
+                if self.isLinear( reduction_method ):
+                    encoder = LinearReducer.load( model_file )
+                else:
+                    from keras.models import load_model
+                    encoder = load_model( model_file, compile=False )
+                self._encoders[ model_key ] = encoder
+        return encoder
+
+    def fit( self, inputs: Union[np.ndarray,Iterable[np.ndarray]], reduction_method: str, ndim: int, nepochs: int, model_key: str ) -> Optional[Union["Model",LinearReducer]]:
+        t0 = time.time()
+        model_file = self.modelFilePath( model_key, reduction_method )
+        if self.isLinear( reduction_method ):
+            encoder = LinearReducer.fit( inputs, reduction_method, ndim )
+        elif reduction_method.lower() == "autoencoder":
+            autoencoder, encoder = self.buildAutoencoder( inputs.shape[1], ndim )
+            autoencoder.fit( inputs, inputs, epochs=nepochs, batch_size=256, shuffle=True )
+        else: return None
+        with atomic_write( model_file ) as tmp_file:     # Readers in other threads or processes never load a partially written model
+            encoder.save( tmp_file )
+        self._encoders[ model_key ] = encoder
+        print( f"Fit {reduction_method} reduction {model_key} in {time.time()-t0} sec, saved to {model_file}")
+        return encoder
+
+    def transform( self, inputs: np.ndarray, model_key: str, reduction_method: str = "autoencoder" ) -> Optional[np.ndarray]:
+        encoder = self.getEncoder( model_key, reduction_method )
+        if encoder is None: return None
+        if isinstance( encoder, LinearReducer ): return encoder.transform( inputs )
+        with self.modelLock( model_key ):         # Keras models are not safe to call from several threads at once
+            return encoder.predict( inputs, batch_size=4096 )
 
     def xreduce(self, inputs: xa.DataArray, reduction_method: str, ndim: int ) -> Tuple[xa.DataArray,xa.DataArray]:
-        if reduction_method.lower() == "autoencoder":
-            ( encoded_data, reproduced_data ) = self.autoencoder( inputs.values, ndim )
+        if reduction_method.lower() in [ "autoencoder" ] + self.LINEAR_METHODS:
+            ( encoded_data, reproduced_data ) = self.reduce( inputs.values, reduction_method, ndim, 100 )
             coords = {inputs.dims[0]: inputs.coords[inputs.dims[0]], inputs.dims[1]: np.arange(ndim)}
             x_encoded_data = xa.DataArray(encoded_data, dims=inputs.dims, coords=coords, attrs=inputs.attrs)
             x_reproduced_data = xa.DataArray( reproduced_data, dims=inputs.dims, coords=inputs.coords, attrs=inputs.attrs)
@@ -48,11 +162,12 @@ class ReductionManager(QObject,EventClient):
         print(f"Completed spectral_embedding in {(time.time() - t0) / 60.0} min.")
         return rv
 
-    def autoencoder( self, encoder_input: np.ndarray, ndim: int, epochs: int = 100 ) -> Tuple[np.ndarray,np.ndarray]:
-        input_dims = encoder_input.shape[1]
-        reduction_factor = 2
+    def buildAutoencoder( self, input_dims: int, ndim: int ) -> Tuple["Model","Model"]:
+        from keras.layers import Input, Dense
+        from keras.models import Model
+        reduction_factor = self.REDUCTION_FACTOR
         inputlayer = Input( shape=[input_dims] )
-        activation = 'tanh'
+        activation = self.ACTIVATION
         loss = "cosine_similarity"
         encoded = None
         layer_dims, x = int( round( input_dims / reduction_factor )), inputlayer
@@ -71,7 +186,10 @@ class ReductionManager(QObject,EventClient):
         autoencoder = Model(inputs=[inputlayer], outputs=[decoded])
         encoder = Model(inputs=[inputlayer], outputs=[encoded])
         autoencoder.compile(loss=loss, optimizer='rmsprop')
+        return autoencoder, encoder
 
+    def autoencoder( self, encoder_input: np.ndarray, ndim: int, epochs: int = 100 ) -> Tuple[np.ndarray,np.ndarray]:
+        autoencoder, encoder = self.buildAutoencoder( encoder_input.shape[1], ndim )
         autoencoder.fit( encoder_input, encoder_input, epochs=epochs, batch_size=256, shuffle=True )
         return  ( encoder.predict( encoder_input ), autoencoder.predict( encoder_input ) )
 
@@ -1,5 +1,5 @@
 import xarray as xa
-import time, traceback
+import time, traceback, os
 import numpy as np
 
 from hyperclass.gui.dialog import DialogBase
@@ -10,10 +10,8 @@ from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
 from hyperclass.gui.events import EventClient, EventMode
 from hyperclass.data.events import dataEventHandler, DataType
 from hyperclass.graph.flow import activationFlowManager
-from hyperclass.umap.model import UMAP
 from collections import OrderedDict
 from typing import List, Tuple, Optional, Dict
-from hyperclass.plot.point_cloud import PointCloud
 from hyperclass.data.manager import dataManager
 from hyperclass.data.spatial.tile import Tile, Block
 from hyperclass.gui.tasks import taskRunner, Task
@@ -30,19 +28,26 @@ class UMAPManager(QObject,EventClient):
 
     def __init__(self,  **kwargs ):
         QObject.__init__(self)
-        self.point_cloud: PointCloud = PointCloud( )
+        self._point_cloud = None
         self._point_data = None
         self._gui = None
         self._current_event = None
         self.embedding_type = kwargs.pop('embedding_type', 'umap')
         self.conf = kwargs
         self._state = self.UNDEF
-        self.learned_mapping: Optional[UMAP] = None
-        self._mapper: Dict[ str, UMAP ] = {}
-        self._current_mapper: UMAP = None
+        self.learned_mapping: Optional["UMAP"] = None
+        self._mapper: Dict[ str, "UMAP" ] = {}
+        self._current_mapper: "UMAP" = None
         self.update_signal.connect( self.gui_update )
         self.menu_actions = OrderedDict( Plots =  [ [ "Increase Point Sizes", 'Ctrl+}',  None, partial( self.update_point_sizes, True ) ],
                                                     [ "Decrease Point Sizes", 'Ctrl+{',  None, partial( self.update_point_sizes, False ) ] ] )
+    @property
+    def point_cloud(self) -> "PointCloud":
+        if self._point_cloud is None:
+            from hyperclass.plot.point_cloud import PointCloud
+            self._point_cloud = PointCloud( )
+        return self._point_cloud
+
     def gui( self, parent ):
         from hyperclass.gui.mpl import PointCloudImageCanvas
         from hyperclass.gui.points import VTKFrame
@@ -73,7 +78,13 @@ class UMAPManager(QObject,EventClient):
         nEpochsSelector = base.createComboSelector( "#Epochs: ", list(range(50, 500, 50)), "umap/nepochs", 200 )
         alphaSelector = base.createComboSelector("alpha: ", np.arange(0.1, 2.0, 0.1 ).tolist(), "umap/alpha", 1.0)
         target_weightSelector = base.createComboSelector("target_weight: ", np.arange( 0.1, 1.0, 0.1 ).tolist(), "umap/target_weight", 0.5)
-        return base.createGroupBox( "umap", [nNeighborsSelector, initSelector, embedDimensionsSelector, nEpochsSelector, alphaSelector, target_weightSelector ] )
+        graphCacheSelector = base.createComboSelector("NN Graph Cache: ", [ "none", "graph", "index" ], "graph/cache", "graph" )
+        spatialSelector = base.createComboSelector("Spatial Edges: ", [ 0, 4, 8 ], "graph/spatial", 0 )
+        spatialWeightSelector = base.createComboSelector("Spatial Weight: ", [ 0.25, 0.5, 1.0, 2.0, 4.0 ], "graph/spatial_weight", 1.0 )
+        knnMethodSelector = base.createComboSelector("NN Method: ", [ "auto", "exact", "tree", "nndescent" ], "graph/knn", "auto" )
+        graphStorageSelector = base.createComboSelector("Graph Storage: ", [ "float32", "float16", "uint8" ], "graph/storage", "float32" )
+        spreadThreadsSelector = base.createComboSelector("Spread Threads: ", [ 2**i for i in range( 0, 7 ) if 2**i <= os.cpu_count() ], "graph/nthreads", 1 )
+        return base.createGroupBox( "umap", [nNeighborsSelector, initSelector, embedDimensionsSelector, nEpochsSelector, alphaSelector, target_weightSelector, graphCacheSelector, knnMethodSelector, graphStorageSelector, spatialSelector, spatialWeightSelector, spreadThreadsSelector ] )
 
     def plotMarkers(self, **kwargs ):
         clear = kwargs.get( 'clear', False )
@@ -171,7 +182,7 @@ class UMAPManager(QObject,EventClient):
 
     def embedding( self,  **kwargs ) -> Optional[xa.DataArray]:
         ndim = kwargs.get('ndim', dataManager.config.value("umap/dims", type=int) )
-        mapper: UMAP = self.getMapper( self._point_data.attrs['dsid'], ndim )
+        mapper: "UMAP" = self.getMapper( self._point_data.attrs['dsid'], ndim )
         if mapper.embedding is not None:
             return self.wrap_embedding(self._point_data.coords[ self._point_data.dims[0] ], mapper.embedding )
         return self.embed( **kwargs )
@@ -180,7 +191,8 @@ class UMAPManager(QObject,EventClient):
         ax_model = np.arange( embedding.shape[1] )
         return xa.DataArray( embedding, dims=['samples','model'], coords=dict( samples=ax_samples, model=ax_model ) )
 
-    def getMapper(self, dsid: str, ndim: int ) -> UMAP:
+    def getMapper(self, dsid: str, ndim: int ) -> "UMAP":
+        from hyperclass.umap.model import UMAP
         mid = f"{ndim}-{dsid}"
         mapper = self._mapper.get( mid )
         if ( mapper is None ):
@@ -207,16 +219,16 @@ class UMAPManager(QObject,EventClient):
         self.point_cloud.update_point_sizes( increase )
 
     def supervised(self, block: Block, labels: xa.DataArray, ndim: int, **kwargs) -> Tuple[Optional[xa.DataArray], Optional[xa.DataArray]]:
-        from hyperclass.graph.flow import ActivationFlow
+        from hyperclass.graph.index import knnIndexRegistry
         flow = labelsManager.flow()
-        if flow.nnd is None:
+        if flow.index is None:
             event = dict( event="message", type="warning", title='Workflow Message', caption="Awaiting task completion", msg="The NN graph computation has not yet finished" )
             self.submitEvent( event, EventMode.Gui )
             return None, None
-        self.learned_mapping: UMAP = self.getMapper( block.dsid, ndim )
+        self.learned_mapping = self.getMapper( block.dsid, ndim )
         point_data: xa.DataArray = block.getPointData( **kwargs )
-        nnd = ActivationFlow.getNNGraph( point_data, **kwargs )
-        self.learned_mapping.embed(point_data.data, nnd, labels.values, **kwargs)
+        index = knnIndexRegistry.getIndex( point_data, **kwargs )
+        self.learned_mapping.embed(point_data.data, index, labels.values, **kwargs)
         coords = dict(samples=point_data.samples, model=np.arange(self.learned_mapping.embedding.shape[1]))
         return xa.DataArray(self.learned_mapping.embedding, dims=['samples', 'model'], coords=coords), labels
 
@@ -240,7 +252,7 @@ class UMAPManager(QObject,EventClient):
 
     def embed( self, **kwargs ) -> Optional[xa.DataArray]:
         flow = activationFlowManager.getActivationFlow( self._point_data )
-        if flow.nnd is None:
+        if flow.index is None:
             event = dict( event="message", type="warning", title='Workflow Message', caption="Awaiting task completion", msg="The NN graph computation has not yet finished" )
             self.submitEvent( event, EventMode.Gui )
             return None
@@ -272,7 +284,7 @@ class UMAPManager(QObject,EventClient):
                     mapper.init = init_method
                 print( f"Completed data prep in {(t1 - t0)} sec, Now fitting umap[{ndim}] with {self._point_data.shape[0]} samples and {np.count_nonzero(labels_data)} labels")
 
-                mapper.embed(self._point_data.data, flow.nnd, labels_data, **kwargs)
+                mapper.embed(self._point_data.data, flow.index, labels_data, **kwargs)
             except Exception as err:
                 print( f" Embedding error: {err}")
                 traceback.print_exc(50)
@@ -26,6 +26,7 @@ from umap.layouts import ( optimize_layout_generic, optimize_layout_inverse )
 from pynndescent import NNDescent
 from pynndescent.distances import named_distances as pynn_named_distances
 from pynndescent.sparse import sparse_named_distances as pynn_sparse_named_distances
+from hyperclass.graph.csr import CSRGraph
 _HAVE_PYNNDESCENT = True
 
 locale.setlocale(locale.LC_NUMERIC, "C")
@@ -218,7 +219,9 @@ def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1
     rho = np.zeros(distances.shape[0], dtype=np.float32)
     result = np.zeros(distances.shape[0], dtype=np.float32)
 
-    mean_distances = np.mean(distances)
+    # Slots with a negative distance are missing neighbours (e.g. the padding of rows merged with spatial edges) and are left out
+    valid = distances >= 0.0
+    mean_distances = np.sum(np.where(valid, distances, 0.0)) / max(np.sum(valid), 1)
 
     for i in range(distances.shape[0]):
         lo = 0.0
@@ -246,6 +249,8 @@ def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1
 
             psum = 0.0
             for j in range(1, distances.shape[1]):
+                if distances[i, j] < 0.0:
+                    continue
                 d = distances[i, j] - rho[i]
                 if d > 0:
                     psum += np.exp(-(d / mid))
@@ -269,7 +274,7 @@ def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1
 
         # TODO: This is very inefficient, but will do for now. FIXME
         if rho[i] > 0.0:
-            mean_ith_distances = np.mean(ith_distances)
+            mean_ith_distances = np.mean(ith_distances[ith_distances >= 0.0])
             if result[i] < MIN_K_DIST_SCALE * mean_ith_distances:
                 result[i] = MIN_K_DIST_SCALE * mean_ith_distances
         else:
@@ -2355,7 +2360,9 @@ def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1
     rho = np.zeros(distances.shape[0], dtype=np.float32)
     result = np.zeros(distances.shape[0], dtype=np.float32)
 
-    mean_distances = np.mean(distances)
+    # Slots with a negative distance are missing neighbours (e.g. the padding of rows merged with spatial edges) and are left out
+    valid = distances >= 0.0
+    mean_distances = np.sum(np.where(valid, distances, 0.0)) / max(np.sum(valid), 1)
 
     for i in range(distances.shape[0]):
         lo = 0.0
@@ -2383,6 +2390,8 @@ def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1
 
             psum = 0.0
             for j in range(1, distances.shape[1]):
+                if distances[i, j] < 0.0:
+                    continue
                 d = distances[i, j] - rho[i]
                 if d > 0:
                     psum += np.exp(-(d / mid))
@@ -2406,7 +2415,7 @@ def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1
 
         # TODO: This is very inefficient, but will do for now. FIXME
         if rho[i] > 0.0:
-            mean_ith_distances = np.mean(ith_distances)
+            mean_ith_distances = np.mean(ith_distances[ith_distances >= 0.0])
             if result[i] < MIN_K_DIST_SCALE * mean_ith_distances:
                 result[i] = MIN_K_DIST_SCALE * mean_ith_distances
         else:
@@ -2610,9 +2619,10 @@ def fuzzy_simplicial_set(
         knn_indices, knn_dists, sigmas, rhos
     )
 
-    result = scipy.sparse.coo_matrix(
-        (vals, (rows, cols)), shape=(X.shape[0], X.shape[0])
-    )
+    # Assembled row by row straight into CSR (the rows are already grouped), instead of going through a COO matrix
+    result = CSRGraph.fromKNN(
+        knn_indices, vals.reshape(knn_indices.shape), symmetric=False, keep_max=True
+    ).toScipy()
     result.eliminate_zeros()
 
     if apply_set_operations: